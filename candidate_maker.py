@@ -0,0 +1,6 @@
+import sys
+from utils import cli_candidate_handler
+
+if __name__ == "__main__":
+    args = sys.argv
+    cli_candidate_handler.main(args)
@@ -0,0 +1,6 @@
+import sys
+from utils import cli_export_handler
+
+if __name__ == "__main__":
+    args = sys.argv
+    cli_export_handler.main(args)
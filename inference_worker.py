@@ -0,0 +1,6 @@
+import sys
+from utils import cli_worker_handler
+
+if __name__ == "__main__":
+    args = sys.argv
+    cli_worker_handler.main(args)
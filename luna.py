@@ -0,0 +1,9 @@
+import time
+STARTED = time.perf_counter()
+
+import sys
+from utils import cli
+
+if __name__ == "__main__":
+    args = sys.argv
+    cli.main(args, STARTED)
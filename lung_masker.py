@@ -0,0 +1,6 @@
+import sys
+from utils import cli_lung_handler
+
+if __name__ == "__main__":
+    args = sys.argv
+    cli_lung_handler.main(args)
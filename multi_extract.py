@@ -1,5 +1,5 @@
 # lets take only 2 subsets at a time for now
-from utils import cli_multi_extractor_handler, cli_make_handler
+from utils import cli_multi_extractor_handler
 from concurrent.futures import ThreadPoolExecutor
 import sys
 
@@ -7,8 +7,9 @@ import sys
 def main():
     args = sys.argv
     batch_args = cli_multi_extractor_handler.main(args)
-    with ThreadPoolExecutor(max_workers=len(batch_args)//2) as executor:
-        executor.map(cli_make_handler.extracting, batch_args)
+    from utils.patching import extracting
+    with ThreadPoolExecutor(max_workers=max(1, len(batch_args)//2)) as executor:
+        executor.map(extracting, batch_args)
 
 if __name__ == "__main__":
     main()
@@ -1,73 +1,97 @@
+import time
+STARTED = time.perf_counter()
+
+import argparse
+import importlib.util
 import subprocess
-import sys
 import os
-from utils.install_torch_cuda import install_pytorch
-
-
-args = sys.argv
-
-if '-h' in args:
-    print("""
-\033[1;34mUsage:\033[0m script.py -d \033[1;32m<MAIN_DATA_DIR>\033[0m -o \033[1;32m<MAIN_OUTPUT_DIR>\033[0m -c \033[1;32m<CSV_PATH>\033[0m
-
-\033[1;34mArguments:\033[0m
-  \033[1;33m-d\033[0m    Path to the main data directory for a subset.
-  \033[1;33m-o\033[0m    Path to the output directory where results will be stored.
-  \033[1;33m-c\033[0m    Path to the annotations CSV file (\033[1;36mannotations.csv\033[0m) of the LUNA16 dataset.
-
-\033[1;34mExample:\033[0m
-  python script.py -d \033[1;32m/path/to/data\033[0m -o \033[1;32m/path/to/output\033[0m -c \033[1;32m/path/to/annotations.csv\033[0m
-""")
-
-    exit(0)
 
-
-install_pytorch()
-MAIN_DATA_DIR = args[args.index('-d')+1]
-MAIN_OUTPUT_DIR = args[args.index('-o')+1]
+parser = argparse.ArgumentParser(
+    description="Runs extraction, VNet inference, patching and DRR generation for one LUNA16 subset.",
+    epilog="Example:\n  python pipeline.py -d /path/to/data -o /path/to/output -c /path/to/annotations.csv",
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    allow_abbrev=False,
+)
+parser.add_argument('-d', dest='data', required=True, help='Path to the main data directory for a subset.')
+parser.add_argument('-o', dest='out', required=True, help='Path to the output directory where results will be stored.')
+parser.add_argument('-c', dest='csv', help='Path to the annotations CSV file (annotations.csv) of the LUNA16 dataset.')
+parser.add_argument('--candidates', choices=['fast', 'balanced', 'sensitive'], help='Unlabeled scans: propose nodule candidates with this preset and run on them instead of -c.')
+parser.add_argument('--worker', dest='queue', help='Queue folder of a running inference_worker.py, reuses its warm model.')
+parser.add_argument('--lungs', action='store_true', help='Precompute lung boxes first and skip VNet on patches outside the lungs.')
+parser.add_argument('--mem-limit', help='RAM budget such as 16G for the CPU stages; scans are only started while their estimated footprint fits.')
+parser.add_argument('--workers', type=int, default=1, help='Maximum number of scans processed in parallel by the CPU stages.')
+parser.add_argument('--install-torch', action='store_true', help='(Re)install PyTorch for the detected CUDA version before running.')
+parser.add_argument('--timing', action='store_true', help='Print startup time.')
+args = parser.parse_args()
+if not args.csv and not args.candidates:
+    parser.error("one of -c or --candidates is required")
+
+if args.timing:
+    print(f"Startup: {(time.perf_counter() - STARTED) * 1000:.0f} ms")
+
+# provisioning is a one-time step, only done when torch is missing or on request
+if args.install_torch or importlib.util.find_spec("torch") is None:
+    from utils.install_torch_cuda import install_pytorch
+    install_pytorch()
+
+MAIN_DATA_DIR = args.data
+MAIN_OUTPUT_DIR = args.out
 
 os.makedirs(MAIN_OUTPUT_DIR, exist_ok=True)
 
-CSV_PATH = args[args.index('-c')+1]
+CSV_PATH = args.csv if not args.candidates else os.path.join(MAIN_OUTPUT_DIR, 'candidates.csv')
 PATCH_MASK_DIR = os.path.join(MAIN_OUTPUT_DIR, 'patch_dataset')
 INFERENCE_DIR = os.path.join(MAIN_OUTPUT_DIR, 'infered_dataset')
 FULL_MASK_DIR = os.path.join(MAIN_OUTPUT_DIR, 'full_mask_dataset')
-META_PATCH_DATASET_PATH = os.path.join(PATCH_MASK_DIR, 'meta.json')
-META_FULL_MASK_PATH  = os.path.join(FULL_MASK_DIR, 'meta.json')
+# every stage records its per-series/per-nodule status in one store instead of meta.json files
+META_STORE_PATH = os.path.join(MAIN_OUTPUT_DIR, 'meta.db')
 XRAY_DIR = os.path.join(MAIN_OUTPUT_DIR, 'xray_dataset')
+# patching and DRR rendering merge their per-series QC columns into one table
+QC_PATH = os.path.join(MAIN_OUTPUT_DIR, 'qc.csv')
+LUNG_DIR = os.path.join(MAIN_OUTPUT_DIR, 'lung_dataset')
 
 paths = [PATCH_MASK_DIR, INFERENCE_DIR, FULL_MASK_DIR, XRAY_DIR, MAIN_OUTPUT_DIR]
 for path in paths:
     os.makedirs(path, exist_ok=True)
 
-extractor = ("python", "dataset_maker.py", "-d", f"{MAIN_DATA_DIR}", "-o", f"{PATCH_MASK_DIR}", "-c", f"{CSV_PATH}")
-infer = ("python", "data_inference_vnet.py", "-i", f"{PATCH_MASK_DIR}", "-o", f"{INFERENCE_DIR}")
-patcher = ("python", "dataset_patcher.py", "-d", f"{MAIN_DATA_DIR}", "-o", f"{FULL_MASK_DIR}", "-r", f"{INFERENCE_DIR}", "-m", f"{META_PATCH_DATASET_PATH}")
-drrer = ("python", "drrer.py", "-d", f"{MAIN_DATA_DIR}", "-m", f"{FULL_MASK_DIR}", "-o", f"{XRAY_DIR}", "--meta", f"{META_FULL_MASK_PATH}")
+extractor = ("python", "dataset_maker.py", "-d", f"{MAIN_DATA_DIR}", "-o", f"{PATCH_MASK_DIR}", "-c", f"{CSV_PATH}", "--store", f"{META_STORE_PATH}")
+infer = ("python", "data_inference_vnet.py", "-i", f"{PATCH_MASK_DIR}", "-o", f"{INFERENCE_DIR}", "-m", f"{META_STORE_PATH}")
+if args.queue:
+    infer += ("-q", f"{args.queue}")
+lung_masker = ("python", "lung_masker.py", "-d", f"{MAIN_DATA_DIR}", "-o", f"{LUNG_DIR}")
+proposer = ("python", "candidate_maker.py", "-d", f"{MAIN_DATA_DIR}", "-o", f"{CSV_PATH}", "--preset", f"{args.candidates}")
+if args.lungs:
+    infer += ("--lungs", os.path.join(LUNG_DIR, 'lungs.json'))
+    proposer += ("--lungs", os.path.join(LUNG_DIR, 'lungs.json'))
+if args.candidates and args.csv:
+    proposer += ("--truth", f"{args.csv}")
+patcher = ("python", "dataset_patcher.py", "-d", f"{MAIN_DATA_DIR}", "-o", f"{FULL_MASK_DIR}", "-r", f"{INFERENCE_DIR}", "-m", f"{META_STORE_PATH}", "--qc", f"{QC_PATH}")
+drrer = ("python", "drrer.py", "-d", f"{MAIN_DATA_DIR}", "-m", f"{FULL_MASK_DIR}", "-o", f"{XRAY_DIR}", "--meta", f"{META_STORE_PATH}", "--qc", f"{QC_PATH}")
+# the per-scan stages share the budget settings, each stage runs alone so it gets the whole budget
+budget = ("--workers", f"{args.workers}") + (("--mem-limit", f"{args.mem_limit}") if args.mem_limit else ())
+extractor += budget
+lung_masker += budget
+proposer += budget
+patcher += budget
+drrer += budget
+
+def run_stage(name, command):
+    print(f"Starting {name}")
+    started = time.perf_counter()
+    process = subprocess.Popen(command)
+    process.wait()
+    print(f"Finished {name} in {time.perf_counter() - started:.1f} s")
 
 print("Starting Pipeline")
-print("Starting Extraction")
-
-process = subprocess.Popen(extractor)
-process.wait()
-
-print("Finished Extraction")
-print("Starting Inference")
-
-process = subprocess.Popen(infer)
-process.wait()  
-
-print("Finished Inference")
-print("Starting Patching")
-
-process = subprocess.Popen(patcher)
-process.wait()
 
-print("Finished Patching")
-print("Starting DRR")
+if args.lungs:
+    run_stage("Lung masking", lung_masker)
+if args.candidates:
+    run_stage("Candidates", proposer)
 
-process = subprocess.Popen(drrer)
-process.wait()  
+run_stage("Extraction", extractor)
+run_stage("Inference", infer)
+run_stage("Patching", patcher)
+run_stage("DRR", drrer)
 
-print("Finished DRR")
-print("Pipeline execution completed.")
\ No newline at end of file
+print("Pipeline execution completed.")
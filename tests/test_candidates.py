@@ -0,0 +1,30 @@
+import os
+
+import pandas as pd
+
+from utils.bench import make_subset
+from utils.candidates import PRESETS, proposal_recall, proposing
+
+
+def test_phantom_nodules_are_the_strongest_candidates(tmp_path, capsys):
+    data_dir, truth_path = make_subset(str(tmp_path), scans=2, size=(128, 128, 40), nodules=3, seed=1)
+    out = os.path.join(tmp_path, "candidates", "candidates.csv")
+    proposing({"data": data_dir, "out": out, "preset": "fast", "truth": truth_path})
+    assert "Recall: 1.000 of 6 annotated nodules" in capsys.readouterr().out
+
+    candidates, truth = pd.read_csv(out), pd.read_csv(truth_path)
+    assert list(candidates.columns) == ["seriesuid", "coordX", "coordY", "coordZ", "diameter_mm", "score"]
+    assert candidates.groupby("seriesuid").size().max() <= PRESETS["fast"]["max_candidates"]
+    # the three nodules of each phantom outscore every noise blob
+    strongest = candidates.sort_values("score", ascending=False).groupby("seriesuid").head(3)
+    assert proposal_recall(strongest, truth) == 1.0
+
+
+def test_recall_counts_hits_within_the_radius():
+    truth = pd.DataFrame([["s0", 0.0, 0.0, 0.0, 20.0], ["s0", 50.0, 0.0, 0.0, 4.0], ["s1", 0.0, 0.0, 0.0, 6.0]],
+                         columns=["seriesuid", "coordX", "coordY", "coordZ", "diameter_mm"])
+    # 9 mm is inside the 10 mm radius, 4.9 mm inside the 5 mm minimum, s1 has no candidates
+    candidates = pd.DataFrame([["s0", 9.0, 0.0, 0.0], ["s0", 50.0, 4.9, 0.0], ["s2", 0.0, 0.0, 0.0]],
+                              columns=["seriesuid", "coordX", "coordY", "coordZ"])
+    assert proposal_recall(candidates, truth) == 2 / 3
+    assert proposal_recall(candidates.iloc[[1]], truth) == 1 / 3
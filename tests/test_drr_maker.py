@@ -0,0 +1,89 @@
+import json
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+from utils import drr_maker
+from utils.bench import make_phantom, reference_generate_drr, reference_raycast
+from utils.drr_manifest import MANIFEST_NAME
+from utils.drr_maker import generate_drr, process_mhd_folder_pair, raycast, raycast_pair, resample_image
+
+
+def phantom():
+    image, _ = make_phantom("test", size=(80, 80, 24), nodules=2, rng=np.random.default_rng(0))
+    return resample_image(image)
+
+
+def test_raycast_matches_the_original_bit_for_bit():
+    image = phantom()
+    drr = raycast(image, device="cpu")
+    assert drr.dtype == np.float64 and drr.min() >= 0 and drr.max() <= 1
+    assert np.array_equal(drr, reference_raycast(image))
+
+
+def test_summed_rays_stay_within_three_grey_levels():
+    image = phantom()
+    reference = np.round(reference_raycast(image) * 255)
+    summed = np.round(raycast(image, device="cpu", method="sum") * 255)
+    assert np.abs(summed - reference).max() <= 3
+    assert np.array_equal(summed, np.round(raycast(image, device="cpu", method="sum") * 255))
+
+
+def test_pair_projects_the_ct_like_raycast():
+    image = phantom()
+    mask = sitk.Cast(image > 0, sitk.sitkUInt8)
+    drr, label = raycast_pair(image, mask, device="cpu")
+    assert np.array_equal(drr, np.round(reference_raycast(image) * 255).astype(np.uint8))
+    assert set(np.unique(label)) == {0, 255}
+
+
+def test_max_projection_matches_the_original():
+    array = sitk.GetArrayFromImage(phantom())
+    assert np.array_equal(generate_drr(array, 1), reference_generate_drr(array, 1))
+
+
+def test_pair_samples_ct_and_mask_together(monkeypatch):
+    image = phantom()
+    mask = sitk.Cast(image > 0, sitk.sitkUInt8)
+    drr, label = raycast_pair(image, mask, device="cpu")
+
+    calls = []
+    grid_sample = drr_maker.F.grid_sample
+    monkeypatch.setattr(drr_maker.F, "grid_sample", lambda *args, **kwargs: calls.append(args[0].shape[1]) or grid_sample(*args, **kwargs))
+    assert np.array_equal(drr_maker.project_ct(image, device="cpu"), drr)
+    ct_calls = len(calls)
+    assert np.array_equal(drr_maker.project_mask(mask, device="cpu"), label)
+    calls.clear()
+    raycast_pair(image, mask, device="cpu")
+    assert len(calls) == ct_calls and all(channels % 2 == 0 for channels in calls)
+
+
+def test_pair_rerenders_entries_without_coco_data(tmp_path, capsys):
+    image, rows = make_phantom("s0", size=(80, 80, 24), nodules=1, rng=np.random.default_rng(0))
+    for folder, volume in (("data", image), ("masks", sitk.Cast(image > 0, sitk.sitkInt16))):
+        os.makedirs(tmp_path / folder)
+        sitk.WriteImage(volume, str(tmp_path / folder / ("s0.mhd" if folder == "data" else "s0.mhd.mhd")))
+    meta = str(tmp_path / "meta.json")
+    with open(meta, "w") as f:
+        json.dump({"s0_0": {"world_coord": rows[0][1:4], "diameter_mm": rows[0][4]}}, f)
+    out = tmp_path / "drr"
+
+    def render():
+        process_mhd_folder_pair(str(tmp_path / "data"), str(tmp_path / "masks"), str(out), meta, patch_meta_path=meta)
+        with open(out / "annotations.json") as f:
+            return json.load(f)
+
+    coco = render()
+    assert len(coco["images"]) == 1 and len(coco["annotations"]) == 1
+    capsys.readouterr()
+    assert render() == coco and "Up to date: s0.mhd" in capsys.readouterr().out
+
+    # a manifest written before the COCO entries were stored
+    with open(out / MANIFEST_NAME) as f:
+        saved = json.load(f)
+    saved["outputs"]["full_ct_xray/s0"]["image"] = None
+    del saved["outputs"]["full_ct_xray/s0"]["annotations"]
+    with open(out / MANIFEST_NAME, "w") as f:
+        json.dump(saved, f)
+    assert render() == coco and "Processing: s0.mhd\n" in capsys.readouterr().out
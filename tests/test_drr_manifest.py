@@ -0,0 +1,60 @@
+import json
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+from utils import drr_maker
+from utils.drr_manifest import DRRManifest, MANIFEST_NAME
+from utils.drr_writer import DRRWriter
+
+
+def write_scan(tmp_path, value=0):
+    path = os.path.join(tmp_path, "scan.mhd")
+    sitk.WriteImage(sitk.GetImageFromArray(np.full((4, 4, 4), value, dtype=np.int16)), path)
+    return path
+
+
+def rendered(tmp_path, params):
+    """A manifest that has rendered scan.mhd with params and saved it."""
+    output = os.path.join(tmp_path, "scan.png")
+    open(output, "w").close()
+    manifest = DRRManifest(tmp_path)
+    inputs = manifest.fingerprint(write_scan(tmp_path))
+    manifest.record("full_ct_xray/scan", inputs, params)
+    manifest.save()
+    return inputs, output
+
+
+def test_changed_settings_invalidate_an_entry(tmp_path, monkeypatch):
+    params = drr_maker.render_params("raycast", DRRWriter(), precision="float32", method="slices", lungs=None)
+    inputs, output = rendered(tmp_path, params)
+
+    manifest = DRRManifest(tmp_path)
+    assert manifest.is_current("full_ct_xray/scan", inputs, params, [output])
+    changed = [
+        drr_maker.render_params("raycast", DRRWriter("png", bit_depth=16), precision="float32", method="slices", lungs=None),
+        drr_maker.render_params("raycast", DRRWriter("webp"), precision="float32", method="slices", lungs=None),
+        drr_maker.render_params("raycast", DRRWriter(), precision="float32", method="sum", lungs=None),
+    ]
+    monkeypatch.setattr(drr_maker, "RAYCAST_CLAHE", (3.0, (16, 16)))
+    changed.append(drr_maker.render_params("raycast", DRRWriter(), precision="float32", method="slices", lungs=None))
+    for params in changed:
+        assert not manifest.is_current("full_ct_xray/scan", inputs, params, [output])
+
+
+def test_changed_inputs_missing_outputs_and_old_versions_are_stale(tmp_path):
+    params = drr_maker.render_params("max", DRRWriter(), lungs=None)
+    inputs, output = rendered(tmp_path, params)
+
+    manifest = DRRManifest(tmp_path)
+    assert not manifest.is_current("full_ct_xray/scan", manifest.fingerprint(write_scan(tmp_path, 1)), params, [output])
+    assert not manifest.is_current("full_ct_xray/scan", inputs, params, [output + ".missing"])
+    assert not DRRManifest(tmp_path, force=True).is_current("full_ct_xray/scan", inputs, params, [output])
+
+    with open(os.path.join(tmp_path, MANIFEST_NAME)) as f:
+        saved = json.load(f)
+    saved["version"] -= 1
+    with open(os.path.join(tmp_path, MANIFEST_NAME), "w") as f:
+        json.dump(saved, f)
+    assert not DRRManifest(tmp_path).is_current("full_ct_xray/scan", inputs, params, [output])
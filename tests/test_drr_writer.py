@@ -0,0 +1,48 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from utils.drr_writer import DRRWriter, to_grayscale
+
+
+def drr():
+    return np.random.default_rng(0).random((64, 48))
+
+
+def test_grayscale_conversion():
+    image = drr()
+    eight, sixteen = to_grayscale(image), to_grayscale(image, 16)
+    assert eight.dtype == np.uint8 and sixteen.dtype == np.uint16
+    assert np.array_equal(eight, np.round(image * 255)) and np.array_equal(sixteen, np.round(image * 65535))
+    assert np.array_equal(to_grayscale(eight, 16), eight.astype(np.uint16) * 257)
+    assert np.array_equal(to_grayscale(eight.astype(np.uint16) * 257), eight)
+    assert np.array_equal(to_grayscale(image > 0.5), (image > 0.5) * 255)
+
+
+@pytest.mark.parametrize("fmt,bit_depth", [("png", 8), ("png", 16), ("webp", 8), ("webp", 16), ("raw", 8), ("raw", 16)])
+def test_formats_decode_losslessly(tmp_path, fmt, bit_depth):
+    image = drr()
+    with DRRWriter(fmt, bit_depth=bit_depth, workers=2) as writer:
+        writer.submit(image, os.path.join(tmp_path, "s0.png"))
+    path = os.path.join(tmp_path, f"s0.{fmt}")
+    assert os.listdir(tmp_path) == [f"s0.{fmt}"]
+
+    # WebP is always 8 bit
+    expected = to_grayscale(image, writer.bit_depth)
+    assert writer.bit_depth == (8 if fmt == "webp" else bit_depth)
+    if fmt == "raw":
+        decoded = np.fromfile(path, dtype=expected.dtype).reshape(image.shape)
+    else:
+        # WebP decodes to three equal channels
+        decoded = cv2.imread(path, cv2.IMREAD_GRAYSCALE if fmt == "webp" else cv2.IMREAD_UNCHANGED)
+    assert decoded.dtype == expected.dtype and np.array_equal(decoded, expected)
+
+
+def test_settings_reject_unknown_formats():
+    assert DRRWriter("png", compression=9).settings() != DRRWriter("png").settings()
+    with pytest.raises(ValueError):
+        DRRWriter("jpg")
+    with pytest.raises(ValueError):
+        DRRWriter("png", bit_depth=12)
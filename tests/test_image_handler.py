@@ -0,0 +1,88 @@
+import numpy as np
+import SimpleITK as sitk
+
+from utils.image_handler import extract_cube_from_image, extract_cubes, paste_cube, resample_cube, series_affine
+
+
+def scan(size=(40, 30, 20)):
+    array = np.arange(np.prod(size), dtype=np.int32).reshape(size[::-1]).astype(np.int16)
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing((0.7, 0.8, 2.5))
+    image.SetOrigin((-12.0, 30.0, -100.0))
+    image.SetDirection((-1, 0, 0, 0, -1, 0, 0, 0, 1))
+    return image
+
+
+def nodule_coords(image, count=40, seed=0):
+    """World points all over the scan, borders and just outside included."""
+    rng = np.random.default_rng(seed)
+    index = rng.uniform(-3, np.array(image.GetSize()) + 2, (count, 3))
+    return [image.TransformContinuousIndexToPhysicalPoint(point.tolist()) for point in index]
+
+
+def test_extract_cubes_matches_the_per_cube_loop():
+    image = scan()
+    coords = nodule_coords(image)
+    cubes, (start_index, extract_size, pad_before, pad_after) = extract_cubes(image, coords, (12, 10, 6))
+    assert not pad_before.any() and not pad_after.any()
+    for coord, cube, start, size in zip(coords, cubes, start_index, extract_size):
+        expected, expected_start, expected_size = extract_cube_from_image(image, coord, (12, 10, 6))
+        assert list(start) == expected_start and list(size) == expected_size
+        assert np.array_equal(sitk.GetArrayViewFromImage(cube), sitk.GetArrayViewFromImage(expected))
+        assert np.allclose(cube.GetOrigin(), expected.GetOrigin()) and cube.GetDirection() == expected.GetDirection()
+
+
+def test_padded_cubes_stay_centred():
+    image = scan()
+    coords = nodule_coords(image, seed=1)
+    cubes, (start_index, extract_size, pad_before, pad_after) = extract_cubes(image, coords, (12, 10, 6), pad=True, pad_value=-1024)
+    array = sitk.GetArrayViewFromImage(image)
+    for coord, cube, start, size, before in zip(coords, cubes, start_index, extract_size, pad_before):
+        assert cube.GetSize() == (12, 10, 6)
+        # the centre voxel is the nodule's voxel (or padding when it lies outside the scan)
+        centre = image.TransformPhysicalPointToIndex(coord)
+        assert cube.TransformPhysicalPointToIndex(coord) == (6, 5, 3)
+        inside = all(0 <= i < n for i, n in zip(centre, image.GetSize()))
+        assert cube[6, 5, 3] == (array[centre[2], centre[1], centre[0]] if inside else -1024)
+        region = sitk.GetArrayViewFromImage(cube)[before[2]:before[2] + size[2], before[1]:before[1] + size[1], before[0]:before[0] + size[0]]
+        assert np.array_equal(region, array[start[2]:start[2] + size[2], start[1]:start[1] + size[1], start[0]:start[0] + size[0]])
+        assert (sitk.GetArrayViewFromImage(cube) == -1024).sum() == 12 * 10 * 6 - np.prod(size)
+
+
+
+def test_padded_cubes_paste_back_in_place():
+    image = scan()
+    coords = nodule_coords(image, seed=2)
+    cubes, (start_index, extract_size, pad_before, _) = extract_cubes(image, coords, (12, 10, 6), pad=True)
+    array = sitk.GetArrayFromImage(image)
+    for cube, start, size, before in zip(cubes, start_index, extract_size, pad_before):
+        pasted = np.zeros_like(array)
+        paste_cube(pasted, image, cube, start, extract_size=size, pad_before=before)
+        region = tuple(slice(start[axis], start[axis] + size[axis]) for axis in (2, 1, 0))
+        assert np.array_equal(pasted[region], array[region]) and pasted.sum() == array[region].sum()
+
+
+def test_resampled_cubes_map_back_onto_the_scan():
+    image = scan((60, 50, 24))
+    centre = image.TransformContinuousIndexToPhysicalPoint((31.3, 22.6, 11.2))
+    # a 12 mm ball, the "prediction" is the ball on the isotropic cube grid
+    points = sitk.GetArrayFromImage(sitk.PhysicalPointSource(sitk.sitkVectorFloat64, image.GetSize(), image.GetOrigin(),
+                                                             image.GetSpacing(), image.GetDirection()))
+    ball = (np.linalg.norm(points - centre, axis=-1) < 6).astype(np.uint8)
+    ball_image = sitk.GetImageFromArray(ball.astype(np.float32))
+    ball_image.CopyInformation(image)
+
+    cube, start_index, extract_size, transform = resample_cube(ball_image, centre, (24, 24, 24), 1.0, series_affine(image))
+    assert cube.GetSize() == (24, 24, 24) and cube.GetSpacing() == (1.0, 1.0, 1.0)
+    assert np.allclose(cube.TransformContinuousIndexToPhysicalPoint((11.5, 11.5, 11.5)), centre)
+    # the covering source region holds the whole cube
+    for corner in ((0, 0, 0), (23, 23, 23)):
+        index = np.array(image.TransformPhysicalPointToContinuousIndex(cube.TransformIndexToPhysicalPoint(corner)))
+        assert (index >= start_index).all() and (index <= np.add(start_index, extract_size) - 1).all()
+
+    prediction = sitk.Cast(cube > 0.5, sitk.sitkUInt8)
+    pasted = np.zeros_like(ball)
+    paste_cube(pasted, image, prediction, start_index, transform, extract_size)
+    overlap = np.logical_and(pasted, ball).sum()
+    assert 2 * overlap / (pasted.sum() + ball.sum()) > 0.9
+    assert not pasted[:start_index[2]].any() and set(np.unique(pasted)) == {0, 1}
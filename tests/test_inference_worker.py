@@ -0,0 +1,40 @@
+import os
+import threading
+import time
+
+from utils.inference_worker import claim, queue_paths, recover, submit
+from utils.json_io import write_json_atomic
+
+TIME = time.time
+
+
+def answer_once(queue_dir, delay):
+    """A worker that claims the first request after delay seconds and answers it."""
+    requests_dir, working_dir, responses_dir = queue_paths(queue_dir)
+    time.sleep(delay)
+    deadline = time.perf_counter() + 5
+    while (working_path := claim(requests_dir, working_dir)) is None:
+        if time.perf_counter() > deadline:
+            return  # the client gave up
+        time.sleep(0.05)
+    write_json_atomic(os.path.join(responses_dir, os.path.basename(working_path)), {"status": "ok", "count": 1})
+    os.remove(working_path)
+
+
+def test_pickup_and_stale_detection_ignore_the_local_clock(tmp_path, monkeypatch):
+    queue_dir = str(tmp_path / "queue")
+    _, working_dir, _ = queue_paths(queue_dir)
+
+    # the client's clock runs an hour ahead of the file server: the fresh request is not "an hour old"
+    monkeypatch.setattr(time, "time", lambda: TIME() + 3600)
+    worker = threading.Thread(target=answer_once, args=(queue_dir, 0.3))
+    worker.start()
+    assert submit(queue_dir, "file", "in.mhd", "out.mhd", pickup_timeout=2, poll_interval=0.05)["status"] == "ok"
+    worker.join()
+
+    # a worker clock an hour behind still sees a crashed worker's request as stale
+    monkeypatch.setattr(time, "time", lambda: TIME() - 3600)
+    left = os.path.join(working_dir, "crashed.json")
+    write_json_atomic(left, {"id": "crashed"})
+    os.utime(left, (TIME() - 120, TIME() - 120))
+    assert recover(queue_dir, stale_after=60) == 1
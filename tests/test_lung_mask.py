@@ -0,0 +1,44 @@
+import json
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+from utils.lung_mask import LungIndex, lung_entry
+
+
+def full_resolution(grid, shrink, size):
+    """Occupancy of every voxel, the partial block BinShrink drops belongs to the last cell."""
+    index = [np.minimum(np.arange(size[axis]) // shrink[axis], grid.shape[2 - axis] - 1) for axis in range(3)]
+    return grid[np.ix_(index[2], index[1], index[0])]
+
+
+def test_overlaps_matches_the_voxel_occupancy(tmp_path):
+    image = sitk.Image((42, 38, 21), sitk.sitkInt16)
+    image.SetSpacing((1.0, 1.0, 2.0))
+    shrink = [4, 4, 2]
+    rng = np.random.default_rng(0)
+    lungs = np.zeros((10, 9, 10), dtype=bool)
+    lungs[2:5, 3:6, 4:9] = True
+    lungs[9, 8, 9] = True  # the last cell, which also holds the dropped partial block
+    entries = {"s0": lung_entry(image, lungs, shrink, margin_mm=0.0),
+               "empty": lung_entry(image, np.zeros_like(lungs), shrink)}
+    with open(os.path.join(tmp_path, "lungs.json"), "w") as f:
+        json.dump(entries, f)
+    index = LungIndex(os.path.join(tmp_path, "lungs.json"))
+
+    voxels = full_resolution(lungs, shrink, image.GetSize())
+    assert index.box("s0") == ([16, 12, 4], [26, 26, 17])
+    for _ in range(500):
+        start = rng.integers(-5, np.array(image.GetSize()) + 2)
+        size = rng.integers(1, 12, 3)
+        low, high = np.maximum(start, 0), np.minimum(start + size, image.GetSize())
+        if (high <= low).any():
+            continue  # extraction boxes always intersect the scan
+        expected = bool(voxels[low[2]:high[2], low[1]:high[1], low[0]:high[0]].any())
+        assert index.overlaps("s0", start, size) == expected, (start, size)
+
+    # series without lungs or missing from lungs.json are all lung
+    assert index.box("empty") is None and index.overlaps("empty", [0, 0, 0], [1, 1, 1])
+    assert index.overlaps("unknown", [0, 0, 0], [1, 1, 1])
+    assert LungIndex.from_entries(entries).overlaps("s0", [40, 36, 20], [5, 5, 5])
@@ -0,0 +1,33 @@
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+from utils.memory_budget import STAGE_FACTORS, estimate_footprint
+
+
+def write_scan(tmp_path, dtype, spacing=(2.0, 2.0, 2.0)):
+    image = sitk.GetImageFromArray(np.zeros((10, 20, 30), dtype=dtype))
+    image.SetSpacing(spacing)
+    path = os.path.join(tmp_path, f"{np.dtype(dtype).name}.mhd")
+    sitk.WriteImage(image, path)
+    return path
+
+
+def test_drr_footprints_scale_with_the_itemsize(tmp_path):
+    int16, float32 = write_scan(tmp_path, np.int16), write_scan(tmp_path, np.float32)
+    resampled = 30 * 20 * 10 * 8
+
+    # resampled int16 scan + float32 (float16 with --ray-sum) volume
+    assert estimate_footprint(int16, "raycast") == int(resampled * (2 + 4) * STAGE_FACTORS["raycast"])
+    assert estimate_footprint(int16, "raycast", working_itemsize=2) == int(resampled * (2 + 2) * STAGE_FACTORS["raycast"])
+    # resampled mask + its array, both in the mask's dtype
+    assert estimate_footprint(float32, "max") == 2 * estimate_footprint(int16, "max")
+    assert estimate_footprint(int16, "max") == int(resampled * (2 + 2) * STAGE_FACTORS["max"])
+
+
+def test_the_original_bounds_the_peak_of_fine_scans(tmp_path):
+    # at 0.5 mm the original is larger than the 1 mm working copy it is freed before
+    fine = write_scan(tmp_path, np.int16, spacing=(0.5, 0.5, 0.5))
+    voxels = 30 * 20 * 10
+    assert estimate_footprint(fine, "raycast") == int((voxels / 8 * 2 + voxels * 2) * STAGE_FACTORS["raycast"])
@@ -0,0 +1,62 @@
+import os
+import sqlite3
+import threading
+
+import pytest
+
+from utils.meta_store import MetaStore, open_store, read_empty_series, read_patch_meta
+
+
+def test_rerun_with_fewer_nodules_supersedes_the_rest(tmp_path):
+    store = MetaStore(os.path.join(tmp_path, "meta.db"))
+    store.append("extract", [("s0", index, "done", {"start_index": [index, 0, 0]}) for index in range(3)])
+    store.append("extract", [("s1", 0, "done", {"start_index": [0, 0, 0]})])
+
+    # the second run of s0 only produces nodule 0
+    store.append("extract", [("s0", 0, "done", {"start_index": [5, 0, 0]})])
+    assert store.supersede("extract", "s0", 1) == 2
+    assert store.supersede("extract", "s0", 1) == 0
+
+    meta = store.patch_meta()
+    assert sorted(meta) == ["s0_0", "s1_0"]
+    assert meta["s0_0"]["start_index"] == [5, 0, 0]
+    assert store.summary()["extract"] == {"done": 2, "superseded": 2}
+
+
+def test_read_paths_do_not_create_a_missing_store(tmp_path):
+    path = os.path.join(tmp_path, "mistyped", "meta.db")
+    for read in (read_patch_meta, read_empty_series, lambda path: open_store(path, create=False)):
+        with pytest.raises(FileNotFoundError):
+            read(path)
+    assert not os.path.exists(os.path.dirname(path))
+
+    MetaStore(path).record("patch", "s0", status="empty")
+    assert read_empty_series(path) == {"s0"}
+    with pytest.raises(sqlite3.OperationalError):
+        MetaStore(path, readonly=True).record("patch", "s1", status="empty")
+
+
+def test_supersede_waits_for_a_concurrent_writer(tmp_path):
+    path = os.path.join(tmp_path, "meta.db")
+    store = MetaStore(path)
+    store.append("extract", [("s0", index, "done", None) for index in range(2)])
+
+    locked, release = threading.Event(), threading.Event()
+
+    def late_writer():
+        # another process is mid-way through appending nodule 2 of s0
+        connection = sqlite3.connect(path, timeout=60)
+        connection.execute("BEGIN IMMEDIATE")
+        locked.set()
+        release.wait()
+        connection.execute("INSERT INTO records (stage, seriesuid, nodule, status, payload, created) VALUES ('extract', 's0', 2, 'done', NULL, 0)")
+        connection.commit()
+        connection.close()
+
+    writer = threading.Thread(target=late_writer)
+    writer.start()
+    locked.wait()
+    threading.Timer(0.3, release.set).start()
+    assert store.supersede("extract", "s0", 1) == 2
+    writer.join()
+    assert store.summary()["extract"] == {"done": 1, "superseded": 2}
@@ -0,0 +1,69 @@
+import os
+
+import json
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from utils import patching
+from utils.bench import make_subset
+from utils.meta_store import read_patch_meta
+from utils.patching import extracting_multi, patch_series
+
+
+def test_superseded_masks_are_skipped(tmp_path, capsys):
+    scan = os.path.join(tmp_path, "s0.mhd")
+    sitk.WriteImage(sitk.GetImageFromArray(np.zeros((12, 12, 12), dtype=np.int16)), scan)
+    ref_dir = os.path.join(tmp_path, "infered")
+    os.makedirs(ref_dir)
+    for index in range(2):
+        sitk.WriteImage(sitk.GetImageFromArray(np.ones((4, 4, 4), dtype=np.int16)), os.path.join(ref_dir, f"s0_{index}.mhd"))
+    # the re-run of the extraction only kept nodule 0
+    meta = {"s0_0": {"start_index": [2, 3, 4], "extract_size": [4, 4, 4]}}
+
+    empty = patch_series(scan, ["s0_0.mhd", "s0_1.mhd"], meta, ref_dir, tmp_path)
+    assert not empty
+    assert "s0_1.mhd" in capsys.readouterr().out
+    mask = sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(tmp_path, "s0.mhd.mhd")))
+    assert mask.sum() == 64 and mask[4:8, 3:7, 2:6].all()
+
+    assert patch_series(scan, ["s0_1.mhd"], meta, ref_dir, tmp_path)
+
+
+def test_specs_share_one_read_of_each_scan(tmp_path, monkeypatch):
+    data_dir, csv_path = make_subset(str(tmp_path), scans=2, size=(96, 96, 32), nodules=2, seed=3)
+    reads = []
+    read_image = sitk.ReadImage
+    monkeypatch.setattr(patching.sitk, "ReadImage", lambda path, *args: reads.append(path) or read_image(path, *args))
+    specs = [
+        {"name": "plain", "size": (16, 16, 8)},
+        {"name": "iso", "size": (12, 12, 12), "spacing": 1.0, "diameter_scale": 2.0, "jitter": 2.0, "negatives": 3, "seed": 1},
+    ]
+    out = str(tmp_path / "patches")
+    extracting_multi({"data": data_dir, "csv": csv_path, "out": out, "specs": specs, "export_json": True})
+    assert len(reads) == 2
+
+    truth = pd.read_csv(csv_path)
+    store = str(tmp_path / "meta.db")
+    plain, iso = read_patch_meta(store, "extract/plain"), read_patch_meta(store, "extract/iso")
+    with open(tmp_path / "patches" / "iso" / "meta.json") as f:
+        assert json.load(f) == iso
+    assert len(plain) == 4 and len(iso) == 4 + 2 * 3
+    assert sorted(f[:-4] for f in os.listdir(tmp_path / "patches" / "iso") if f.endswith(".mhd")) == sorted(iso)
+
+    for key, entry in plain.items():
+        assert entry["extract_size"] == [16, 16, 8] and entry["transform"] is None and not entry["negative"]
+    for key, entry in iso.items():
+        cube = sitk.ReadImage(str(tmp_path / "patches" / "iso" / f"{key}.mhd"))
+        assert cube.GetSpacing() == (1.0, 1.0, 1.0) and entry["spec"] == json.loads(json.dumps(specs[1]))
+        nodules = truth[truth["seriesuid"] == key.rsplit("_", 1)[0]][["coordX", "coordY", "coordZ"]].to_numpy()
+        distance = np.linalg.norm(nodules - entry["world_coord"], axis=1).min()
+        if entry["negative"]:
+            assert distance >= 12 * 2.5 / 2 and entry["diameter_mm"] is None  # half the cube at the scan spacing
+        else:
+            # jittered centre, cube grown to twice the diameter
+            assert distance < 1e-3 and np.abs(entry["jitter_mm"]).max() <= 2.0
+            assert cube.GetSize() == (max(12, int(np.ceil(2 * entry["diameter_mm"]))),) * 3
+            centre = np.add(entry["world_coord"], entry["jitter_mm"])
+            assert np.allclose(cube.TransformContinuousIndexToPhysicalPoint([(n - 1) / 2 for n in cube.GetSize()]), centre)
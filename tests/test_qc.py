@@ -0,0 +1,41 @@
+import os
+
+import pandas as pd
+
+from utils.meta_store import report_dir
+from utils.qc import QCTable
+
+
+def test_stages_merge_into_one_table(tmp_path):
+    path = os.path.join(tmp_path, "qc.csv")
+    patch = QCTable(path)
+    patch.add("s0", patches=2, empty_patches=1)
+    patch.add("s1", patches=1, empty_patches=0)
+    patch.save()
+
+    drr = QCTable(path)
+    drr.add("s0", xray_min=3.0, xray_constant=False)
+    drr.add("s2", xray_min=0.0, xray_constant=True)
+    drr.add("s1", mask_pixels=10)
+    drr.add("s1", mask_pixels=12)
+    drr.save()
+
+    table = pd.read_csv(path, index_col="seriesuid")
+    assert list(table.index) == ["s0", "s1", "s2"]
+    assert table.loc["s0", "patches"] == 2 and table.loc["s0", "xray_min"] == 3.0
+    assert table.loc["s1", "empty_patches"] == 0 and table.loc["s1", "mask_pixels"] == 12
+    assert pd.isna(table.loc["s2", "patches"]) and bool(table.loc["s2", "xray_constant"])
+
+    # a re-run overwrites its own columns and keeps the other stage's
+    rerun = QCTable(path)
+    rerun.add("s0", patches=3)
+    rerun.save()
+    table = pd.read_csv(path, index_col="seriesuid")
+    assert table.loc["s0", "patches"] == 3 and table.loc["s0", "xray_min"] == 3.0
+
+
+def test_reports_go_next_to_the_store(tmp_path):
+    store = os.path.join(tmp_path, "run", "meta.db")
+    assert report_dir(store, os.path.join(tmp_path, "elsewhere")) == os.path.join(tmp_path, "run")
+    assert report_dir(os.path.join(tmp_path, "meta.json"), "root") == "root"
+    assert report_dir(None, "root") == "root"
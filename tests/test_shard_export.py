@@ -0,0 +1,49 @@
+import json
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+from utils.shard_export import ShardReader, export_shards
+
+
+def test_samples_round_trip_through_the_shards(tmp_path):
+    folders = {name: tmp_path / name for name in ("patch", "mask", "xray")}
+    for folder in folders.values():
+        os.makedirs(folder)
+    os.makedirs(folders["xray"] / "full_ct_xray")
+    rng = np.random.default_rng(0)
+    meta, patches = {}, {}
+    for key in ("s0_0", "s0_1", "s1_0", "s1_1", "s1_2"):
+        patches[key] = rng.integers(-1000, 400, (6, 6, 6)).astype(np.int16)
+        image = sitk.GetImageFromArray(patches[key])
+        image.SetSpacing((0.7, 0.7, 2.5))
+        sitk.WriteImage(image, str(folders["patch"] / f"{key}.mhd"))
+        meta[key] = {"start_index": [1, 2, 3], "extract_size": [6, 6, 6]}
+    # one nodule without a predicted mask, one series without DRRs
+    for key in ("s0_0", "s1_0", "s1_2"):
+        sitk.WriteImage(sitk.GetImageFromArray((patches[key] > 0).astype(np.int16)), str(folders["mask"] / f"{key}.mhd"))
+    (folders["xray"] / "full_ct_xray" / "s1.png").write_bytes(b"png bytes")
+    with open(tmp_path / "meta.json", "w") as f:
+        json.dump({**meta, "s2_0": meta["s0_0"]}, f)  # s2_0 has no patch on disk
+
+    out = str(tmp_path / "shards")
+    export_shards({**{name: str(folder) for name, folder in folders.items()}, "meta": str(tmp_path / "meta.json"),
+                   "out": out, "shard_size": 2, "workers": 2})
+
+    reader = ShardReader(out)
+    assert len(reader) == 5 and len(reader.index["shards"]) == 3
+    sample = reader["s1_2"]
+    assert np.array_equal(sample["patch.npy"], patches["s1_2"])
+    assert np.array_equal(sample["mask.npy"], patches["s1_2"] > 0) and sample["mask.npy"].dtype == np.uint8
+    assert sample["drr.png"] == b"png bytes" and "drr_mask.png" not in sample
+    assert sample["json"]["seriesuid"] == "s1" and sample["json"]["spacing"] == [0.7, 0.7, 2.5]
+    assert "mask.npy" not in reader["s0_1"] and reader[0]["key"] == "s0_0"
+
+    streamed = list(reader.stream())
+    assert [sample["key"] for sample in streamed] == reader.keys
+    for sample in streamed:
+        expected = reader[sample["key"]]
+        assert sample.keys() == expected.keys()
+        assert np.array_equal(sample["patch.npy"], expected["patch.npy"]) and sample["json"] == expected["json"]
+    assert [sample["key"] for sample in reader.stream(reader.index["shards"][1:2])] == ["s1_0", "s1_1"]
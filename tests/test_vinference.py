@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from utils.vinference import FLIPS, normalize_patch, predict_tta
+
+
+class Positional(nn.Module):
+    """Logits that depend on where a voxel is, so a flipped pass that is not flipped back shows."""
+
+    def __init__(self, shape, scale=1.0):
+        super().__init__()
+        self.ramp = torch.linspace(-1, 1, int(np.prod(shape))).reshape(1, 1, *shape)
+        self.scale = scale
+
+    def forward(self, x):
+        return self.scale * (8 * (x - 0.5) + 4 * self.ramp)
+
+
+def patches(count=3, shape=(6, 7, 8)):
+    rng = np.random.default_rng(0)
+    return [rng.integers(-1000, 400, shape).astype(np.int16) for _ in range(count)]
+
+
+@pytest.mark.parametrize("variants", [1, 2, 4, 8])
+def test_flipped_passes_are_flipped_back(variants):
+    arrays = patches()
+    models = [Positional(arrays[0].shape), Positional(arrays[0].shape, scale=0.5)]
+    flips = FLIPS[:variants]
+
+    expected = np.zeros((len(arrays), *arrays[0].shape))
+    for model in models:
+        for flip in flips:
+            batch = torch.from_numpy(np.stack([normalize_patch(array) for array in arrays]))[:, None]
+            output = model(batch.flip(flip) if flip else batch).sigmoid()
+            expected += (output.flip(flip) if flip else output)[:, 0].numpy()
+    expected = (expected / (len(models) * len(flips)) > 0.5).astype(np.float32)
+
+    masks = predict_tta(models, torch.device("cpu"), arrays, flips)
+    assert masks.shape == expected.shape and np.array_equal(masks, expected)
+
+
+def test_flip_equivariant_models_agree_on_every_variant():
+    arrays = patches()
+    model = lambda x: 8 * (x - 0.5)
+    plain = predict_tta([model], torch.device("cpu"), arrays)
+    assert 0 < plain.mean() < 1
+    for count in (2, 4, 8):
+        assert np.array_equal(predict_tta([model], torch.device("cpu"), arrays, FLIPS[:count]), plain)
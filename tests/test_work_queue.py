@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import multiprocessing
+
+from utils.work_queue import claim, owns, release, try_lock, queue_dirs, Lease, DONE
+
+CONTEXT = multiprocessing.get_context("fork")
+TIME = time.time
+
+
+def make_queue(queue_dir, count):
+    items_dir, _, _ = queue_dirs(queue_dir)
+    for index in range(count):
+        with open(os.path.join(items_dir, f"s{index}.json"), 'w') as f:
+            json.dump({"uid": f"s{index}", "path": f"/data/s{index}.mhd", "subset": "data"}, f)
+
+
+def stale_lock(queue_dir, uid, age=3600):
+    lock_path = os.path.join(queue_dir, "locks", f"{uid}.lock")
+    try_lock(lock_path, "crashed")
+    os.utime(lock_path, (TIME() - age, TIME() - age))
+    return lock_path
+
+
+def claim_once(queue_dir, node_id, barrier, results):
+    barrier.wait()
+    item = claim(queue_dir, node_id, lease_timeout=60)
+    results.put((node_id, item and item["uid"], item and item["token"]))
+
+
+def drain(queue_dir, node_id, results):
+    while True:
+        item = claim(queue_dir, node_id, lease_timeout=60)
+        if item is None:
+            return
+        results.put(item["uid"])
+        with open(os.path.join(queue_dir, DONE, f"{item['uid']}.json"), 'w') as f:
+            json.dump({"node": node_id}, f)
+        release(item["lock"], item["token"])
+
+
+def run_processes(target, args_list):
+    processes = [CONTEXT.Process(target=target, args=args) for args in args_list]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(30)
+        assert process.exitcode == 0
+
+
+def test_expired_lease_has_exactly_one_owner(tmp_path):
+    for trial in range(10):
+        queue_dir = str(tmp_path / f"queue{trial}")
+        make_queue(queue_dir, 1)
+        lock_path = stale_lock(queue_dir, "s0")
+        barrier, results = CONTEXT.Barrier(4), CONTEXT.Queue()
+        run_processes(claim_once, [(queue_dir, f"node{index}", barrier, results) for index in range(4)])
+
+        claims = [results.get(timeout=5) for _ in range(4)]
+        owners = [node for node, uid, token in claims if uid == "s0" and owns(lock_path, token)]
+        assert len(owners) == 1, claims
+
+
+def test_processes_drain_every_item_once(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    make_queue(queue_dir, 40)
+    stale_lock(queue_dir, "s7")
+    results = CONTEXT.Queue()
+    run_processes(drain, [(queue_dir, f"node{index}", results) for index in range(4)])
+
+    processed = []
+    while not results.empty():
+        processed.append(results.get(timeout=5))
+    assert sorted(processed) == sorted(f"s{index}" for index in range(40))
+
+
+def test_taken_over_lock_is_neither_renewed_nor_released(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    make_queue(queue_dir, 1)
+    item = claim(queue_dir, "node0", lease_timeout=0.3)
+    with Lease(item["lock"], item["token"], 0.3) as lease:
+        os.remove(item["lock"])
+        other = try_lock(item["lock"], "node1")
+        time.sleep(0.4)
+    assert lease.lost
+    assert not release(item["lock"], item["token"])
+    assert owns(item["lock"], other)
+
+
+def test_lease_expiry_ignores_the_local_clock(tmp_path, monkeypatch):
+    queue_dir = str(tmp_path / "queue")
+    make_queue(queue_dir, 2)
+    live = claim(queue_dir, "node0", lease_timeout=60)
+    crashed = stale_lock(queue_dir, "s1")
+
+    # this node's clock runs an hour ahead, then an hour behind the file server
+    for skew in (3600, -3600):
+        monkeypatch.setattr(time, "time", lambda skew=skew: TIME() + skew)
+        assert claim(queue_dir, "node1", lease_timeout=60)["uid"] == "s1"
+        assert owns(live["lock"], live["token"])
+        os.remove(crashed)
+        stale_lock(queue_dir, "s1")
@@ -0,0 +1,327 @@
+import os
+import sys
+import json
+import time
+import shutil
+import itertools
+import subprocess
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGE_NAMES = ["extract", "infer", "patch", "drr"]
+
+
+def make_phantom(uid, size=(200, 200, 60), spacing=(0.9, 0.9, 2.5), nodules=2, rng=None):
+    """
+    Synthetic chest CT: air, an elliptic body, two lungs and spherical nodules inside the lungs.
+
+    Args:
+        uid (str): Series uid
+        size (tuple): (x, y, z) size
+        spacing (tuple): (x, y, z) spacing in mm
+        nodules (int): Number of nodules
+        rng (np.random.Generator): Random source
+
+    Returns:
+        (image, rows): int16 SimpleITK image and its annotations.csv rows
+    """
+    rng = rng or np.random.default_rng(0)
+    X, Y, Z = size
+    zz, yy, xx = np.ogrid[:Z, :Y, :X]
+    array = np.full((Z, Y, X), -1000, dtype=np.float32)
+    body = ((yy - Y / 2) / (0.4 * Y)) ** 2 + ((xx - X / 2) / (0.47 * X)) ** 2 < 1
+    array[np.broadcast_to(body, array.shape)] = 40
+    centres = [(0.3 * X, 0.47 * Y), (0.7 * X, 0.47 * Y)]
+    radii = (0.16 * X, 0.27 * Y, 0.4 * Z)
+    for cx, cy in centres:
+        lung = ((yy - cy) / radii[1]) ** 2 + ((xx - cx) / radii[0]) ** 2 + ((zz - Z / 2) / radii[2]) ** 2 < 1
+        array[lung] = -850
+    nodule_centres = []
+    for index in range(nodules):
+        cx, cy = centres[index % 2]
+        centre = [int(cx + rng.uniform(-0.4, 0.4) * radii[0]), int(cy + rng.uniform(-0.4, 0.4) * radii[1]), int(Z / 2 + rng.uniform(-0.4, 0.4) * radii[2])]
+        diameter = float(rng.uniform(5, 15))
+        distance = sum(((grid - c) * s) ** 2 for grid, c, s in zip((xx, yy, zz), centre, spacing))
+        array[distance < (diameter / 2) ** 2] = 30
+        nodule_centres.append((centre, diameter))
+    array += rng.normal(0, 20, array.shape).astype(np.float32)
+
+    image = sitk.GetImageFromArray(array.astype(np.int16))
+    image.SetSpacing(spacing)
+    image.SetOrigin([-s * n / 2 for s, n in zip(spacing, size)])
+    rows = [[uid, *image.TransformIndexToPhysicalPoint(centre), diameter] for centre, diameter in nodule_centres]
+    return image, rows
+
+
+def make_subset(output_dir, scans=4, size=(200, 200, 60), nodules=2, seed=0):
+    """Write scans synthetic phantoms to <output_dir>/data and their <output_dir>/annotations.csv; returns both paths."""
+    data_dir = os.path.join(output_dir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    rows = []
+    for index in range(scans):
+        uid = f"1.2.826.0.1.{seed}.{index}"
+        image, series_rows = make_phantom(uid, size, nodules=nodules, rng=rng)
+        sitk.WriteImage(image, os.path.join(data_dir, f"{uid}.mhd"))
+        rows += series_rows
+    csv_path = os.path.join(output_dir, "annotations.csv")
+    pd.DataFrame(rows, columns=["seriesuid", "coordX", "coordY", "coordZ", "diameter_mm"]).to_csv(csv_path, index=False)
+    return data_dir, csv_path
+
+
+def make_weights(path, seed=0):
+    """Randomly initialised VNet weights, so inference runs at real cost without a trained model."""
+    import torch
+    from utils.vinference import VNet
+    torch.manual_seed(seed)
+    torch.save(VNet(in_channels=1, out_channels=1).state_dict(), path)
+    return path
+
+
+def tree_size(path):
+    """Total size in bytes of the files under path."""
+    total = 0
+    for folder, _, files in os.walk(path):
+        for file in files:
+            total += os.path.getsize(os.path.join(folder, file))
+    return total
+
+
+def stage_commands(stage, shard, csv_path, weights, config):
+    """Command line of one stage for one shard folder (see `shard_folders`), laid out like pipeline.py."""
+    luna = [sys.executable, os.path.join(ROOT, "luna.py"), stage]
+    data, patch, infer, full, xray = (os.path.join(shard, name) for name in
+                                      ("data", "patch_dataset", "infered_dataset", "full_mask_dataset", "xray_dataset"))
+    store = os.path.join(shard, "meta.db") if config["store"] == "db" else None
+    workers = str(config["workers"])
+    if stage == "extract":
+        return luna + ["-d", data, "-o", patch, "-c", csv_path, "--workers", workers] + (["--store", store] if store else ["--export-json"])
+    if stage == "infer":
+        return luna + ["-i", patch, "-o", infer, "-w", weights, "--batch", str(config["batch"])] + (["-m", store] if store else [])
+    if stage == "patch":
+        return luna + ["-d", data, "-o", full, "-r", infer, "-m", store or os.path.join(patch, "meta.json"), "--workers", workers] + ([] if store else ["--export-json"])
+    return luna + ["-d", data, "-m", full, "-o", xray, "--meta", store or os.path.join(full, "meta.json"),
+                   "--workers", workers, "--post-workers", workers if config["workers"] > 1 else "0"]
+
+
+def shard_folders(run_dir, data_dir, shards):
+    """Split the scans round-robin into shard folders of symlinks, one pipeline output tree each."""
+    scans = sorted(file for file in os.listdir(data_dir) if file.endswith(".mhd"))
+    folders = []
+    for index in range(shards):
+        shard = os.path.join(run_dir, f"shard_{index}")
+        os.makedirs(os.path.join(shard, "data"), exist_ok=True)
+        for name in ("patch_dataset", "infered_dataset", "full_mask_dataset", "xray_dataset"):
+            os.makedirs(os.path.join(shard, name), exist_ok=True)
+        for scan in scans[index::shards]:
+            for path in (scan, scan[:-4] + ".raw"):
+                if os.path.exists(os.path.join(data_dir, path)):
+                    os.symlink(os.path.abspath(os.path.join(data_dir, path)), os.path.join(shard, "data", path))
+        folders.append(shard)
+    return folders
+
+
+def run_stage(commands, env, log):
+    """
+    Start one process per command, wait for all of them.
+
+    Returns:
+        (seconds, peak_bytes, ok): wall time, summed peak RSS of the concurrent processes, all exited with 0
+    """
+    started = time.perf_counter()
+    processes = [subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT, cwd=ROOT) for command in commands]
+    peak, ok = 0, True
+    for process in processes:
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        ok &= process.returncode == 0
+        peak += usage.ru_maxrss * 1024  # kilobytes on Linux
+    return time.perf_counter() - started, peak, ok
+
+
+def run_config(config, data_dir, csv_path, weights, run_dir, scans):
+    """
+    Run extract -> infer -> patch -> DRR once for one configuration.
+
+    "threads" runs every stage as one process with config['workers'] threads,
+    "processes" splits the scans into config['workers'] shards and runs one
+    single-threaded process per shard and stage at the same time.
+
+    Returns:
+        Result row: wall time, scans per hour, per-stage seconds, peak RSS and bytes written
+    """
+    shutil.rmtree(run_dir, ignore_errors=True)
+    processes = config["mode"] == "processes"
+    shards = shard_folders(run_dir, data_dir, config["workers"] if processes else 1)
+    stage_config = dict(config, workers=1) if processes else config
+
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES="")
+    if processes:
+        env["OMP_NUM_THREADS"] = str(max(1, (os.cpu_count() or 1) // len(shards)))
+    row = dict(config)
+    peak = 0
+    ok = True
+    # the log lives next to run_dir so it does not count as written bytes
+    with open(f"{run_dir}.log", "w") as log:
+        for stage in STAGE_NAMES:
+            before = tree_size(run_dir)
+            seconds, stage_peak, stage_ok = run_stage([stage_commands(stage, shard, csv_path, weights, stage_config) for shard in shards], env, log)
+            row[f"{stage}_s"] = seconds
+            row[f"{stage}_mb"] = (tree_size(run_dir) - before) / 2 ** 20
+            peak = max(peak, stage_peak)
+            ok &= stage_ok
+    wall = sum(row[f"{stage}_s"] for stage in STAGE_NAMES)
+    row.update({
+        "wall_s": wall,
+        "scans_per_hour": scans / wall * 3600,
+        "peak_rss_mb": peak / 2 ** 20,
+        "written_mb": sum(row[f"{stage}_mb"] for stage in STAGE_NAMES),
+        "ok": ok,
+    })
+    return row
+
+
+def benchmark(data: dict):
+    """
+    Reproducible end-to-end throughput of the pipeline over a configuration matrix.
+
+    A synthetic subset (data['scans'] phantoms of data['size'], data['seed']) and a
+    randomly initialised VNet are generated in data['out'], then every combination
+    of data['modes'], data['workers'], data['batch'] and data['store'] runs the full
+    flow on CPU. The table is printed and written to <out>/bench.csv and bench.json.
+    """
+    print(data)
+    OUTPUT_DIR = data['out']
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    data_dir, csv_path = make_subset(os.path.join(OUTPUT_DIR, "subset"), data['scans'], tuple(data['size']), data.get('nodules', 2), data.get('seed', 0))
+    weights = make_weights(os.path.join(OUTPUT_DIR, "random_vnet.pth"), data.get('seed', 0))
+
+    configs = [dict(zip(("mode", "workers", "batch", "store"), values))
+               for values in itertools.product(data['modes'], data['workers'], data['batch'], data['store'])]
+    rows = []
+    for index, config in enumerate(configs):
+        print(f"[{index + 1}/{len(configs)}] {config}")
+        row = run_config(config, data_dir, csv_path, weights, os.path.join(OUTPUT_DIR, f"run_{index}"), data['scans'])
+        print(f"  {row['wall_s']:.1f} s, {row['scans_per_hour']:.0f} scans/h, peak {row['peak_rss_mb']:.0f} MB" + ("" if row["ok"] else f", FAILED (see run_{index}.log)"))
+        rows.append(row)
+        if row["ok"] and not data.get('keep'):
+            shutil.rmtree(os.path.join(OUTPUT_DIR, f"run_{index}"), ignore_errors=True)
+
+    table = pd.DataFrame(rows)
+    table.to_csv(os.path.join(OUTPUT_DIR, "bench.csv"), index=False)
+    with open(os.path.join(OUTPUT_DIR, "bench.json"), 'w') as f:
+        json.dump({"scans": data['scans'], "size": list(data['size']), "cpus": os.cpu_count(), "rows": rows}, f, indent=1)
+    columns = ["mode", "workers", "batch", "store", "wall_s", "scans_per_hour"] + [f"{stage}_s" for stage in STAGE_NAMES] + ["peak_rss_mb", "written_mb"]
+    print(table[columns].to_string(index=False, float_format=lambda value: f"{value:.1f}"))
+    return table
+
+
+def reference_raycast(image, detector_size=(512, 512), source_to_detector_distance=1300):
+    """
+    The original slice-by-slice raycast (before the in-place and summed-ray rewrites), kept
+    verbatim on CPU as the reference of `utils.drr_maker.raycast`; float DRR in [0, 1].
+    """
+    import cv2
+    import torch
+    import torch.nn.functional as F
+    from utils.drr_maker import build_projection_grid
+    np_image = sitk.GetArrayFromImage(image)
+    np_image = np.clip(np_image, -600, 100)
+    np_image = (np_image - np.min(np_image)) / (np.max(np_image) - np.min(np_image))
+    tensor_image = torch.tensor(np_image, dtype=torch.float32).unsqueeze(0).unsqueeze(0)
+    depth, height, width = np_image.shape
+    grid = build_projection_grid((depth, height, width), detector_size)
+    drr = torch.zeros(detector_size, dtype=torch.float32)
+    for y in range(height):
+        drr += F.grid_sample(tensor_image[:, :, :, y, :], grid, align_corners=True, mode="bilinear").squeeze()
+    drr = drr / height
+    drr = torch.exp(-drr / source_to_detector_distance)
+    drr = (drr - torch.min(drr)) / (torch.max(drr) - torch.min(drr) + 1e-6)
+    drr = (1.0 - drr).numpy()
+    drr = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(16, 16)).apply((drr * 255).astype(np.uint8)) / 255.0
+    return np.flipud(drr)
+
+
+def reference_generate_drr(ct_array, projection_axis=0, output_size=(512, 512)):
+    """The original maximum intensity DRR, the reference of `utils.drr_maker.generate_drr`."""
+    import cv2
+    drr = np.max(ct_array, axis=projection_axis)
+    drr = (drr - np.min(drr)) / (np.max(drr) - np.min(drr))
+    drr = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8)).apply((drr * 255).astype(np.uint8))
+    return np.flipud(cv2.resize(drr, output_size, interpolation=cv2.INTER_AREA))
+
+
+def raycast_variant(image, method, precision):
+    """utils.drr_maker.raycast on CPU with one projection method and volume precision."""
+    from utils.drr_maker import raycast
+    return raycast(image, device="cpu", precision=precision, method=method)
+
+
+def max_variant(image):
+    """utils.drr_maker.generate_drr of a volume projected along y, like render_max_file."""
+    from utils.drr_maker import generate_drr
+    return generate_drr(sitk.GetArrayFromImage(image), 1)
+
+
+RAYCAST_VARIANTS = {
+    "reference": lambda image: reference_raycast(image),
+    "slices": lambda image: raycast_variant(image, "slices", "float32"),
+    "sum_float32": lambda image: raycast_variant(image, "sum", "float32"),
+    "sum_float16": lambda image: raycast_variant(image, "sum", "float16"),
+    "max_reference": lambda image: reference_generate_drr(sitk.GetArrayFromImage(image), 1),
+    "max": lambda image: max_variant(image),
+}
+
+
+def time_variant(name, image_path, repeats):
+    """Run one RAYCAST_VARIANTS entry repeats times in this (fresh) process; returns best seconds, RSS growth and the DRR."""
+    from utils.drr_maker import load_mhd_image, resample_image
+    from utils.memory_budget import RSSSampler
+    image = resample_image(load_mhd_image(image_path))
+    best, growth = float("inf"), 0
+    with RSSSampler(0.01) as sampler:
+        for repeat in range(repeats):
+            sampler.open(repeat)
+            started = time.perf_counter()
+            drr = RAYCAST_VARIANTS[name](image)
+            best = min(best, time.perf_counter() - started)
+            baseline, peak = sampler.close(repeat)
+            growth = max(growth, peak - baseline)
+    return best, growth, np.round(np.asarray(drr, dtype=np.float64) * (255 if drr.dtype != np.uint8 else 1))
+
+
+def benchmark_raycast(data: dict):
+    """
+    Time and memory of the DRR projections against their original implementations.
+
+    One synthetic scan of data['size'] is generated in data['out'], every variant of
+    RAYCAST_VARIANTS runs data.get('repeats', 3) times in its own process (so the RSS
+    growth is not hidden by memory an earlier variant left behind), and the best time,
+    the RSS growth and the largest grey-level difference to its reference are printed
+    and written to <out>/raycast_bench.json.
+    """
+    import multiprocessing
+    print(data)
+    OUTPUT_DIR = data['out']
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    image, _ = make_phantom("raycast", tuple(data['size']), nodules=data.get('nodules', 2), rng=np.random.default_rng(data.get('seed', 0)))
+    image_path = os.path.join(OUTPUT_DIR, "raycast_phantom.mhd")
+    sitk.WriteImage(image, image_path)
+
+    rows, drrs = [], {}
+    context = multiprocessing.get_context("spawn")
+    for name in RAYCAST_VARIANTS:
+        with context.Pool(1) as pool:
+            seconds, growth, drr = pool.apply(time_variant, (name, image_path, data.get('repeats', 3)))
+        drrs[name] = drr
+        reference = drrs["max_reference" if name.startswith("max") else "reference"]
+        rows.append({"variant": name, "seconds": seconds, "rss_growth_mb": growth / 2 ** 20,
+                     "max_diff": int(np.abs(drr - reference).max()), "pixels_diff": int(np.count_nonzero(drr != reference))})
+
+    table = pd.DataFrame(rows)
+    with open(os.path.join(OUTPUT_DIR, "raycast_bench.json"), 'w') as f:
+        json.dump({"size": list(data['size']), "cpus": os.cpu_count(), "rows": rows}, f, indent=1)
+    print(table.to_string(index=False, float_format=lambda value: f"{value:.2f}"))
+    return table
@@ -0,0 +1,203 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+from scipy import ndimage
+
+# recall/throughput presets: coarser grids, fewer scales and fewer candidates are faster
+PRESETS = {
+    "fast": {"spacing": 2.5, "diameters": [5, 10, 20], "threshold": 0.12, "blobness": 0.35, "max_candidates": 30},
+    "balanced": {"spacing": 2.0, "diameters": [4, 6, 9, 13, 20], "threshold": 0.08, "blobness": 0.25, "max_candidates": 100},
+    "sensitive": {"spacing": 1.25, "diameters": [3, 4, 6, 8, 11, 15, 20, 30], "threshold": 0.05, "blobness": 0.1, "max_candidates": 300},
+}
+COLUMNS = ["seriesuid", "coordX", "coordY", "coordZ", "diameter_mm", "score"]
+
+
+def resample_isotropic(image, spacing):
+    """Resample a CT to an isotropic spacing in mm (linear), keeping origin and direction."""
+    size = [max(1, int(round(image.GetSize()[i] * image.GetSpacing()[i] / spacing))) for i in range(3)]
+    return sitk.Resample(image, size, sitk.Transform(), sitk.sitkLinear, image.GetOrigin(),
+                         [spacing] * 3, image.GetDirection(), -1000, sitk.sitkFloat32)
+
+
+def window_image(image, window=(-1000, 200)):
+    """Clamp a CT to the window and scale it to [0, 1], so bone is not brighter than soft tissue."""
+    windowed = sitk.Clamp(image, sitk.sitkFloat32, *window)
+    return (windowed - window[0]) / float(window[1] - window[0])
+
+
+def blob_sigma(diameter):
+    """A bright ball of diameter d responds most at sigma = d / (2 * sqrt(3))."""
+    return diameter / (2 * np.sqrt(3))
+
+
+def blob_response(windowed, diameters):
+    """
+    Scale-normalised Laplacian of Gaussian, maximised over the nodule diameters.
+
+    Returns:
+        (response, scale): float32 (z, y, x) maximum response and the index of its diameter
+    """
+    response = None
+    for index, diameter in enumerate(diameters):
+        sigma = blob_sigma(diameter)
+        log = sitk.GetArrayFromImage(sitk.LaplacianRecursiveGaussian(windowed, sigma))
+        log *= -sigma ** 2
+        if response is None:
+            response, scale = log, np.zeros(log.shape, dtype=np.uint8)
+            continue
+        better = log > response
+        np.copyto(response, log, where=better)
+        scale[better] = index
+    return response, scale
+
+
+def blobness(windowed, indices, scales, diameters):
+    """
+    Ratio of the weakest to the strongest Hessian eigenvalue at each peak, at its own scale.
+
+    Close to 1 for balls, close to 0 for vessels (tubes) and the chest wall (plates);
+    0 when the peak is not a bright maximum in every direction. Only the scales that
+    have peaks are smoothed again and only 3x3x3 neighbourhoods are differentiated.
+    """
+    ratios = np.zeros(len(indices), dtype=np.float32)
+    for index in np.unique(scales):
+        selected = np.flatnonzero(scales == index)
+        smoothed = np.pad(sitk.GetArrayFromImage(sitk.SmoothingRecursiveGaussian(windowed, blob_sigma(diameters[index]))), 1, mode="edge")
+        z, y, x = (indices[selected] + 1).T
+        sample = lambda dz, dy, dx: smoothed[z + dz, y + dy, x + dx]
+        centre = sample(0, 0, 0)
+        hessian = np.empty((len(selected), 3, 3), dtype=np.float32)
+        axes = [(1, 0, 0), (0, 1, 0), (0, 0, 1)]
+        for i, a in enumerate(axes):
+            hessian[:, i, i] = sample(*a) + sample(*(-np.array(a))) - 2 * centre
+            for j in range(i + 1, 3):
+                b = axes[j]
+                plus, minus = np.add(a, b), np.subtract(a, b)
+                hessian[:, i, j] = hessian[:, j, i] = (sample(*plus) + sample(*-plus) - sample(*minus) - sample(*-minus)) / 4
+        eigenvalues = np.linalg.eigvalsh(hessian)  # ascending, all negative for a bright blob
+        ratios[selected] = np.where(eigenvalues[:, 2] < 0, eigenvalues[:, 2] / np.minimum(eigenvalues[:, 0], -1e-12), 0)
+    return ratios
+
+
+def suppress(points, scores, radii, max_candidates):
+    """Greedy non-maximum suppression: keep the strongest blob, drop the ones inside its radius."""
+    order = np.argsort(-scores)
+    kept = []
+    for i in order:
+        if len(kept) >= max_candidates:
+            break
+        if kept:
+            distance = np.linalg.norm(points[kept] - points[i], axis=1)
+            if np.any(distance < np.maximum(radii[kept], radii[i])):
+                continue
+        kept.append(i)
+    return np.array(kept, dtype=int)
+
+
+def propose_series(file_path, spacing=2.0, diameters=(4, 6, 9, 13, 20), threshold=0.08, blobness_ratio=0.25, max_candidates=100, lungs=None, min_hu=-500):
+    """
+    Multi-scale LoG blob proposals of one scan, restricted to the lungs.
+
+    Args:
+        file_path (str): CT scan (.mhd)
+        spacing (float): Isotropic working spacing in mm
+        diameters (list): Nodule diameters in mm, one LoG scale each
+        threshold (float): Minimum normalised response
+        blobness_ratio (float): Minimum weakest/strongest Hessian eigenvalue ratio, 0 keeps vessels and walls
+        max_candidates (int): Candidates kept per scan after suppression
+        lungs (LungIndex): Lung occupancy of the scan, segmented on the fly when None
+        min_hu (int): Minimum HU at the candidate centre
+
+    Returns:
+        DataFrame with the annotations.csv columns plus the blob score
+    """
+    uid = os.path.basename(file_path)[:-4]
+    image = sitk.ReadImage(file_path)
+    small = resample_isotropic(image, spacing)
+    windowed = window_image(small)
+    response, scale = blob_response(windowed, diameters)
+
+    peaks = (response == ndimage.maximum_filter(response, size=3)) & (response > threshold)
+    peaks &= sitk.GetArrayViewFromImage(small) > min_hu
+    indices = np.argwhere(peaks)
+    if lungs is None:
+        from utils.lung_mask import segment_lungs, lung_entry, LungIndex
+        mask, shrink = segment_lungs(image)
+        lungs = LungIndex.from_entries({uid: lung_entry(image, mask, shrink)})
+
+    points = np.array([small.TransformIndexToPhysicalPoint([int(i) for i in index[::-1]]) for index in indices]).reshape(-1, 3)
+    inside = [lungs.overlaps(uid, image.TransformPhysicalPointToIndex(point), (1, 1, 1)) for point in points]
+    indices, points = indices[inside], points[inside]
+    scales = scale[tuple(indices.T)]
+    if blobness_ratio > 0 and len(indices):
+        blobs = blobness(windowed, indices, scales, diameters) >= blobness_ratio
+        indices, points, scales = indices[blobs], points[blobs], scales[blobs]
+
+    scores = response[tuple(indices.T)]
+    sizes = np.array(diameters, dtype=float)[scales]
+    kept = suppress(points, scores, sizes / 2, max_candidates)
+
+    rows = pd.DataFrame({
+        "seriesuid": uid,
+        "coordX": points[kept, 0] if len(kept) else [],
+        "coordY": points[kept, 1] if len(kept) else [],
+        "coordZ": points[kept, 2] if len(kept) else [],
+        "diameter_mm": sizes[kept],
+        "score": scores[kept],
+    }, columns=COLUMNS)
+    print(f"{uid}: {len(rows)} candidates from {int(peaks.sum())} peaks")
+    return rows
+
+
+def proposal_recall(candidates, annotations):
+    """Fraction of annotated nodules with a candidate closer than their radius (at least 5 mm)."""
+    hits = 0
+    for row in annotations.itertuples(index=False):
+        series = candidates[candidates["seriesuid"] == row[0]]
+        if not len(series):
+            continue
+        distance = np.linalg.norm(series[["coordX", "coordY", "coordZ"]].to_numpy() - np.array(row[1:4], dtype=float), axis=1)
+        hits += bool(np.any(distance < max(row[4] / 2, 5.0)))
+    return hits / len(annotations) if len(annotations) else float("nan")
+
+
+def proposing(data: dict):
+    """
+    Writes nodule candidates of every scan to data['out'] in the annotations.csv schema
+    (plus a score column), so extraction, VNet and patching run on unlabeled scans.
+
+    data['preset'] picks spacing, diameters, threshold and max_candidates from PRESETS,
+    explicit keys override it. data['lungs'] restricts to a precomputed lungs.json and
+    data['truth'] (an annotations.csv) reports the recall of the proposals.
+    With data['memory_limit'] (bytes) and data['workers'] scans run in parallel while their estimated footprint fits.
+    """
+    from utils.memory_budget import run_budgeted
+    print(data)
+    DATA_DIR = data['data']
+    OUTPUT_PATH = data['out']
+    settings = dict(PRESETS[data.get('preset') or 'balanced'])
+    settings.update({key: data[key] for key in settings if data.get(key) is not None})
+    settings["blobness_ratio"] = settings.pop("blobness")
+    lungs = None
+    if data.get('lungs'):
+        from utils.lung_mask import LungIndex
+        lungs = LungIndex(data['lungs'])
+
+    files = [os.path.join(DATA_DIR, file) for file in os.listdir(DATA_DIR) if file[-4:] == '.mhd']
+    started = time.perf_counter()
+    results = run_budgeted(
+        lambda path: propose_series(path, lungs=lungs if lungs is not None and os.path.basename(path)[:-4] in lungs.entries else None, **settings),
+        files, "candidates", data.get('memory_limit'), data.get('workers', 1),
+    )
+    seconds = time.perf_counter() - started
+    candidates = pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=COLUMNS)
+    os.makedirs(os.path.dirname(os.path.abspath(OUTPUT_PATH)), exist_ok=True)
+    candidates.to_csv(OUTPUT_PATH, index=False)
+
+    print(f"{len(candidates)} candidates for {len(files)} scans in {seconds:.1f} s ({settings})")
+    if data.get('truth'):
+        truth = pd.read_csv(data['truth'])
+        truth = truth[truth['seriesuid'].isin([os.path.basename(path)[:-4] for path in files])]
+        print(f"Recall: {proposal_recall(candidates, truth):.3f} of {len(truth)} annotated nodules")
@@ -0,0 +1,75 @@
+import argparse
+import importlib
+import time
+
+STAGES = {
+    "extract": "utils.cli_make_handler",
+    "infer": "utils.cli_inference_handler",
+    "patch": "utils.cli_patch_handler",
+    "drr": "utils.cli_drr_handler",
+    "export": "utils.cli_export_handler",
+    "worker": "utils.cli_worker_handler",
+    "queue": "utils.cli_queue_handler",
+    "lungs": "utils.cli_lung_handler",
+    "candidates": "utils.cli_candidate_handler",
+    "meta": "utils.cli_meta_handler",
+    "bench": "utils.cli_bench_handler",
+}
+
+
+def build_parser(handler, prog=None):
+    """Build the argparse parser of one cli_*_handler module."""
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description=handler.DESCRIPTION,
+        epilog=handler.EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        allow_abbrev=False,
+    )
+    handler.add_arguments(parser)
+    return parser
+
+
+def parse(handler, args: list):
+    """Parse a full sys.argv style list (program name first) for one handler."""
+    return build_parser(handler, args[0] if args else None).parse_args(args[1:])
+
+
+def main(args: list, started=None):
+    """
+    Single entry point for every stage: `python luna.py <stage> [options]`.
+
+    Handler modules only import argparse/os at module level, heavy libraries
+    (torch, SimpleITK, cv2, ...) are imported when a stage actually runs, so
+    `-h` and argument errors return immediately.
+    """
+    started = time.perf_counter() if started is None else started
+    parser = argparse.ArgumentParser(
+        prog=args[0] if args else None,
+        description="CT to X-Ray DRR pipeline stages",
+        allow_abbrev=False,
+    )
+    parser.add_argument('--timing', action='store_true', help='Print startup and stage wall time')
+    stages = parser.add_subparsers(dest='stage', required=True, metavar='STAGE')
+    handlers = {}
+    for name, module in STAGES.items():
+        handler = importlib.import_module(module)
+        handlers[name] = handler
+        sub = stages.add_parser(
+            name,
+            help=handler.DESCRIPTION.strip().splitlines()[0],
+            description=handler.DESCRIPTION,
+            epilog=handler.EPILOG,
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            allow_abbrev=False,
+        )
+        handler.add_arguments(sub)
+
+    opts = parser.parse_args(args[1:])
+    if opts.timing:
+        print(f"Startup: {(time.perf_counter() - started) * 1000:.0f} ms")
+    stage_started = time.perf_counter()
+    result = handlers[opts.stage].run(opts)
+    if opts.timing:
+        print(f"Stage {opts.stage}: {time.perf_counter() - stage_started:.2f} s")
+    return result
@@ -0,0 +1,53 @@
+import sys
+from utils import cli
+
+DESCRIPTION = """Pipeline Benchmark
+  This script measures the end-to-end throughput of extract -> infer -> patch -> DRR on CPU.
+  A synthetic subset of body/lung phantoms with spherical nodules and a randomly initialised VNet
+  are generated (reproducible with --seed), then every combination of the configuration matrix
+  (--modes x --workers x --batch x --store) runs the full flow. Wall time, scans/hour, the
+  per-stage breakdown, peak RSS and bytes written are printed and saved to <out>/bench.csv and bench.json.
+"""
+EPILOG = """Example Usage:
+  python bench.py -o /tmp/bench
+  python bench.py -o /tmp/bench --scans 8 --modes threads processes --workers 1 4 --batch 1 4 --store json db
+  python bench.py -o /tmp/bench --raycast --size 360 360 300
+"""
+
+def add_arguments(parser):
+    parser.add_argument('-o', dest='out', required=True, help='Output directory for the synthetic subset, the runs and the results')
+    parser.add_argument('--scans', type=int, default=4, help='Number of synthetic scans (default: 4)')
+    parser.add_argument('--size', type=int, nargs=3, default=[200, 200, 60], metavar=('X', 'Y', 'Z'), help='Size of every scan (default: 200 200 60)')
+    parser.add_argument('--nodules', type=int, default=2, help='Nodules per scan (default: 2)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the scans and of the random VNet weights')
+    parser.add_argument('--modes', nargs='+', default=['threads'], choices=['threads', 'processes'],
+                        help='threads: one process per stage with --workers threads; processes: --workers shards, one process each')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1], help='Parallelism values to sweep (default: 1)')
+    parser.add_argument('--batch', type=int, nargs='+', default=[1], help='Inference batch sizes to sweep (default: 1)')
+    parser.add_argument('--store', nargs='+', default=['db'], choices=['json', 'db'], help='Metadata handoff to sweep: meta.db, or meta.json files exported by every stage and read by the next (default: db)')
+    parser.add_argument('--raycast', action='store_true', help='Instead of the pipeline, compare time, RSS growth and output of the DRR projections with their original implementations on one scan of --size')
+    parser.add_argument('--repeats', type=int, default=3, help='Runs per projection with --raycast, the best time is kept (default: 3)')
+    parser.add_argument('--keep', action='store_true', help='Keep the outputs of every run (default: only failed runs are kept)')
+
+def run(opts):
+    from utils.bench import benchmark, benchmark_raycast
+    if opts.raycast:
+        benchmark_raycast({"out": opts.out, "size": opts.size, "nodules": opts.nodules, "seed": opts.seed, "repeats": opts.repeats})
+        return
+    data = {
+        "out": opts.out,
+        "scans": opts.scans,
+        "size": opts.size,
+        "nodules": opts.nodules,
+        "seed": opts.seed,
+        "modes": opts.modes,
+        "workers": opts.workers,
+        "batch": opts.batch,
+        "store": opts.store,
+        "keep": opts.keep,
+    }
+    benchmark(data)
+    
+
+def main(args: list):
+    run(cli.parse(sys.modules[__name__], args))
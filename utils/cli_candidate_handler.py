@@ -0,0 +1,55 @@
+import sys
+from utils import cli
+
+DESCRIPTION = """Nodule Candidate Proposer
+  This script proposes nodule candidates in unlabeled chest CT scans with a multi-scale LoG blob detector on CPU.
+  Candidates are written in the annotations.csv schema (seriesuid, coordX, coordY, coordZ, diameter_mm, plus a score),
+  so the extract -> VNet -> patch flow can run on them instead of annotations.
+"""
+EPILOG = """Example Usage:
+  python candidate_maker.py -d /path/to/ct_scans -o /path/to/candidates.csv
+  python candidate_maker.py -d /path/to/ct_scans -o /path/to/candidates.csv --preset sensitive --truth annotations.csv
+  python dataset_maker.py -d /path/to/ct_scans -o /path/to/output -c /path/to/candidates.csv
+
+Presets (recall vs throughput):
+  fast       2.5 mm grid, 3 scales,  30 candidates per scan
+  balanced   2.0 mm grid, 5 scales, 100 candidates per scan
+  sensitive  1.25 mm grid, 8 scales, 300 candidates per scan
+"""
+
+def add_arguments(parser):
+    parser.add_argument('-d', dest='data', required=True, help='Path to the directory containing full chest CT scans (.mhd)')
+    parser.add_argument('-o', dest='out', required=True, help='Output CSV of candidates')
+    parser.add_argument('--preset', default='balanced', choices=['fast', 'balanced', 'sensitive'], help='Recall/throughput preset')
+    parser.add_argument('--spacing', type=float, help='Isotropic working spacing in mm (overrides the preset)')
+    parser.add_argument('--diameters', type=float, nargs='+', help='Nodule diameters in mm, one LoG scale each (overrides the preset)')
+    parser.add_argument('--threshold', type=float, help='Minimum blob response (overrides the preset)')
+    parser.add_argument('--blobness', type=float, help='Minimum Hessian eigenvalue ratio, 0 keeps vessels and walls (overrides the preset)')
+    parser.add_argument('--max', dest='max_candidates', type=int, help='Maximum candidates per scan (overrides the preset)')
+    parser.add_argument('--lungs', help='lungs.json of the lungs stage, otherwise the lungs are segmented on the fly')
+    parser.add_argument('--truth', help='annotations.csv to report the recall of the candidates')
+    parser.add_argument('--mem-limit', help='RAM budget such as 16G; scans are only started while their estimated footprint fits')
+    parser.add_argument('--workers', type=int, default=1, help='Maximum number of scans processed in parallel')
+
+def run(opts):
+    from utils.candidates import proposing
+    from utils.memory_budget import parse_size
+    data = {
+        "data": opts.data,
+        "out": opts.out,
+        "preset": opts.preset,
+        "spacing": opts.spacing,
+        "diameters": opts.diameters,
+        "threshold": opts.threshold,
+        "blobness": opts.blobness,
+        "max_candidates": opts.max_candidates,
+        "lungs": opts.lungs,
+        "truth": opts.truth,
+        "memory_limit": parse_size(opts.mem_limit) if opts.mem_limit else None,
+        "workers": opts.workers
+    }
+    proposing(data)
+    
+
+def main(args: list):
+    run(cli.parse(sys.modules[__name__], args))
@@ -1,73 +1,58 @@
 import os
-from utils.drr_maker import *
+import sys
+from utils import cli
 
-mandate = ['-d', '-o', '-m', '--meta']
-DATA_DIR = ""
-OUTPUT_DIR = ""
-MASK_DIR = ""
-META_PATH = ""
-
-def check_args(args: list):
-    for arg in mandate:
-        if not arg in args:
-            raise ValueError(f"{arg} is a mandatory keyword, use -h for help")
-
-def print_help():
-    help_message = """
-\033[1;36m
-DRR Maker - Help
-\033[0m
-Usage:
-  python drr_maker.py -d <data_directory> -m <mask_directory> -o <output_directory>
-
-\033[1;33mOptions:\033[0m
-  \033[1;32m-d\033[0m    Path to the directory containing full chest CT scans (.mhd)  \033[1;30m[Required]\033[0m
-  \033[1;32m-m\033[0m    Path to the directory containing corresponding masks (.mhd)  \033[1;30m[Required]\033[0m
-  \033[1;32m-o\033[0m    Output directory to store generated DRRs                 \033[1;30m[Required]\033[0m
-
-\033[1;33mExample Usage:\033[0m
-  \033[1;34mpython drr_maker.py -d /path/to/ct_scans -m /path/to/masks -o /path/to/output\033[0m
-
-\033[1;35mDescription:\033[0m
+DESCRIPTION = """DRR Maker
   This script generates Digitally Reconstructed Radiographs (DRRs) from chest CT scans.
   It requires both the CT scan directory and the corresponding mask directory.
-    """
-    print(help_message)
-
-
-def check_help(args: list):
-    if '-h' in args:
-        print_help()
-        return False
-    return True
-
-
-def checks(args: list):
-    if not check_help(args):
-        exit(0)
-    check_args(args)
-
-def set_vars(args: list):
-    global DATA_DIR
-    global OUTPUT_DIR
-    global MASK_DIR
-    global META_PATH
-    DATA_DIR = args[args.index('-d')+1]
-    OUTPUT_DIR = args[args.index('-o')+1]
-    MASK_DIR = args[args.index('-m')+1]
-    META_PATH = args[args.index('--meta')+1]
-
-def start_patch():
-    # data = {
-    #     "data":DATA_DIR,
-    #     "mask":MASK_DIR,
-    #     "out": OUTPUT_DIR,
-    # }
-    process_mhd_folder_raycast(DATA_DIR, os.path.join(OUTPUT_DIR, "full_ct_xray"), META_PATH)
-    process_mhd_folder_max(MASK_DIR, os.path.join(OUTPUT_DIR, "full_ct_mask"), META_PATH)
+"""
+EPILOG = """Example Usage:
+  python drrer.py -d /path/to/ct_scans -m /path/to/masks -o /path/to/output --meta /path/to/masks/meta.json
+"""
+
+def add_arguments(parser):
+    parser.add_argument('-d', dest='data', required=True, help='Path to the directory containing full chest CT scans (.mhd)')
+    parser.add_argument('-m', dest='mask', required=True, help='Path to the directory containing corresponding masks (.mhd)')
+    parser.add_argument('-o', dest='out', required=True, help='Output directory to store generated DRRs')
+    parser.add_argument('--meta', required=True, help='Path to the meta.json of the full mask dataset, or the meta.db of the run (renders are recorded there)')
+    parser.add_argument('--paired', action='store_true', help='Project CT and mask through one shared geometry (pixel-aligned)')
+    parser.add_argument('--patch-meta', help='Extraction meta.json (or meta.db), emits COCO/YOLO nodule boxes (with --paired)')
+    parser.add_argument('--crop', type=int, help='Size of nodule-centred ROI crops to save (with --patch-meta)')
+    parser.add_argument('--format', default='png', choices=['png', 'webp', 'raw'], help='Output format, webp is lossless')
+    parser.add_argument('--compression', type=int, default=3, help='PNG compression level 0-9')
+    parser.add_argument('--bits', type=int, default=8, choices=[8, 16], help='Output bit depth (png/raw)')
+    parser.add_argument('--encode-workers', type=int, default=0, help='Number of background encoding threads')
+    parser.add_argument('--post-workers', type=int, default=0, help='Threads for CLAHE/resize/flip, overlapping with projecting the next scan (default: 0, inline)')
+    parser.add_argument('--post-batch', type=int, default=4, help='Projections per post-processing task')
+    parser.add_argument('--ray-sum', action='store_true', help='Sum the rays before sampling: faster and lighter, within 3 grey levels of the default slice-by-slice DRRs')
+    parser.add_argument('--precision', default='float32', choices=['float32', 'float16'], help='Storage precision of the CT volume while raycasting (with --ray-sum, rays are summed in float32)')
+    parser.add_argument('--mem-limit', help='RAM budget such as 16G; scans are only started while their estimated footprint fits')
+    parser.add_argument('--workers', type=int, default=1, help='Maximum number of scans processed in parallel')
+    parser.add_argument('--lungs', help='lungs.json of the lungs stage, crops every DRR to the lung box (x/z)')
+    parser.add_argument('--qc', help='QC table to merge the DRR intensity statistics into (default: qc.csv next to the meta.db, else <out>/qc.csv)')
+    parser.add_argument('--force', action='store_true', help='Re-render every DRR, ignoring drr_manifest.json')
+
+def run(opts):
+    from utils.drr_maker import process_mhd_folder_raycast, process_mhd_folder_max, process_mhd_folder_pair
+    from utils.drr_writer import DRRWriter
+    from utils.drr_postprocess import DRRPostProcessor
+    from utils.memory_budget import parse_size
+    from utils.meta_store import report_dir
+    from utils.qc import QCTable, QC_NAME
+    if opts.precision != 'float32' and not opts.ray_sum:
+        raise SystemExit("--precision float16 needs --ray-sum, the default projection is exact in float32")
+    memory_limit = parse_size(opts.mem_limit) if opts.mem_limit else None
+    method = "sum" if opts.ray_sum else "slices"
+    with DRRWriter(opts.format, opts.compression, opts.bits, opts.encode_workers) as writer, DRRPostProcessor(opts.post_workers, opts.post_batch) as post:
+        if opts.paired:
+            process_mhd_folder_pair(opts.data, opts.mask, opts.out, opts.meta, opts.patch_meta, opts.crop, writer, opts.precision, opts.force, opts.lungs, opts.qc, post, method)
+            return
+        # both halves merge into one QC table, saved once
+        qc = QCTable(opts.qc or os.path.join(report_dir(opts.meta, opts.out), QC_NAME))
+        process_mhd_folder_raycast(opts.data, os.path.join(opts.out, "full_ct_xray"), opts.meta, writer, memory_limit, opts.workers, opts.precision, opts.force, opts.lungs, qc, post, opts.out, method)
+        process_mhd_folder_max(opts.mask, os.path.join(opts.out, "full_ct_mask"), opts.meta, writer, memory_limit, opts.workers, opts.force, opts.lungs, qc, post, opts.out)
+        qc.save()
     
 
 def main(args: list):
-    checks(args)
-    set_vars(args)
-    start_patch()
\ No newline at end of file
+    run(cli.parse(sys.modules[__name__], args))
@@ -0,0 +1,36 @@
+import sys
+from utils import cli
+
+DESCRIPTION = """Shard Exporter
+  This script packs paired (patch, mask, DRR, metadata) samples into tar shards (WebDataset layout).
+  An index.json with per-sample byte offsets allows random access as well as streaming reads.
+"""
+EPILOG = """Example Usage:
+  python export_shards.py -p out/patch_dataset -r out/infered_dataset -x out/xray_dataset -m out/patch_dataset/meta.json -o out/shards
+"""
+
+def add_arguments(parser):
+    parser.add_argument('-p', dest='patch', required=True, help='Path to the directory containing extracted CT patches (.mhd)')
+    parser.add_argument('-r', dest='mask', required=True, help='Path to the directory containing inferred patch masks (.mhd)')
+    parser.add_argument('-x', dest='xray', required=True, help='Path to the DRR output directory of drrer.py')
+    parser.add_argument('-m', dest='meta', required=True, help='Path to the meta.json (or meta.db) generated during dataset creation')
+    parser.add_argument('-o', dest='out', required=True, help='Output directory to store the shards and index.json')
+    parser.add_argument('-s', dest='shard_size', type=int, default=256, help='Number of samples per shard')
+    parser.add_argument('-w', dest='workers', type=int, default=4, help='Number of shards written in parallel')
+
+def run(opts):
+    from utils.shard_export import export_shards
+    data = {
+        "patch": opts.patch,
+        "mask": opts.mask,
+        "xray": opts.xray,
+        "meta": opts.meta,
+        "out": opts.out,
+        "shard_size": opts.shard_size,
+        "workers": opts.workers
+    }
+    export_shards(data)
+    
+
+def main(args: list):
+    run(cli.parse(sys.modules[__name__], args))
@@ -1,64 +1,52 @@
-import os
-from utils.vinference import convert_to_vnet
-
-mandate = ['-i', '-o']
-DATA_DIR = ""
-OUTPUT_DIR = ""
-
-def check_args(args: list):
-    for arg in mandate:
-        if not arg in args:
-            raise ValueError(f"{arg} is a mandatory keyword, use -h for help")
-
-def print_help():
-    help_message = """\033[1;36m
-nnUNet CT Patch Inference - Help
-\033[0m
-Usage:
-  python data_inference_nnunet.py -i <data_directory> -o <output_directory> 
-
-\033[1;33mOptions:\033[0m
-  \033[1;32m-d\033[0m    Path to the directory containing CT scans patches (.mhd)  \033[1;30m[Required]\033[0m
-  \033[1;32m-o\033[0m    Output directory to store inferenced CT patches                \033[1;30m[Required]\033[0m
-
-\033[1;33mExample Usage:\033[0m
-  \033[1;34mdata_inference_nnunet.py -i /path/to/ct_scans -o /path/to/output\033[0m
-
-\033[1;35mDescription:\033[0m
-  This script runs an inference on 3d_fullres configuration of the nnUNet model using patches from chest CT scans stored in the specified directory.
-  The 3D patch mask predicted by the nnUNET model will be stored in the specified output directory.
-    """
-    print(help_message)
-
-def check_help(args: list):
-    if '-h' in args:
-        print_help()
-        return False
-    return True
-
-
-def checks(args: list):
-    if not check_help(args):
-        exit(0)
-    check_args(args)
-
-def set_vars(args: list):
-    global DATA_DIR
-    global OUTPUT_DIR
-    DATA_DIR = args[args.index('-i')+1]
-    OUTPUT_DIR = args[args.index('-o')+1]
-
-
-def start_inf():
+import sys
+from utils import cli
+
+DESCRIPTION = """VNet CT Patch Inference
+  This script runs VNet segmentation on patches from chest CT scans stored in the specified directory.
+  The 3D patch mask predicted by the model will be stored in the specified output directory.
+"""
+EPILOG = """Example Usage:
+  python data_inference_vnet.py -i /path/to/ct_patches -o /path/to/output
+  python data_inference_vnet.py -i /path/to/ct_patches -o /path/to/output -q /tmp/vnet_queue
+  python data_inference_vnet.py -i /path/to/ct_patches -o /path/to/output --tta 4 -w a.pth b.pth --batch 4 --bench-tta
+"""
+
+def add_arguments(parser):
+    parser.add_argument('-i', dest='data', required=True, help='Path to the directory containing CT scans patches (.mhd)')
+    parser.add_argument('-o', dest='out', required=True, help='Output directory to store inferenced CT patches')
+    parser.add_argument('-q', dest='queue', help='Send the patches to the inference worker serving this queue folder')
+    parser.add_argument('--timeout', type=float, help='With -q, seconds to wait for the worker in total (default: as long as it is alive)')
+    parser.add_argument('--lungs', help='lungs.json of the lungs stage; patches outside the lungs get an empty mask without running VNet')
+    parser.add_argument('-m', dest='meta', help='Extraction meta.json used with --lungs (default: <input>/meta.json); a meta.db also records the inference status')
+    parser.add_argument('-w', dest='weights', nargs='+', help='Weight files; several files are ensembled by averaging their probabilities (default: ./weights/best_model1.pth)')
+    parser.add_argument('--tta', type=int, default=1, choices=range(1, 9), metavar='N', help='Flip variants per patch (1-8), averaged before the 0.5 threshold (default: 1, no TTA)')
+    parser.add_argument('--batch', type=int, default=1, help='Patches per forward pass (default: 1)')
+    parser.add_argument('--bench-tta', dest='bench_tta', action='store_true', help='Time 1, 2, 4 and 8 flip variants first and write <output>/tta_benchmark.json')
+
+def run(opts):
     data = {
-        "data":DATA_DIR,
-        "out": OUTPUT_DIR,
+        "data": opts.data,
+        "out": opts.out,
+        "lungs": opts.lungs,
+        "meta": opts.meta,
+        "weights": opts.weights,
+        "tta": opts.tta,
+        "batch": opts.batch,
+        "bench_tta": opts.bench_tta,
     }
     print(data)
+    if opts.queue:
+        from utils.inference_worker import submit
+        # the worker serves its own single model without TTA
+        local = [flag for flag, used in (("-w", opts.weights), ("--tta", opts.tta > 1), ("--batch", opts.batch > 1), ("--bench-tta", opts.bench_tta)) if used]
+        if local:
+            raise SystemExit(f"{', '.join(local)} cannot be combined with -q, the worker serves its own model")
+        response = submit(opts.queue, "folder", opts.data, opts.out, timeout=opts.timeout, lungs=opts.lungs, meta=opts.meta)
+        print(f"Worker {response['status']}: {response['count']} patches in {response['seconds']:.1f} s")
+        return
+    from utils.vinference import convert_to_vnet
     convert_to_vnet(data)
     
 
 def main(args: list):
-    checks(args)
-    set_vars(args)
-    start_inf()
\ No newline at end of file
+    run(cli.parse(sys.modules[__name__], args))
@@ -0,0 +1,39 @@
+import sys
+from utils import cli
+
+DESCRIPTION = """Lung Masker
+  This script finds the lungs of every chest CT scan on a downsampled copy (threshold, morphology, connected components).
+  A lung bounding box and a coarse occupancy grid per series are cached in <out>/lungs.json,
+  which the extract (--specs negatives), infer and drr stages accept with --lungs to skip regions outside the lungs.
+"""
+EPILOG = """Example Usage:
+  python lung_masker.py -d /path/to/ct_scans -o /path/to/output
+  python drrer.py -d /path/to/ct_scans -m /path/to/masks -o /path/to/xray --meta /path/to/masks/meta.json --lungs /path/to/output/lungs.json
+"""
+
+def add_arguments(parser):
+    parser.add_argument('-d', dest='data', required=True, help='Path to the directory containing full chest CT scans (.mhd)')
+    parser.add_argument('-o', dest='out', required=True, help='Output directory to store lungs.json')
+    parser.add_argument('--spacing', type=float, default=4.0, help='Spacing in mm of the downsampled volume (also the occupancy cell size)')
+    parser.add_argument('--threshold', type=int, default=-320, help='Air threshold in HU')
+    parser.add_argument('--margin', type=float, default=10.0, help='Margin in mm added around the lungs')
+    parser.add_argument('--mem-limit', help='RAM budget such as 16G; scans are only started while their estimated footprint fits')
+    parser.add_argument('--workers', type=int, default=1, help='Maximum number of scans processed in parallel')
+
+def run(opts):
+    from utils.lung_mask import lung_masking
+    from utils.memory_budget import parse_size
+    data = {
+        "data": opts.data,
+        "out": opts.out,
+        "coarse_spacing": opts.spacing,
+        "threshold": opts.threshold,
+        "margin": opts.margin,
+        "memory_limit": parse_size(opts.mem_limit) if opts.mem_limit else None,
+        "workers": opts.workers
+    }
+    lung_masking(data)
+    
+
+def main(args: list):
+    run(cli.parse(sys.modules[__name__], args))
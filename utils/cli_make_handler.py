@@ -1,72 +1,55 @@
 import os
-from utils.patching import extracting
+import sys
+import json
+from utils import cli
 
-mandate = ['-d', '-o']
-DATA_DIR = ""
-OUTPUT_DIR = ""
-CSV_PATH = ""
-
-def check_args(args: list):
-    for arg in mandate:
-        if not arg in args:
-            raise ValueError(f"{arg} is a mandatory keyword, use -h for help")
-
-def print_help():
-    help_message = """\033[1;36m
-CT Patch Extractor - Help
-\033[0m
-Usage:
-  python dataset_maker.py -d <data_directory> -o <output_directory> [-c <csv_file>]
-
-\033[1;33mOptions:\033[0m
-  \033[1;32m-d\033[0m    Path to the directory containing full chest CT scans (.mhd)  \033[1;30m[Required]\033[0m
-  \033[1;32m-o\033[0m    Output directory to store extracted CT patches                \033[1;30m[Required]\033[0m
-  \033[1;32m-c\033[0m    Path to the CSV file containing annotations (optional)
-
-\033[1;33mExample Usage:\033[0m
-  \033[1;34mpython script.py -d /path/to/ct_scans -o /path/to/output\033[0m
-  \033[1;34mpython script.py -d /path/to/ct_scans -o /path/to/output -c annotations.csv\033[0m
-
-\033[1;35mDescription:\033[0m
+DESCRIPTION = """CT Patch Extractor
   This script extracts patches from chest CT scans stored in the specified directory.
   If an annotation CSV file is provided, patches will be extracted based on its coordinates.
   Else the script expects an annotation CSV file in the data directory.
-    """
-    print(help_message)
-
-def check_help(args: list):
-    if '-h' in args:
-        print_help()
-        return False
-    return True
-
-
-def checks(args: list):
-    if not check_help(args):
-        exit(0)
-    check_args(args)
-
-def set_vars(args: list):
-    global DATA_DIR
-    global OUTPUT_DIR
-    global CSV_PATH
-    DATA_DIR = args[args.index('-d')+1]
-    OUTPUT_DIR = args[args.index('-o')+1]
-    if "-c" in args:
-        CSV_PATH = args[args.index('-c')+1]
-    else:
-        CSV_PATH = os.path.join(DATA_DIR, 'annotations.csv')
-
-def start_patch():
+"""
+EPILOG = """Example Usage:
+  python dataset_maker.py -d /path/to/ct_scans -o /path/to/output
+  python dataset_maker.py -d /path/to/ct_scans -o /path/to/output -c annotations.csv
+  python dataset_maker.py -d /path/to/ct_scans -o /path/to/output -c annotations.csv -s 1.0
+"""
+
+def add_arguments(parser):
+    parser.add_argument('-d', dest='data', required=True, help='Path to the directory containing full chest CT scans (.mhd)')
+    parser.add_argument('-o', dest='out', required=True, help='Output directory to store extracted CT patches')
+    parser.add_argument('-c', dest='csv', help='Path to the CSV file containing annotations (default: <data>/annotations.csv)')
+    parser.add_argument('-s', dest='spacing', type=float, help='Resample each 50-voxel patch to an isotropic spacing in mm around the nodule')
+    parser.add_argument('--pad', action='store_true', help='Keep patches centred and pad border patches to the full 50x50x50 size')
+    parser.add_argument('--specs', help='JSON list of patch specs (name, size, spacing, diameter_scale, jitter, negatives); '
+                        'all specs are extracted from a single read of each scan into <out>/<name>')
+    parser.add_argument('--store', help='meta.db to record the patches in as each scan finishes (default: meta.db in the parent of <out>)')
+    parser.add_argument('--export-json', action='store_true', help='Also write the patch metadata to <out>/meta.json for tools that still read JSON')
+    parser.add_argument('--lungs', help='lungs.json of the lungs stage, --specs negatives are drawn inside the lung occupancy grid')
+    parser.add_argument('--mem-limit', help='RAM budget such as 16G; scans are only started while their estimated footprint fits')
+    parser.add_argument('--workers', type=int, default=1, help='Maximum number of scans processed in parallel')
+
+def run(opts):
+    from utils.patching import extracting, extracting_multi
+    from utils.memory_budget import parse_size
     data = {
-        "data":DATA_DIR,
-        "out": OUTPUT_DIR,
-        "csv": CSV_PATH
+        "data": opts.data,
+        "out": opts.out,
+        "csv": opts.csv or os.path.join(opts.data, 'annotations.csv'),
+        "spacing": opts.spacing,
+        "pad": opts.pad,
+        "memory_limit": parse_size(opts.mem_limit) if opts.mem_limit else None,
+        "workers": opts.workers,
+        "lungs": opts.lungs,
+        "store": opts.store,
+        "export_json": opts.export_json,
     }
+    if opts.specs:
+        with open(opts.specs, 'r') as f:
+            data["specs"] = json.load(f)
+        extracting_multi(data)
+        return
     extracting(data)
     
 
 def main(args: list):
-    checks(args)
-    set_vars(args)
-    start_patch()
\ No newline at end of file
+    run(cli.parse(sys.modules[__name__], args))
@@ -0,0 +1,36 @@
+import sys
+from utils import cli
+
+DESCRIPTION = """Metadata Store
+  This script shows the per-stage status recorded in a meta.db (extract, infer, patch, drr/...)
+  and exports a stage in its legacy meta.json layout for tools that still read JSON.
+"""
+EPILOG = """Example Usage:
+  python luna.py meta -s /path/to/output/meta.db
+  python luna.py meta -s /path/to/output/meta.db --series 1.3.6.1.4.1.14519
+  python luna.py meta -s /path/to/output/meta.db --export extract -o /path/to/output/patch_dataset/meta.json
+"""
+
+def add_arguments(parser):
+    parser.add_argument('-s', dest='store', required=True, help='Path to the meta.db')
+    parser.add_argument('--series', help='Show every record of one series uid')
+    parser.add_argument('--export', help='Stage to export as meta.json (extract, extract/<spec>, patch, infer, drr/xray, ...)')
+    parser.add_argument('-o', dest='out', help='Output meta.json path for --export')
+
+def run(opts):
+    from utils.meta_store import MetaStore, export_json
+    store = MetaStore(opts.store, readonly=True)
+    if opts.export:
+        if not opts.out:
+            raise SystemExit("--export needs -o")
+        print(f"Exported {export_json(store, opts.export, opts.out)} {opts.export} entries to {opts.out}")
+        return
+    for stage, counts in store.summary().items():
+        print(f"{stage:<16} " + "  ".join(f"{status}: {count}" for status, count in counts.items()))
+        if opts.series:
+            for uid, nodule, status, payload in store.latest(stage, seriesuid=opts.series):
+                print(f"  {uid} {'' if nodule < 0 else nodule} {status} {payload if payload is not None else ''}")
+    
+
+def main(args: list):
+    run(cli.parse(sys.modules[__name__], args))
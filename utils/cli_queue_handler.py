@@ -0,0 +1,55 @@
+import sys
+from utils import cli
+
+DESCRIPTION = """Distributed Extraction Queue
+  Splits patch extraction across several machines through a work-queue folder on a shared filesystem.
+  init   registers every series of the data directory (and its subset subfolders) as a work item.
+  work   claims series one at a time with atomic lock files and extracts their patches;
+         locks of crashed workers expire after the lease timeout and are retried.
+  reduce merges the per-node meta.<node>.json files into meta.json.
+"""
+EPILOG = """Example Usage:
+  python queue_worker.py init -q /shared/queue -d /shared/luna16
+  python queue_worker.py work -q /shared/queue -o /shared/out/patch_dataset -c annotations.csv
+  python queue_worker.py reduce -q /shared/queue -o /shared/out/patch_dataset
+"""
+
+def add_arguments(parser):
+    parser.add_argument('action', choices=['init', 'work', 'reduce'], help='Queue operation')
+    parser.add_argument('-q', dest='queue', required=True, help='Shared work-queue folder')
+    parser.add_argument('-d', dest='data', help='Data directory with .mhd scans or subset subfolders (init)')
+    parser.add_argument('-o', dest='out', help='Shared output directory for patches and meta files (work, reduce)')
+    parser.add_argument('-c', dest='csv', help='Path to the LUNA16 annotations CSV file (work)')
+    parser.add_argument('-s', dest='spacing', type=float, help='Isotropic patch spacing in mm (work)')
+    parser.add_argument('--node', help='Node id, defaults to <hostname>-<pid>')
+    parser.add_argument('--lease', type=float, default=600, help='Seconds without heartbeat before a claimed series is retried')
+    parser.add_argument('--poll', type=float, default=5, help='Seconds to wait while remaining series are leased by other nodes')
+
+def run(opts):
+    from utils.work_queue import init_queue, run_extraction_worker, reduce_meta
+    if opts.action == 'init':
+        if not opts.data:
+            raise ValueError("-d is a mandatory keyword for init, use -h for help")
+        print(f"{init_queue(opts.queue, opts.data)} series in {opts.queue}")
+        return
+    if not opts.out:
+        raise ValueError(f"-o is a mandatory keyword for {opts.action}, use -h for help")
+    if opts.action == 'reduce':
+        reduce_meta(opts.queue, opts.out)
+        return
+    if not opts.csv:
+        raise ValueError("-c is a mandatory keyword for work, use -h for help")
+    data = {
+        "queue": opts.queue,
+        "out": opts.out,
+        "csv": opts.csv,
+        "node": opts.node,
+        "lease": opts.lease,
+        "poll": opts.poll,
+        "spacing": opts.spacing
+    }
+    run_extraction_worker(data)
+    
+
+def main(args: list):
+    run(cli.parse(sys.modules[__name__], args))
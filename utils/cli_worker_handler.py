@@ -0,0 +1,34 @@
+import sys
+from utils import cli
+
+DESCRIPTION = """VNet Inference Worker
+  This script keeps the VNet model loaded and serves inference requests from a queue folder.
+  Run data_inference_vnet.py with -q <queue_dir> to send a patch folder to the worker
+  instead of loading the model again.
+"""
+EPILOG = """Example Usage:
+  python inference_worker.py -q /tmp/vnet_queue
+  python inference_worker.py -q /tmp/vnet_queue --stop
+  python inference_worker.py -q /tmp/vnet_queue --recover
+"""
+
+def add_arguments(parser):
+    parser.add_argument('-q', dest='queue', required=True, help='Queue folder shared with the clients')
+    parser.add_argument('-w', dest='weights', default='./weights/best_model1.pth', help='Path to the VNet weights')
+    parser.add_argument('-t', dest='threads', type=int, default=2, help='Number of threads reading/writing patches')
+    parser.add_argument('--stop', action='store_true', help='Ask the worker serving the queue to exit')
+    parser.add_argument('--recover', action='store_true', help='Requeue requests a crashed worker left in working/ and exit (a running worker also does this)')
+
+def run(opts):
+    from utils.inference_worker import InferenceWorker, stop, recover
+    if opts.stop:
+        stop(opts.queue)
+        return
+    if opts.recover:
+        print(f"Recovered {recover(opts.queue)} requests")
+        return
+    InferenceWorker(opts.queue, opts.weights, opts.threads).serve()
+    
+
+def main(args: list):
+    run(cli.parse(sys.modules[__name__], args))
@@ -0,0 +1,108 @@
+import os
+import json
+import hashlib
+import threading
+from utils.json_io import write_json_atomic
+
+MANIFEST_NAME = "drr_manifest.json"
+# bump when the rendering code changes in a way that alters existing outputs
+# (settings such as CLAHE, writer and box mode are part of every entry's parameters instead)
+# 2: nodule boxes, per-stage work dir keys, batched post-processing, exact raycast
+RENDER_VERSION = 2
+
+
+def input_files(mhd_path):
+    """The .mhd header and the data file it points to (ElementDataFile)."""
+    files = [mhd_path]
+    with open(mhd_path, "r", errors="ignore") as header:
+        for line in header:
+            key, _, value = line.partition("=")
+            if key.strip() == "ElementDataFile":
+                value = value.strip()
+                if value != "LOCAL":
+                    files.append(os.path.join(os.path.dirname(mhd_path), value))
+                break
+    return files
+
+
+def file_digest(path, chunk_size=1 << 22):
+    """BLAKE2b content hash of one file."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def json_digest(payload):
+    """Hash of a JSON-serialisable value, used for parameters and meta rows."""
+    return hashlib.blake2b(json.dumps(payload, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+class DRRManifest:
+    """
+    Per-output record of what every DRR was rendered from.
+
+    Each output key stores the content hashes of its input files and the
+    rendering parameters. A later run only re-renders keys whose inputs or
+    parameters changed or whose files are missing. File hashes are cached
+    by (size, mtime) so unchanged scans are not read again.
+
+    Args:
+        output_dir (str): Folder holding the DRRs and drr_manifest.json
+        force (bool): Treat every output as stale (the manifest is still rewritten)
+    """
+
+    def __init__(self, output_dir, force=False):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.force = force
+        self.lock = threading.Lock()
+        self.files = {}
+        self.outputs = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                manifest = json.load(f)
+            if manifest.get("version") == RENDER_VERSION:
+                self.files = manifest.get("files", {})
+                self.outputs = manifest.get("outputs", {})
+
+    def fingerprint(self, mhd_path):
+        """Content hashes of a scan's header and data file, keyed by file name."""
+        hashes = {}
+        for path in input_files(mhd_path):
+            stat = os.stat(path)
+            key = os.path.abspath(path)
+            with self.lock:
+                cached = self.files.get(key)
+            if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+                digest = cached[2]
+            else:
+                digest = file_digest(path)
+                with self.lock:
+                    self.files[key] = [stat.st_size, stat.st_mtime_ns, digest]
+            hashes[os.path.basename(path)] = digest
+        return hashes
+
+    def is_current(self, key, inputs, params, outputs=()):
+        """True when key was rendered from the same inputs and params and all outputs still exist."""
+        if self.force:
+            return False
+        with self.lock:
+            entry = self.outputs.get(key)
+        if entry is None or entry["inputs"] != inputs or entry["params"] != json_digest(params):
+            return False
+        return all(os.path.exists(path) for path in outputs)
+
+    def get(self, key, field, default=None):
+        """Extra data stored with an output, such as its boxes."""
+        with self.lock:
+            return self.outputs.get(key, {}).get(field, default)
+
+    def record(self, key, inputs, params, **extra):
+        """Remember that key has been rendered from inputs with params."""
+        with self.lock:
+            self.outputs[key] = {"inputs": inputs, "params": json_digest(params), **extra}
+
+    def save(self):
+        with self.lock:
+            write_json_atomic(self.path, {"version": RENDER_VERSION, "files": self.files, "outputs": self.outputs})
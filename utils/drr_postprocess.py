@@ -0,0 +1,109 @@
+import threading
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+
+# CLAHE (clip limit, tile grid) of the raycast/paired CT DRRs and of the max-projected masks
+RAYCAST_CLAHE = (2.0, (16, 16))
+MAX_CLAHE = (3.0, (8, 8))
+
+_local = threading.local()
+
+
+def clahe(clip_limit, tile_grid):
+    """CLAHE object of the calling thread, created once per thread and setting."""
+    cache = getattr(_local, "clahe", None)
+    if cache is None:
+        cache = _local.clahe = {}
+    key = (clip_limit, tuple(tile_grid))
+    if key not in cache:
+        cache[key] = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tuple(tile_grid))
+    return cache[key]
+
+
+def postprocess(drr, clip_limit, tile_grid, output_size=None):
+    """
+    CLAHE, optional area resize and vertical flip of one uint8 projection.
+
+    Every step stays in uint8; OpenCV releases the GIL, so several images
+    can be processed on threads in parallel.
+
+    Args:
+        drr (ndarray): uint8 projection
+        clip_limit (float): CLAHE clip limit
+        tile_grid (tuple): CLAHE tile grid
+        output_size (tuple): (width, height) to resize to, None keeps the size
+
+    Returns:
+        uint8 DRR image
+    """
+    image = clahe(clip_limit, tile_grid).apply(drr)
+    if output_size is not None:
+        image = cv2.resize(image, output_size, interpolation=cv2.INTER_AREA)
+    return cv2.flip(image, 0)
+
+
+class DRRPostProcessor:
+    """
+    Post-processing of projections in batches on a thread pool.
+
+    `submit` queues a projection together with a callback that receives the
+    finished image (saving, QC, manifest); full batches start right away, so
+    the caller can project the next volume meanwhile. Without workers every
+    projection is processed and handed to its callback immediately.
+
+    Args:
+        workers (int): Threads, 0 processes in the calling thread
+        batch_size (int): Projections per pool task
+    """
+
+    def __init__(self, workers=0, batch_size=4):
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.batch_size = max(1, batch_size)
+        self.lock = threading.Lock()
+        self.batch = []
+        self.pending = []
+
+    @staticmethod
+    def run_batch(batch):
+        for drr, settings, callback in batch:
+            callback(postprocess(drr, *settings))
+
+    def submit(self, drr, settings, callback):
+        """
+        Queue one uint8 projection.
+
+        Args:
+            drr (ndarray): uint8 projection, not modified
+            settings (tuple): Arguments of `postprocess` after the image
+            callback (callable): Called with the finished image
+        """
+        if self.executor is None:
+            callback(postprocess(drr, *settings))
+            return
+        with self.lock:
+            self.batch.append((drr, settings, callback))
+            if len(self.batch) < self.batch_size:
+                return
+            batch, self.batch = self.batch, []
+            self.pending.append(self.executor.submit(self.run_batch, batch))
+
+    def flush(self):
+        """Process the partial batch, wait for every queued projection and re-raise the first error."""
+        with self.lock:
+            if self.batch:
+                self.pending.append(self.executor.submit(self.run_batch, self.batch))
+                self.batch = []
+            pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,116 @@
+import numpy as np
+import cv2
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+FORMATS = {"png": ".png", "webp": ".webp", "raw": ".raw"}
+
+
+def to_grayscale(drr, bit_depth=8):
+    """
+    Convert a DRR to a single-channel unsigned integer image.
+
+    Float images are expected in [0, 1], integer
+    images are rescaled between 8 and 16 bit when needed.
+    """
+    drr = np.ascontiguousarray(drr)
+    max_value = 255 if bit_depth == 8 else 65535
+    dtype = np.uint8 if bit_depth == 8 else np.uint16
+
+    if drr.dtype == np.bool_:
+        return drr.astype(dtype) * max_value
+    if np.issubdtype(drr.dtype, np.floating):
+        return (np.clip(drr, 0.0, 1.0) * max_value + 0.5).astype(dtype)
+    if drr.dtype == dtype:
+        return drr
+    if drr.dtype == np.uint8:
+        return drr.astype(dtype) * 257
+    if drr.dtype == np.uint16:
+        return (drr // 257).astype(dtype)
+    return np.clip(drr, 0, max_value).astype(dtype)
+
+
+class DRRWriter:
+    """
+    Encode grayscale DRRs straight to disk with OpenCV.
+
+    Args:
+        fmt (str): "png", "webp" (lossless) or "raw" (headerless uint16/uint8 bytes)
+        compression (int): PNG zlib level 0-9, ignored for other formats
+        bit_depth (int): 8 or 16, WebP is always written as 8 bit
+        workers (int): encode on a background thread pool when > 0
+    """
+
+    def __init__(self, fmt="png", compression=3, bit_depth=8, workers=0):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unsupported DRR format: {fmt}, expected one of {list(FORMATS)}")
+        if bit_depth not in (8, 16):
+            raise ValueError(f"Unsupported bit depth: {bit_depth}, expected 8 or 16")
+        self.fmt = fmt
+        self.bit_depth = 8 if fmt == "webp" else bit_depth
+        if fmt == "png":
+            self.params = [cv2.IMWRITE_PNG_COMPRESSION, int(compression)]
+        elif fmt == "webp":
+            self.params = [cv2.IMWRITE_WEBP_QUALITY, 101]
+        else:
+            self.params = []
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.pending = []
+
+    def settings(self):
+        """Everything that changes the encoded bytes, recorded in the DRR manifest."""
+        return {"fmt": self.fmt, "bit_depth": self.bit_depth, "params": list(self.params)}
+
+    def output_path(self, output_path):
+        """Replace the extension of output_path with the one of the configured format."""
+        return os.path.splitext(output_path)[0] + FORMATS[self.fmt]
+
+    def encode(self, drr):
+        """Encode one DRR and return the file bytes."""
+        image = to_grayscale(drr, self.bit_depth)
+        if self.fmt == "raw":
+            return image.tobytes()
+        ok, buffer = cv2.imencode(FORMATS[self.fmt], image, self.params)
+        if not ok:
+            raise RuntimeError(f"Failed to encode DRR as {self.fmt}")
+        return buffer.tobytes()
+
+    def write(self, drr, output_path):
+        """Encode and write one DRR synchronously, returns the path written."""
+        output_path = self.output_path(output_path)
+        payload = self.encode(drr)
+        with open(output_path, "wb") as f:
+            f.write(payload)
+        return output_path
+
+    def submit(self, drr, output_path):
+        """Queue a DRR for background encoding, falls back to write without workers."""
+        if self.executor is None:
+            return self.write(drr, output_path)
+        # copy so the caller may reuse its buffer while encoding runs
+        future = self.executor.submit(self.write, np.array(drr, copy=True), output_path)
+        self.pending.append(future)
+        return future
+
+    def write_batch(self, drrs, output_paths):
+        """Encode a batch of DRRs, in parallel when workers are configured."""
+        for drr, output_path in zip(drrs, output_paths):
+            self.submit(drr, output_path)
+        self.flush()
+
+    def flush(self):
+        """Wait for every queued DRR and re-raise the first encoding error."""
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,4 +1,5 @@
 import SimpleITK as sitk
+import numpy as np
 import os
 
 def extract_cube(mhd_file, world_coord, cube_size):
@@ -17,6 +18,21 @@ def extract_cube(mhd_file, world_coord, cube_size):
       extract_size  : list of ints, the actual size used (may be smaller near image borders).
     """
     image = sitk.ReadImage(mhd_file)
+    return extract_cube_from_image(image, world_coord, cube_size)
+
+def extract_cube_from_image(image, world_coord, cube_size):
+    """
+    Same as extract_cube but works on an already loaded image, so several
+    cubes can be cut from one read of the volume.
+    
+    Parameters:
+      image      : SimpleITK.Image, the full CT scan.
+      world_coord: tuple, (x, y, z) world coordinate.
+      cube_size  : tuple, (cube_width, cube_height, cube_depth).
+    
+    Returns:
+      extracted_cube, start_index, extract_size (see extract_cube).
+    """
     img_size = image.GetSize()  # (x, y, z)
     
     index = image.TransformPhysicalPointToIndex(world_coord)
@@ -44,20 +60,214 @@ def extract_cube(mhd_file, world_coord, cube_size):
     
     return extracted_cube, start_index, extract_size
 
-def patch_cube(mutated_image, cube, start_index):
+def world_to_index(world_coords, origin, spacing, direction):
     """
-    Creates a new image with a white (255) background and pastes the binary mask into its
-    original location. The binary mask is assumed to contain values 0 and 1; it is inverted
-    so that the foreground (mask==1) appears black (0) and the background (mask==0) remains white.
+    Converts an (N, 3) array of world coordinates to voxel indices in one operation,
+    rounding like TransformPhysicalPointToIndex.
     
     Parameters:
-      mutated_image: SimpleITK.Image, the original image (used for dimensions/metadata).
-      cube: SimpleITK.Image, the extracted cube (binary mask expected).
-      start_index   : list of ints, the (x, y, z) index where the mask was extracted.
+      world_coords: array-like (N, 3), (x, y, z) world coordinates.
+      origin      : (x, y, z) origin of the series.
+      spacing     : (x, y, z) spacing of the series.
+      direction   : 9 values (row major) or 3x3 direction matrix.
+    
+    Returns:
+      indices: int array (N, 3) in (x, y, z) order.
     """
+    world_coords = np.atleast_2d(np.asarray(world_coords, dtype=np.float64))
+    matrix = np.asarray(direction, dtype=np.float64).reshape(3, 3) @ np.diag(spacing)
+    continuous = np.linalg.solve(matrix, (world_coords - np.asarray(origin)).T).T
+    return np.floor(continuous + 0.5).astype(np.int64)
 
-    orig_array = sitk.GetArrayFromImage(mutated_image)
-    cube_array = sitk.GetArrayFromImage(cube)
+def cube_bounds(world_coords, origin, spacing, direction, image_size, cube_size, pad=False):
+    """
+    Computes the extraction region of every cube in one NumPy pass.
+    
+    Without pad the result matches extract_cube: the start is clamped at 0 (the cube
+    shifts inwards) and the end at the image border (the cube shrinks). With pad the
+    cube stays centred on the nodule and pad_before/pad_after give the number of
+    voxels to pad so that every patch has exactly cube_size voxels.
+    
+    Parameters:
+      world_coords: array-like (N, 3), (x, y, z) world coordinates.
+      origin, spacing, direction: geometry of the series.
+      image_size  : (x, y, z) size of the series.
+      cube_size   : (x, y, z) cube size.
+      pad         : bool, keep cubes centred and report padding.
+    
+    Returns:
+      start_index, extract_size, pad_before, pad_after: int arrays (N, 3), (x, y, z) order.
+    """
+    index = world_to_index(world_coords, origin, spacing, direction)
+    image_size = np.asarray(image_size, dtype=np.int64)
+    cube_size = np.asarray(cube_size, dtype=np.int64)
+
+    start = index - cube_size // 2
+    if pad:
+        end = start + cube_size
+        start_index = np.clip(start, 0, image_size)
+        end_index = np.clip(end, 0, image_size)
+        pad_before = start_index - start
+        pad_after = end - np.maximum(end_index, start_index)
+    else:
+        start_index = np.maximum(start, 0)
+        end_index = np.minimum(start_index + cube_size, image_size)
+        pad_before = np.zeros_like(start_index)
+        pad_after = np.zeros_like(start_index)
+    extract_size = np.maximum(end_index - start_index, 0)
+    return start_index, extract_size, pad_before, pad_after
+
+def extract_cubes(image, world_coords, cube_size, pad=False, pad_value=-1024):
+    """
+    Extracts all cubes of a series from one loaded image, using cube_bounds.
+    
+    Parameters:
+      image       : SimpleITK.Image, the full CT scan.
+      world_coords: array-like (N, 3), (x, y, z) world coordinates.
+      cube_size   : (x, y, z) cube size.
+      pad         : bool, pad every cube to cube_size with pad_value (cubes stay centred).
+      pad_value   : value used for voxels outside the scan.
+    
+    Returns:
+      cubes: list of SimpleITK.Image, bounds: (start_index, extract_size, pad_before, pad_after).
+    """
+    bounds = cube_bounds(world_coords, image.GetOrigin(), image.GetSpacing(), image.GetDirection(),
+                         image.GetSize(), cube_size, pad)
+    start_index, extract_size, pad_before, pad_after = bounds
+    array = sitk.GetArrayViewFromImage(image)
+    cubes = []
+    for start, size, before, after in zip(start_index, extract_size, pad_before, pad_after):
+        region = array[start[2]:start[2] + size[2], start[1]:start[1] + size[1], start[0]:start[0] + size[0]]
+        if pad:
+            region = np.pad(region, list(zip(before[::-1], after[::-1])), constant_values=pad_value)
+        cube = sitk.GetImageFromArray(np.ascontiguousarray(region))
+        cube.SetSpacing(image.GetSpacing())
+        cube.SetDirection(image.GetDirection())
+        cube.SetOrigin(image.TransformIndexToPhysicalPoint([int(i) for i in start - before]))
+        cubes.append(cube)
+    return cubes, bounds
+
+def series_affine(image):
+    """
+    Precomputes the index <-> world affine of a series once, so every cube of the
+    series can be placed with plain matrix products instead of ITK calls.
+    
+    Parameters:
+      image: SimpleITK.Image, the full CT scan.
+    
+    Returns:
+      dict with 4x4 numpy matrices "index_to_world" and "world_to_index",
+      plus the image "size" and "direction".
+    """
+    direction = np.array(image.GetDirection()).reshape(3, 3)
+    index_to_world = np.eye(4)
+    index_to_world[:3, :3] = direction @ np.diag(image.GetSpacing())
+    index_to_world[:3, 3] = image.GetOrigin()
+    return {
+        "index_to_world": index_to_world,
+        "world_to_index": np.linalg.inv(index_to_world),
+        "size": np.array(image.GetSize()),
+        "direction": direction,
+    }
+
+def resample_cube(image, world_coord, cube_size, spacing, affine=None):
+    """
+    Resamples a cube of cube_size voxels at an isotropic spacing (mm) centred on
+    a world coordinate, keeping the direction of the source image. Only the source
+    region covering the cube is cut and resampled, not the whole scan.
+    
+    Parameters:
+      image      : SimpleITK.Image, the full CT scan.
+      world_coord: tuple, (x, y, z) world coordinate of the cube centre.
+      cube_size  : tuple, output size in voxels (x, y, z).
+      spacing    : float, output voxel spacing in mm.
+      affine     : dict from series_affine, computed here when not given.
+    
+    Returns:
+      resampled_cube: SimpleITK.Image, the resampled region.
+      start_index   : list of ints, (x, y, z) start of the covering source region.
+      extract_size  : list of ints, size of the covering source region.
+      transform     : dict, origin/spacing/direction/size of the resampled cube,
+                      needed by patch_cube to map a mask back onto the source grid.
+    """
+    if affine is None:
+        affine = series_affine(image)
+    direction = affine["direction"]
+    half_extent = (np.array(cube_size) - 1) * spacing / 2
+    origin = np.array(world_coord) - direction @ half_extent
+
+    corners = np.array([[(c >> axis) & 1 for axis in range(3)] for c in range(8)]) * (np.array(cube_size) - 1) * spacing
+    world_corners = origin + corners @ direction.T
+    index_corners = (np.c_[world_corners, np.ones(8)] @ affine["world_to_index"].T)[:, :3]
+    start = np.clip(np.floor(index_corners.min(axis=0)).astype(int) - 1, 0, affine["size"] - 1)
+    end = np.clip(np.ceil(index_corners.max(axis=0)).astype(int) + 2, start + 1, affine["size"])
+    start_index = [int(i) for i in start]
+    extract_size = [int(i) for i in end - start]
+
+    extractor = sitk.RegionOfInterestImageFilter()
+    extractor.SetIndex(start_index)
+    extractor.SetSize(extract_size)
+    roi = extractor.Execute(image)
+
+    transform = {
+        "origin": [float(o) for o in origin],
+        "spacing": [float(spacing)] * 3,
+        "direction": [float(d) for d in direction.flatten()],
+        "size": [int(c) for c in cube_size],
+    }
+
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetOutputSpacing(transform["spacing"])
+    resampler.SetSize(transform["size"])
+    resampler.SetOutputDirection(transform["direction"])
+    resampler.SetOutputOrigin(transform["origin"])
+    resampler.SetInterpolator(sitk.sitkLinear)
+    resampler.SetDefaultPixelValue(-1024)
+    return resampler.Execute(roi), start_index, extract_size, transform
+
+def map_back(cube, reference, transform):
+    """
+    Resamples a mask predicted on a resampled cube back onto a source region grid
+    (nearest neighbour, so binary masks stay binary).
+    
+    Parameters:
+      cube     : SimpleITK.Image, mask on the resampled cube grid.
+      reference: SimpleITK.Image, source region the mask is mapped onto.
+      transform: dict stored by resample_cube.
+    """
+    cube = sitk.Image(cube)
+    cube.SetOrigin(transform["origin"])
+    cube.SetSpacing(transform["spacing"])
+    cube.SetDirection(transform["direction"])
+    return sitk.Resample(cube, reference, sitk.Transform(), sitk.sitkNearestNeighbor, 0, cube.GetPixelID())
+
+def prepare_cube(reference, cube, start_index, transform=None, extract_size=None, pad_before=None):
+    """
+    Returns the array of a predicted cube ready to be pasted at start_index of the
+    reference grid: isotropic cubes are mapped back, padded cubes are cropped.
+    
+    Parameters:
+      reference: SimpleITK.Image carrying the geometry of the full scan, its pixels
+                 are never read (a 1x1x1 image with copied geometry is enough).
+      see patch_cube for the others.
+    """
+    if transform is not None:
+        region = sitk.Image([int(i) for i in extract_size], cube.GetPixelID())
+        region.SetSpacing(reference.GetSpacing())
+        region.SetDirection(reference.GetDirection())
+        region.SetOrigin(reference.TransformIndexToPhysicalPoint([int(i) for i in start_index]))
+        cube = map_back(cube, region, transform)
+    if pad_before is not None:
+        cube = cube[tuple(slice(pad_before[axis], pad_before[axis] + extract_size[axis]) for axis in range(3))]
+    # a copy: a view would outlive the mapped or cropped image made here
+    return sitk.GetArrayFromImage(cube)
+
+def paste_cube(array, reference, cube, start_index, transform=None, extract_size=None, pad_before=None):
+    """
+    In-place variant of patch_cube that writes into a numpy array (z, y, x) of the
+    full scan, so several cubes can be pasted without copying the scan each time.
+    """
+    cube_array = prepare_cube(reference, cube, start_index, transform, extract_size, pad_before)
     
     cube_depth, cube_height, cube_width = cube_array.shape
     
@@ -66,13 +276,51 @@ def patch_cube(mutated_image, cube, start_index):
     y_end = y_start + cube_height
     x_end = x_start + cube_width
 
-    orig_array[z_start:z_end, y_start:y_end, x_start:x_end] = cube_array
+    array[z_start:z_end, y_start:y_end, x_start:x_end] = cube_array
+
+def patch_cube(mutated_image, cube, start_index, transform=None, extract_size=None, pad_before=None):
+    """
+    Creates a new image with a white (255) background and pastes the binary mask into its
+    original location. The binary mask is assumed to contain values 0 and 1; it is inverted
+    so that the foreground (mask==1) appears black (0) and the background (mask==0) remains white.
+    
+    Parameters:
+      mutated_image: SimpleITK.Image, the original image (used for dimensions/metadata).
+      cube: SimpleITK.Image, the extracted cube (binary mask expected).
+      start_index   : list of ints, the (x, y, z) index where the mask was extracted.
+      transform     : dict, set for isotropic cubes (see resample_cube); the mask is
+                      mapped back onto the source region before pasting.
+      extract_size  : list of ints, size of the source region, required with transform.
+      pad_before    : list of ints, set for padded cubes (see cube_bounds); the padding
+                      is cropped away before pasting, extract_size is required too.
+    """
+
+    orig_array = sitk.GetArrayFromImage(mutated_image)
+    paste_cube(orig_array, mutated_image, cube, start_index, transform, extract_size, pad_before)
 
     result_image = sitk.GetImageFromArray(orig_array)
     result_image.CopyInformation(mutated_image)
     
     return result_image
 
+def read_header(path):
+    """
+    Reads only the header of an image file.
+    
+    Returns:
+      reference: 1x1x1 SimpleITK.Image with the geometry of the file (for index/world transforms).
+      size     : (x, y, z) size of the image.
+      pixel_id : SimpleITK pixel id.
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.ReadImageInformation()
+    reference = sitk.Image([1] * reader.GetDimension(), reader.GetPixelID())
+    reference.SetSpacing(reader.GetSpacing())
+    reference.SetDirection(reader.GetDirection())
+    reference.SetOrigin(reader.GetOrigin())
+    return reference, reader.GetSize(), reader.GetPixelID()
+
 def load_image(path: os.PathLike):
     return sitk.ReadImage(path)
 
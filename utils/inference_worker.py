@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.json_io import write_json_atomic
+from utils.work_queue import fs_now
+
+REQUESTS = "requests"
+WORKING = "working"
+RESPONSES = "responses"
+STOP_FILE = "stop"
+KINDS = ("folder", "file", "array")
+# a request nobody claims within PICKUP_TIMEOUT means no worker is serving the queue;
+# the worker touches the requests it holds every HEARTBEAT seconds, so a working/
+# entry untouched for STALE_AFTER seconds was left behind by a crashed worker
+PICKUP_TIMEOUT = 60.0
+HEARTBEAT = 5.0
+STALE_AFTER = 60.0
+
+
+def queue_paths(queue_dir):
+    """Create (if needed) and return the requests/working/responses folders of a queue."""
+    paths = [os.path.join(queue_dir, name) for name in (REQUESTS, WORKING, RESPONSES)]
+    for path in paths:
+        os.makedirs(path, exist_ok=True)
+    return paths
+
+
+def age(path, now):
+    """
+    Seconds since path was last modified, None once it is gone.
+    now is the queue filesystem's time (utils.work_queue.fs_now), the clock that
+    stamps the mtimes, so the clocks of the client and worker hosts do not matter.
+    """
+    try:
+        return now - os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def submit(queue_dir, kind, input_path, output_path, timeout=None, poll_interval=0.2,
+           pickup_timeout=PICKUP_TIMEOUT, stale_after=STALE_AFTER, **options):
+    """
+    Queue one request for a running worker and wait for its response.
+
+    Raises instead of waiting forever when no worker claims the request within
+    pickup_timeout, or when the worker stops renewing the claimed request for
+    stale_after seconds (it crashed); the request is withdrawn in both cases.
+
+    Args:
+        queue_dir (str): Queue folder the worker serves
+        kind (str): "folder" (dir of .mhd patches), "file" (one .mhd) or "array" (one .npy)
+        input_path (str): Input folder or file
+        output_path (str): Output folder or file
+        timeout (float): Seconds to wait in total, None waits as long as the worker is alive
+        pickup_timeout (float): Seconds until a worker must have claimed the request
+        stale_after (float): Seconds without a heartbeat after which the worker counts as dead
+        options: Extra request fields, "lungs" and "meta" paths for "folder" requests
+
+    Returns:
+        Response dict with "status" ("ok" or "error"), "count", "seconds" and "error"
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Unknown request kind: {kind}, expected one of {KINDS}")
+    requests_dir, working_dir, responses_dir = queue_paths(queue_dir)
+    request_id = uuid.uuid4().hex
+    request_path = os.path.join(requests_dir, f"{request_id}.json")
+    working_path = os.path.join(working_dir, f"{request_id}.json")
+    write_json_atomic(request_path, {
+        "id": request_id,
+        "kind": kind,
+        "input": os.path.abspath(input_path),
+        "output": os.path.abspath(output_path),
+        **{key: os.path.abspath(value) for key, value in options.items() if value},
+    })
+
+    response_path = os.path.join(responses_dir, f"{request_id}.json")
+    started = time.perf_counter()
+    while not os.path.exists(response_path):
+        now = fs_now(queue_dir)
+        pending, working = age(request_path, now), age(working_path, now)
+        if pending is not None and pending > pickup_timeout and withdraw(request_path):
+            raise TimeoutError(f"No inference worker claimed the request within {pickup_timeout:g} s, "
+                               f"start one with: python inference_worker.py -q {queue_dir}")
+        if working is not None and working > stale_after and withdraw(working_path):
+            raise RuntimeError(f"The inference worker serving {queue_dir} stopped responding "
+                               f"(no heartbeat for {stale_after:g} s), it probably crashed")
+        if timeout is not None and time.perf_counter() - started > timeout:
+            withdraw(request_path) or withdraw(working_path)
+            raise TimeoutError(f"No response from inference worker in {queue_dir} after {timeout} s")
+        time.sleep(poll_interval)
+    with open(response_path, 'r') as f:
+        response = json.load(f)
+    os.remove(response_path)
+    return response
+
+
+def withdraw(path):
+    """Remove a request file, False when it was claimed or answered meanwhile."""
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def claim(requests_dir, working_dir):
+    """Atomically move the oldest pending request to working/, returns its path or None."""
+    pending = sorted(
+        (entry for entry in os.scandir(requests_dir) if entry.name.endswith(".json")),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+    for entry in pending:
+        target = os.path.join(working_dir, entry.name)
+        try:
+            os.rename(entry.path, target)
+        except FileNotFoundError:
+            continue  # claimed by another worker
+        return target
+    return None
+
+
+def recover(queue_dir, stale_after=STALE_AFTER):
+    """
+    Move requests that a crashed worker left in working/ back to requests/,
+    so a running worker picks them up again for clients still waiting.
+
+    Returns:
+        Number of recovered requests
+    """
+    requests_dir, working_dir, _ = queue_paths(queue_dir)
+    recovered = 0
+    now = fs_now(queue_dir)
+    for entry in os.scandir(working_dir):
+        if not entry.name.endswith(".json"):
+            continue
+        elapsed = age(entry.path, now)
+        if elapsed is None or elapsed < stale_after:
+            continue
+        target = os.path.join(requests_dir, entry.name)
+        try:
+            os.rename(entry.path, target)
+            os.utime(target)  # restart the pickup clock of the waiting client
+        except FileNotFoundError:
+            continue
+        recovered += 1
+    return recovered
+
+
+class InferenceWorker:
+    """
+    Keeps one VNet resident and serves requests from a queue folder.
+
+    Clients drop requests with `submit`; several pipeline runs can share the
+    same warm model. The forward pass is serialised by a lock while reading
+    and writing patches runs on a thread pool. Claimed requests are touched
+    every HEARTBEAT seconds so clients and other workers can tell a busy
+    worker from a crashed one.
+    """
+
+    def __init__(self, queue_dir, weight_path="./weights/best_model1.pth", threads=2):
+        from utils.vinference import get_device, load_model
+        self.queue_dir = queue_dir
+        self.requests_dir, self.working_dir, self.responses_dir = queue_paths(queue_dir)
+        self.device = get_device()
+        self.model = load_model(self.device, weight_path)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(threads, 1))
+        self.claimed = set()
+        self.claimed_lock = threading.Lock()
+        print(f"Inference worker ready on {self.device}, serving {queue_dir}")
+
+    def handle(self, request):
+        from utils.vinference import infer_file, infer_folder, predict_array
+        import numpy as np
+        kind = request["kind"]
+        if kind == "folder":
+            from utils.vinference import folder_filters
+            skip, store = folder_filters(request["input"], request.get("lungs"), request.get("meta"))
+            return infer_folder(self.model, self.device, request["input"], request["output"], self.lock, skip, store)
+        if kind == "file":
+            infer_file(self.model, self.device, request["input"], request["output"], self.lock)
+            return 1
+        if kind == "array":
+            array = np.load(request["input"])
+            with self.lock:
+                mask = predict_array(self.model, self.device, array)
+            np.save(request["output"], mask)
+            return 1
+        raise ValueError(f"Unknown request kind: {kind}")
+
+    def process(self, working_path):
+        started = time.perf_counter()
+        response = {"status": "ok", "count": 0, "error": None}
+        try:
+            with open(working_path, 'r') as f:
+                request = json.load(f)
+            response["id"] = request["id"]
+            response["count"] = self.handle(request)
+        except Exception as e:
+            response.update({"status": "error", "error": str(e)})
+            print(f"⚠️ Request {os.path.basename(working_path)} failed: {e}")
+        response["seconds"] = time.perf_counter() - started
+        write_json_atomic(os.path.join(self.responses_dir, os.path.basename(working_path)), response)
+        with self.claimed_lock:
+            self.claimed.discard(working_path)
+        withdraw(working_path)
+
+    def heartbeat(self, stopped):
+        """Touch every claimed request until stopped is set."""
+        while not stopped.wait(HEARTBEAT):
+            with self.claimed_lock:
+                claimed = list(self.claimed)
+            for working_path in claimed:
+                try:
+                    os.utime(working_path)
+                except FileNotFoundError:
+                    pass
+
+    def serve(self, poll_interval=0.2, max_requests=None):
+        """Serve until a `stop` file appears in the queue folder or max_requests were claimed."""
+        stop_path = os.path.join(self.queue_dir, STOP_FILE)
+        served = 0
+        stopped = threading.Event()
+        beating = threading.Thread(target=self.heartbeat, args=(stopped,), daemon=True)
+        beating.start()
+        recovered_at = 0
+        try:
+            while max_requests is None or served < max_requests:
+                if os.path.exists(stop_path):
+                    os.remove(stop_path)
+                    break
+                if time.time() - recovered_at > STALE_AFTER:
+                    recovered_at = time.time()
+                    recovered = recover(self.queue_dir)
+                    if recovered:
+                        print(f"Recovered {recovered} requests left in {WORKING}/ by a crashed worker")
+                working_path = claim(self.requests_dir, self.working_dir)
+                if working_path is None:
+                    time.sleep(poll_interval)
+                    continue
+                os.utime(working_path)
+                with self.claimed_lock:
+                    self.claimed.add(working_path)
+                self.executor.submit(self.process, working_path)
+                served += 1
+        finally:
+            self.executor.shutdown(wait=True)
+            stopped.set()
+            beating.join()
+        print(f"Inference worker stopped after {served} requests")
+
+
+def stop(queue_dir):
+    """Ask the worker serving queue_dir to exit once queued requests are handed out."""
+    os.makedirs(queue_dir, exist_ok=True)
+    open(os.path.join(queue_dir, STOP_FILE), 'w').close()
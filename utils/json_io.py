@@ -0,0 +1,11 @@
+import os
+import json
+import uuid
+
+
+def write_json_atomic(path, payload):
+    """Write JSON to a temporary file and rename it, so readers never see a partial file."""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(payload, f)
+    os.replace(tmp_path, path)
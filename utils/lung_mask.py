@@ -0,0 +1,185 @@
+import os
+import json
+import base64
+import numpy as np
+import SimpleITK as sitk
+from scipy import ndimage
+
+LUNGS_NAME = "lungs.json"
+
+
+def segment_lungs(image, coarse_spacing=4.0, threshold=-320, min_fraction=0.1):
+    """
+    Coarse lung mask of a CT from a block-averaged copy of the scan.
+
+    Voxels below threshold HU are air; air components touching the in-plane
+    border are outside the body, of the rest the largest component and every
+    component at least min_fraction of its size are kept (both lungs, unless
+    they are already connected), then closed and hole-filled so vessels and
+    juxtapleural nodules are included.
+
+    Args:
+        image (SimpleITK Image): CT in HU
+        coarse_spacing (float): Target spacing in mm of the downsampled volume
+        threshold (int): Air threshold in HU
+        min_fraction (float): Minimum size of a second lung relative to the largest component
+
+    Returns:
+        (mask, shrink): boolean (z, y, x) mask and the (x, y, z) shrink factors used
+    """
+    shrink = [max(1, int(round(coarse_spacing / spacing))) for spacing in image.GetSpacing()]
+    small = sitk.BinShrink(image, shrink)
+    air = sitk.GetArrayViewFromImage(small) < threshold
+
+    labels, count = ndimage.label(air)
+    if count == 0:
+        return np.zeros(air.shape, dtype=bool), shrink
+    sizes = np.bincount(labels.ravel(), minlength=count + 1)
+    sizes[0] = 0
+    outside = np.unique(np.concatenate([labels[:, 0, :].ravel(), labels[:, -1, :].ravel(),
+                                        labels[:, :, 0].ravel(), labels[:, :, -1].ravel()]))
+    sizes[outside] = 0
+    if sizes.max() == 0:
+        return np.zeros(air.shape, dtype=bool), shrink
+
+    keep = np.flatnonzero(sizes >= max(1, min_fraction * sizes.max()))
+    lungs = np.isin(labels, keep)
+    lungs = ndimage.binary_closing(lungs, iterations=2, border_value=0)
+    lungs = ndimage.binary_fill_holes(lungs)
+    return lungs, shrink
+
+
+def lung_entry(image, lungs, shrink, margin_mm=10.0):
+    """
+    Bounding box (in index space of the full scan) and occupancy grid of a coarse lung mask.
+
+    The occupancy grid is the coarse mask dilated by margin_mm, one cell per
+    shrink block of the scan, bit-packed for the JSON cache.
+    """
+    size = image.GetSize()
+    margin = [int(np.ceil(margin_mm / (image.GetSpacing()[axis] * shrink[axis]))) for axis in range(3)]
+    if lungs.any():
+        occupancy = ndimage.binary_dilation(lungs, structure=np.ones([2 * m + 1 for m in margin[::-1]], dtype=bool))
+        zs, ys, xs = np.nonzero(occupancy)
+        low = [xs.min(), ys.min(), zs.min()]
+        high = [xs.max(), ys.max(), zs.max()]
+        start = [int(low[axis] * shrink[axis]) for axis in range(3)]
+        end = [int(min(size[axis], (high[axis] + 1) * shrink[axis])) for axis in range(3)]
+        # BinShrink drops the last partial block, a box reaching the last cell covers it
+        end = [size[axis] if high[axis] == occupancy.shape[2 - axis] - 1 else end[axis] for axis in range(3)]
+    else:
+        occupancy = lungs
+        start, end = [0, 0, 0], list(size)
+    return {
+        "start_index": start,
+        "extract_size": [end[axis] - start[axis] for axis in range(3)],
+        "found": bool(lungs.any()),
+        "lung_fraction": float(lungs.mean()),
+        "shrink": [int(s) for s in shrink],
+        "grid_shape": list(occupancy.shape),
+        "occupancy": base64.b64encode(np.packbits(occupancy, axis=None).tobytes()).decode("ascii"),
+    }
+
+
+def lung_series(file_path, coarse_spacing=4.0, threshold=-320, margin_mm=10.0):
+    """Segment one scan and return its lungs.json entry."""
+    image = sitk.ReadImage(file_path)
+    lungs, shrink = segment_lungs(image, coarse_spacing, threshold)
+    entry = lung_entry(image, lungs, shrink, margin_mm)
+    print(f"{os.path.basename(file_path)}: lung box {entry['start_index']} + {entry['extract_size']} of {list(image.GetSize())}")
+    return entry
+
+
+def lung_masking(data: dict):
+    """
+    Precomputes the lung box and occupancy grid of every scan into <out>/lungs.json.
+    With data['memory_limit'] (bytes) and data['workers'] scans run in parallel while their estimated footprint fits.
+    """
+    from utils.memory_budget import run_budgeted
+    print(data)
+    DATA_DIR = data['data']
+    OUTPUT_PATH = data['out']
+    os.makedirs(OUTPUT_PATH, exist_ok=True)
+    files = [os.path.join(DATA_DIR, file) for file in os.listdir(DATA_DIR) if file[-4:] == '.mhd']
+    entries = run_budgeted(
+        lambda path: lung_series(path, data.get('coarse_spacing', 4.0), data.get('threshold', -320), data.get('margin', 10.0)),
+        files, "lungs", data.get('memory_limit'), data.get('workers', 1),
+    )
+    lungs = {os.path.basename(path)[:-4]: entry for path, entry in zip(files, entries)}
+    with open(os.path.join(OUTPUT_PATH, LUNGS_NAME), 'w') as f:
+        json.dump(lungs, f)
+
+
+class LungIndex:
+    """
+    Read side of lungs.json: lung boxes and coarse occupancy queries by series uid.
+    Series that are missing from the file, or where no lungs were found, are treated as all lung.
+    """
+
+    def __init__(self, path):
+        with open(path, 'r') as f:
+            self.entries = {uid: entry for uid, entry in json.load(f).items() if entry["found"]}
+        self.grids = {}
+
+    @classmethod
+    def from_entries(cls, entries):
+        """Index over entries of `lung_entry` computed in memory."""
+        index = cls.__new__(cls)
+        index.entries = {uid: entry for uid, entry in entries.items() if entry["found"]}
+        index.grids = {}
+        return index
+
+    def grid(self, uid):
+        """Occupancy grid (z, y, x) of a series, None when unknown."""
+        entry = self.entries.get(uid)
+        if entry is None:
+            return None
+        if uid not in self.grids:
+            shape = entry["grid_shape"]
+            bits = np.frombuffer(base64.b64decode(entry["occupancy"]), dtype=np.uint8)
+            self.grids[uid] = np.unpackbits(bits, count=int(np.prod(shape))).reshape(shape).astype(bool)
+        return self.grids[uid]
+
+    def box(self, uid):
+        """(start_index, extract_size) of the lungs in (x, y, z), None when unknown."""
+        entry = self.entries.get(uid)
+        if entry is None:
+            return None
+        return entry["start_index"], entry["extract_size"]
+
+    def overlaps(self, uid, start_index, extract_size):
+        """True when an index box (x, y, z) touches an occupied cell."""
+        grid = self.grid(uid)
+        if grid is None:
+            return True
+        shrink = self.entries[uid]["shrink"]
+        # clamp to the grid, the partial block BinShrink drops belongs to the last cell
+        last = [grid.shape[2 - axis] - 1 for axis in range(3)]
+        low = [min(last[axis], max(0, int(start_index[axis]) // shrink[axis])) for axis in range(3)]
+        high = [min(last[axis], max(0, (int(start_index[axis]) + int(extract_size[axis]) - 1) // shrink[axis])) for axis in range(3)]
+        return bool(grid[low[2]:high[2] + 1, low[1]:high[1] + 1, low[0]:high[0] + 1].any())
+
+    def cells(self, uid):
+        """(first (x, y, z) index of every occupied cell, cell size), None when unknown."""
+        grid = self.grid(uid)
+        if grid is None:
+            return None
+        shrink = np.array(self.entries[uid]["shrink"])
+        return np.argwhere(grid)[:, ::-1] * shrink, shrink
+
+
+def outside_lungs(lung_index, meta_path):
+    """
+    skip callable for `vinference.infer_folder`: true for patches (`<uid>_<i>.mhd`)
+    whose extraction box does not touch the lung occupancy grid.
+    """
+    from utils.meta_store import read_patch_meta
+    meta = read_patch_meta(meta_path)
+
+    def skip(filename):
+        key = filename[:-4]
+        entry = meta.get(key)
+        if entry is None:
+            return False
+        return not lung_index.overlaps(key.rsplit("_", 1)[0], entry["start_index"], entry["extract_size"])
+    return skip
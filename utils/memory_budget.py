@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MB = 1024 * 1024
+
+# bytes held per byte of the input scan, measured from the arrays each stage keeps
+# alive at its peak; for the DRR stages per byte of the two volumes they hold at 1 mm
+STAGE_FACTORS = {
+    "extract": 1.5,  # image + numpy view + patches
+    "patch": 2.0,    # blank mask array + image built from it for writing
+    "raycast": 1.2,  # resampled image + windowed volume (working dtype) + slabs
+    "max": 1.2,      # resampled mask + its array copy
+    "lungs": 1.2,    # image, the coarse volumes are small
+    "candidates": 2.0,  # image + on-the-fly lung mask, the LoG volumes are coarse
+}
+
+
+def parse_size(text):
+    """Parse a memory size like '8G', '512M' or a plain number of bytes."""
+    text = str(text).strip().upper()
+    units = {"K": 1024, "M": MB, "G": 1024 * MB, "T": 1024 * 1024 * MB}
+    if text[-1:] == "B":
+        text = text[:-1]
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+
+def estimate_footprint(mhd_path, stage, working_itemsize=4):
+    """
+    Estimate the peak memory of one item of a stage from the .mhd header only.
+
+    Args:
+        mhd_path (str): Scan (or full mask) the item works on
+        stage (str): One of STAGE_FACTORS
+        working_itemsize (int): Bytes per voxel of the raycast volume (4 for float32, 2 for float16)
+
+    Returns:
+        Estimated bytes
+    """
+    import numpy as np
+    import SimpleITK as sitk
+    from utils.image_handler import read_header
+    reference, size, _ = read_header(mhd_path)
+    voxels = float(np.prod(size))
+    bytes_per_voxel = sitk.GetArrayViewFromImage(reference).itemsize
+    if stage in ("raycast", "max"):
+        # these stages work on the scan resampled to 1 mm (input dtype); the original is freed before
+        # the working copy (raycast volume, mask array) is made, so the peak holds the larger of the two
+        resampled = float(np.prod(np.array(size) * np.array(reference.GetSpacing())))
+        working = resampled * (working_itemsize if stage == "raycast" else bytes_per_voxel)
+        return int((resampled * bytes_per_voxel + max(voxels * bytes_per_voxel, working)) * STAGE_FACTORS[stage])
+    return int(voxels * bytes_per_voxel * STAGE_FACTORS[stage])
+
+
+def current_rss():
+    """Resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        # ru_maxrss is the peak, not the current RSS, but the best we get without /proc
+        scale = 1 if os.uname().sysname == "Darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class RSSSampler:
+    """
+    Samples the process RSS in the background and tracks the peak of every open window.
+    RSS is process-wide: with items in parallel a window also sees what the others allocate.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.windows = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.update()
+
+    def update(self):
+        rss = current_rss()
+        with self.lock:
+            for window in self.windows.values():
+                window[1] = max(window[1], rss)
+
+    def open(self, key):
+        rss = current_rss()
+        with self.lock:
+            self.windows[key] = [rss, rss]
+
+    def close(self, key):
+        """Returns (baseline, peak): the RSS when the window opened and the highest RSS sampled since."""
+        self.update()
+        with self.lock:
+            return tuple(self.windows.pop(key))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+class MemoryBudget:
+    """
+    Admits work only while the sum of estimated footprints fits the limit.
+    An item larger than the whole budget still runs, but alone.
+    """
+
+    def __init__(self, limit_bytes):
+        self.limit = limit_bytes
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def __repr__(self):
+        return f"MemoryBudget({self.limit / MB:.0f} MB)"
+
+    def acquire(self, amount):
+        with self.condition:
+            self.condition.wait_for(lambda: self.used == 0 or self.used + amount <= self.limit)
+            self.used += amount
+
+    def release(self, amount):
+        with self.condition:
+            self.used -= amount
+            self.condition.notify_all()
+
+
+def run_budgeted(func, items, stage, limit_bytes=None, workers=1, report_path=None, estimate=None, budget=None,
+                 working_itemsize=4):
+    """
+    Run func(item) for every item on a thread pool, admitting items only while
+    their estimated footprints fit limit_bytes, and report the RSS growth of the
+    process while each item ran together with the process peak.
+
+    Args:
+        func (callable): Work for one item, returns its result
+        items (list): Items, usually file paths
+        stage (str): Stage name for estimate_footprint
+        limit_bytes (int): RAM budget, None runs without admission control
+        workers (int): Maximum number of items in flight
+        report_path (str): Optional JSON file for the per-item report
+        estimate (callable): item -> path given to estimate_footprint, defaults to the item
+        budget (MemoryBudget): Budget shared with other concurrent calls, replaces limit_bytes
+        working_itemsize (int): Bytes per voxel of the raycast volume, see estimate_footprint
+
+    Returns:
+        List of results in item order
+    """
+    if budget is None and limit_bytes:
+        budget = MemoryBudget(limit_bytes)
+    report = []
+    report_lock = threading.Lock()
+
+    def run_one(item):
+        footprint = estimate_footprint(estimate(item) if estimate else item, stage, working_itemsize)
+        if budget is not None:
+            budget.acquire(footprint)
+        key = id(item), threading.get_ident()
+        sampler.open(key)
+        started = time.perf_counter()
+        try:
+            return func(item)
+        finally:
+            baseline, peak = sampler.close(key)
+            if budget is not None:
+                budget.release(footprint)
+            entry = {
+                "item": os.path.basename(str(item)),
+                "stage": stage,
+                "estimate_mb": round(footprint / MB, 1),
+                "rss_growth_mb": round((peak - baseline) / MB, 1),
+                "process_peak_rss_mb": round(peak / MB, 1),
+                "seconds": round(time.perf_counter() - started, 2),
+            }
+            print(f"[{stage}] {entry['item']}: estimate {entry['estimate_mb']} MB, RSS growth {entry['rss_growth_mb']} MB "
+                  f"(process peak {entry['process_peak_rss_mb']} MB), {entry['seconds']} s")
+            with report_lock:
+                report.append(entry)
+
+    with RSSSampler() as sampler:
+        if workers <= 1:
+            results = [run_one(item) for item in items]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(run_one, items))
+
+    if report_path:
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=1)
+    return results
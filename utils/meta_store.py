@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+STORE_NAME = "meta.db"
+SERIES = -1  # nodule index of records about a whole series
+INSERT = "INSERT INTO records (stage, seriesuid, nodule, status, payload, created) VALUES (?, ?, ?, ?, ?, ?)"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stage TEXT NOT NULL,
+    seriesuid TEXT NOT NULL,
+    nodule INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    payload TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_key ON records (stage, seriesuid, nodule, id);
+"""
+
+
+def is_store(path):
+    """True for a metadata store path (.db), False for a meta.json."""
+    return bool(path) and str(path).endswith(".db")
+
+
+def split_key(key):
+    """`<uid>_<i>` -> (uid, i); keys without an index belong to the whole series."""
+    uid, _, index = key.rpartition("_")
+    if uid and index.isdigit():
+        return uid, int(index)
+    return key, SERIES
+
+
+def record_rows(stage, records):
+    """INSERT rows of (seriesuid, nodule, status, payload) records."""
+    now = time.time()
+    return [(stage, uid, int(nodule), status, None if payload is None else json.dumps(payload), now)
+            for uid, nodule, status, payload in records]
+
+
+class MetaStore:
+    """
+    Append-only metadata of every stage in one SQLite file.
+
+    Each record is (stage, seriesuid, nodule, status, payload); nodule is -1
+    for records about a whole series. Records are never updated, the latest
+    record of a (stage, seriesuid, nodule) key wins, so re-running a stage
+    simply appends; nodules a re-run no longer produces get a "superseded" record. Parallel threads and processes on one machine can write
+    concurrently (WAL journal, one connection per thread); keep the file on a
+    local disk, SQLite locking is not reliable on network filesystems.
+
+    Args:
+        path (str): Store file, created with its schema when missing
+        readonly (bool): Open an existing store read-only instead (FileNotFoundError when missing)
+    """
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self.local = threading.local()
+        if readonly:
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f"Metadata store not found: {path}")
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self.connection() as connection:
+            connection.executescript(SCHEMA)
+
+    def connection(self):
+        """The connection of the calling thread."""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            if self.readonly:
+                connection = sqlite3.connect(f"file:{os.path.abspath(self.path)}?mode=ro", uri=True, timeout=60)
+            else:
+                connection = sqlite3.connect(self.path, timeout=60)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def append(self, stage, records):
+        """
+        Append records in one transaction.
+
+        Args:
+            stage (str): Stage name such as "extract", "infer", "patch" or "drr"
+            records (iterable): (seriesuid, nodule, status, payload) tuples, payload is JSON-serialisable or None
+        """
+        rows = record_rows(stage, records)
+        if not rows:
+            return
+        with self.connection() as connection:
+            connection.executemany(INSERT, rows)
+
+    def record(self, stage, seriesuid, nodule=SERIES, status="done", payload=None):
+        """Append a single record."""
+        self.append(stage, [(seriesuid, nodule, status, payload)])
+
+    def latest(self, stage, status=None, seriesuid=None):
+        """Latest (seriesuid, nodule, status, payload) of every key of a stage, optionally filtered."""
+        query = ("SELECT seriesuid, nodule, status, payload FROM records WHERE id IN "
+                 "(SELECT MAX(id) FROM records WHERE stage = ?" + (" AND seriesuid = ?" if seriesuid else "") +
+                 " GROUP BY seriesuid, nodule)")
+        params = [stage] + ([seriesuid] if seriesuid else [])
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        rows = self.connection().execute(query + " ORDER BY seriesuid, nodule", params).fetchall()
+        return [(uid, nodule, state, None if payload is None else json.loads(payload)) for uid, nodule, state, payload in rows]
+
+    def supersede(self, stage, seriesuid, count):
+        """
+        Tombstone the nodule records of a series from index count on, so a re-run
+        that produced fewer nodules does not leave the old ones "done".
+
+        The read and the tombstones run in one write transaction, so records
+        another process appends meanwhile are either seen or written after them.
+
+        Returns:
+            Number of records superseded
+        """
+        connection = self.connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            stale = [nodule for _, nodule, status, _ in self.latest(stage, seriesuid=seriesuid)
+                     if nodule >= count and status != "superseded"]
+            connection.executemany(INSERT, record_rows(stage, [(seriesuid, nodule, "superseded", None) for nodule in stale]))
+        return len(stale)
+
+    def patch_meta(self, stage="extract"):
+        """Extracted patches in the meta.json layout: {"<uid>_<i>": {start_index, extract_size, ...}}."""
+        return {f"{uid}_{nodule}": payload for uid, nodule, _, payload in self.latest(stage, "done")}
+
+    def series(self, stage, status):
+        """Series uids whose latest series record of a stage has status."""
+        return {uid for uid, nodule, _, _ in self.latest(stage, status) if nodule == SERIES}
+
+    def summary(self):
+        """{stage: {status: count}} over the latest records."""
+        rows = self.connection().execute(
+            "SELECT stage, status, COUNT(*) FROM records WHERE id IN "
+            "(SELECT MAX(id) FROM records GROUP BY stage, seriesuid, nodule) GROUP BY stage, status ORDER BY stage, status").fetchall()
+        summary = {}
+        for stage, status, count in rows:
+            summary.setdefault(stage, {})[status] = count
+        return summary
+
+    def close(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+def default_store(store_path, root):
+    """The store a stage records into: store_path when it is a meta.db, else meta.db in root (the run's output root)."""
+    return store_path if is_store(store_path) else os.path.join(root, STORE_NAME)
+
+
+def report_dir(store_path, root):
+    """Folder of a stage's reports (qc.csv, memory reports): next to the run's meta.db, else root."""
+    return os.path.dirname(os.path.abspath(store_path)) if is_store(store_path) else root
+
+
+def open_store(path, create=True):
+    """
+    MetaStore for a .db path, None for meta.json paths (and None).
+    Without create the store must already exist (FileNotFoundError), for stages
+    that add to the records of earlier ones, so a mistyped path is not a new empty store.
+    """
+    if not is_store(path):
+        return None
+    if not create and not os.path.isfile(path):
+        raise FileNotFoundError(f"Metadata store not found: {path}")
+    return MetaStore(path)
+
+
+def read_patch_meta(path, stage="extract"):
+    """Extraction metadata `{"<uid>_<i>": {...}}` from a meta.json or a store."""
+    if is_store(path):
+        return MetaStore(path, readonly=True).patch_meta(stage)
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def read_empty_series(path):
+    """Series without any nodule mask: the keys of the full mask meta.json, or the "empty" patch records of a store."""
+    if is_store(path):
+        return MetaStore(path, readonly=True).series("patch", "empty")
+    with open(path, 'r') as f:
+        return set(json.load(f).keys())
+
+
+def export_json(store, stage, path):
+    """
+    Write one stage of a store in its legacy meta.json layout, for tools that still read JSON.
+    Extraction stages give {"<uid>_<i>": {...}}, "patch" gives the empty series {uid: True},
+    other stages {"<uid>[_<i>]": status}.
+    """
+    if stage.startswith("extract"):
+        payload = store.patch_meta(stage)
+    elif stage == "patch":
+        payload = {uid: True for uid in store.series("patch", "empty")}
+    else:
+        payload = {uid if nodule == SERIES else f"{uid}_{nodule}": status for uid, nodule, status, _ in store.latest(stage)}
+    with open(path, 'w') as f:
+        json.dump(payload, f)
+    return len(payload)
@@ -4,74 +4,288 @@ import pandas as pd
 import numpy as np
 import os
 from tqdm import tqdm
-import json
+from utils.meta_store import default_store, export_json, open_store, read_patch_meta, report_dir
+
+def extract_series(file_path, coord_rows, output_path, cube_dimensions=(50, 50, 50), spacing=None, pad=False, store=None):
+    """
+    Extracts the patches of one CT for its annotation rows and returns their meta entries.
+    The scan is read once; with pad every patch is padded to cube_dimensions.
+    With a MetaStore every patch is recorded as "done" or "failed" under the "extract" stage,
+    patches of an earlier run beyond the current annotation count as "superseded".
+    """
+    file = os.path.basename(file_path)
+    meta_data = {}
+    if not len(coord_rows):
+        if store is not None:
+            store.supersede("extract", file[:-4], 0)
+        return meta_data
+    image = sitk.ReadImage(file_path)
+    world_coords = coord_rows.iloc[:, 1:4].to_numpy(dtype=np.float64)
+
+    if spacing:
+        affine = image_handler.series_affine(image)
+        results = [image_handler.resample_cube(image, tuple(coord), cube_dimensions, spacing, affine) for coord in world_coords]
+    else:
+        cubes, (start_index, extract_size, pad_before, _) = image_handler.extract_cubes(image, world_coords, cube_dimensions, pad)
+        results = [(cube, start.tolist(), size.tolist(), None) for cube, start, size in zip(cubes, start_index, extract_size)]
+
+    for index, (patch, start_index, extract_size, transform) in enumerate(results):
+        key = file[:-4]+"_"+str(index)
+        path = os.path.join(output_path, key+".mhd")
+        
+        try:
+            sitk.WriteImage(patch, path)
+            meta_data[key] = {"start_index": start_index, "extract_size": extract_size, "world_coord": world_coords[index].tolist()}
+            if coord_rows.shape[1] > 4:
+                meta_data[key]["diameter_mm"] = float(coord_rows.iloc[index, 4])
+            if transform is not None:
+                meta_data[key]["transform"] = transform
+            if pad and not spacing:
+                meta_data[key]["pad_before"] = pad_before[index].tolist()
+        except RuntimeError as e:
+            print(f"{file} - {index}: One patch failed")
+            print(e)
+    if store is not None:
+        store.append("extract", [(file[:-4], index, "done" if f"{file[:-4]}_{index}" in meta_data else "failed", meta_data.get(f"{file[:-4]}_{index}"))
+                                 for index in range(len(results))])
+        store.supersede("extract", file[:-4], len(results))
+    return meta_data
 
 def extracting(data: dict):
+    """
+    Extracts the 50^3 patches of every annotated scan. With data['memory_limit'] (bytes)
+    and data['workers'] scans run in parallel while their estimated footprint fits;
+    data['memory_budget'] (a MemoryBudget) shares one limit between concurrent calls.
+    The patches are recorded in data['store'] (default: meta.db in the parent of data['out']) as each
+    scan finishes; data['export_json'] also writes them to <out>/meta.json for tools that still read JSON.
+    memory_report_extract.json goes to data['reports'] (default: next to the meta.db).
+    """
+    from utils.memory_budget import run_budgeted
     print(data)
     DATA_DIR = data['data']
     CSV_PATH = data['csv']
     OUTPUT_PATH = data['out']
     annots = pd.read_csv(CSV_PATH)
-    files = [file for file in os.listdir(DATA_DIR) if file[-4:] == '.mhd']
+    SPACING = data.get('spacing')
+    PAD = data.get('pad', False)
+    ROOT = os.path.dirname(os.path.abspath(OUTPUT_PATH))
+    STORE_PATH = default_store(data.get('store'), ROOT)
+    STORE = open_store(STORE_PATH)
+    REPORT_DIR = data.get('reports') or report_dir(STORE_PATH, ROOT)
+    files = [os.path.join(DATA_DIR, file) for file in os.listdir(DATA_DIR) if file[-4:] == '.mhd']
     cube_dimensions = (50, 50, 50)
-    meta_data = {}
+    run_budgeted(
+        lambda path: extract_series(path, annots[annots['seriesuid']==os.path.basename(path)[:-4]], OUTPUT_PATH, cube_dimensions, SPACING, PAD, STORE),
+        files, "extract", data.get('memory_limit'), data.get('workers', 1),
+        os.path.join(REPORT_DIR, "memory_report_extract.json"), budget=data.get('memory_budget'),
+    )
+    if data.get('export_json'):
+        export_json(STORE, "extract", os.path.join(OUTPUT_PATH, "meta.json"))
+
+def spec_cube_size(spec, spacing, diameter_mm):
+    """Voxel size of a cube for one spec, optionally grown to diameter_scale * diameter_mm."""
+    size = list(spec.get('size', (50, 50, 50)))
+    scale = spec.get('diameter_scale')
+    if scale and diameter_mm:
+        size = [max(size[i], int(np.ceil(scale * diameter_mm / spacing[i]))) for i in range(3)]
+    return size
+
+def cut_spec_cube(image, world_coord, spec, diameter_mm, affine=None):
+    """Cut one cube for a spec, resampling to spec['spacing'] mm when given; returns a transform for resampled cubes."""
+    if spec.get('spacing'):
+        iso = [spec['spacing']] * 3
+        size = spec_cube_size(spec, iso, diameter_mm)
+        return image_handler.resample_cube(image, world_coord, size, spec['spacing'], affine)
+    size = spec_cube_size(spec, image.GetSpacing(), diameter_mm)
+    return (*image_handler.extract_cube_from_image(image, world_coord, size), None)
+
+def random_negatives(image, positives, count, min_distance, rng, cells=None):
+    """
+    Random world coordinates inside the scan at least min_distance mm away from every nodule.
+    With cells (occupied lung cells and their size, see LungIndex.cells) they are drawn inside the lungs.
+    """
+    img_size = np.array(image.GetSize())
+    negatives = []
+    attempts = 0
+    while len(negatives) < count and attempts < count * 100:
+        attempts += 1
+        if cells is not None:
+            origins, cell_size = cells
+            index = origins[rng.integers(len(origins))] + rng.integers(0, cell_size)
+            index = [int(i) for i in np.minimum(index, img_size - 1)]
+        else:
+            index = [int(i) for i in rng.integers(0, img_size)]
+        point = np.array(image.TransformIndexToPhysicalPoint(index))
+        if all(np.linalg.norm(point - np.array(p)) >= min_distance for p in positives):
+            negatives.append(tuple(point))
+    return negatives
+
+def extracting_multi(data: dict):
+    """
+    Extracts patches for several specs from a single read of every CT.
+
+    data['specs'] is a list of dicts with keys:
+      name           : output sub folder (required)
+      size           : cube size in voxels (x, y, z), default (50, 50, 50)
+      spacing        : isotropic spacing in mm, resamples the cube when set
+      diameter_scale : grow the cube to diameter_scale * diameter_mm
+      jitter         : max random offset of the centre in mm
+      negatives      : number of random background cubes per scan
+      seed           : random seed, default 0
+    Each spec gets its own folder and records its provenance under stage "extract/<name>" of
+    data['store'] (default: meta.db in the parent of data['out']); data['export_json'] also
+    writes <out>/<name>/meta.json.
+    With data['lungs'] (lungs.json of the lung stage) negatives are only drawn inside the lung occupancy grid.
+    """
+    print(data)
+    DATA_DIR = data['data']
+    CSV_PATH = data['csv']
+    OUTPUT_PATH = data['out']
+    specs = data['specs']
+    STORE = open_store(default_store(data.get('store'), os.path.dirname(os.path.abspath(OUTPUT_PATH))))
+    annots = pd.read_csv(CSV_PATH)
+    files = [file for file in os.listdir(DATA_DIR) if file[-4:] == '.mhd']
+    lungs = None
+    if data.get('lungs'):
+        from utils.lung_mask import LungIndex
+        lungs = LungIndex(data['lungs'])
+
+    rngs = {spec['name']: np.random.default_rng(spec.get('seed', 0)) for spec in specs}
+    for spec in specs:
+        os.makedirs(os.path.join(OUTPUT_PATH, spec['name']), exist_ok=True)
+
     for file in tqdm(files):
+        image = sitk.ReadImage(os.path.join(DATA_DIR, file))
+        affine = image_handler.series_affine(image)
         coord_rows = annots[annots['seriesuid']==file[:-4]]
+        positives = [(tuple(row[1:4]), row[4]) for row in coord_rows.itertuples(index=False)]
+        cells = lungs.cells(file[:-4]) if lungs is not None else None
 
-        for index, row in enumerate(coord_rows.iterrows()):
-            x,y,z = row[1][1:4]
-
-            patch, start_index, extract_size = image_handler.extract_cube(
-                os.path.join(DATA_DIR, file),
-                (x, y, z),
-                cube_dimensions
-                )
-            path = os.path.join(OUTPUT_PATH, file[:-4]+"_"+str(index)+".mhd")
-            
-            try:
-                sitk.WriteImage(patch, path)
-                meta_data[file[:-4]+"_"+str(index)] = {"start_index": start_index, "extract_size": extract_size}
-            except RuntimeError as e:
-                print(f"{file} - {index}: One patch failed")
-                print(e)
-    with open(os.path.join(OUTPUT_PATH, "meta.json"), 'w') as f:
-        json.dump(meta_data, f)
+        for spec in specs:
+            rng = rngs[spec['name']]
+            jitter = spec.get('jitter', 0)
+            samples = []
+            for world_coord, diameter_mm in positives:
+                offset = rng.uniform(-jitter, jitter, 3) if jitter else np.zeros(3)
+                samples.append((tuple(np.array(world_coord) + offset), world_coord, diameter_mm, offset, False))
+            size = spec.get('size', (50, 50, 50))
+            min_distance = max(size[i] * image.GetSpacing()[i] for i in range(3)) / 2
+            for world_coord in random_negatives(image, [p[0] for p in positives], spec.get('negatives', 0), min_distance, rng, cells):
+                samples.append((world_coord, world_coord, None, np.zeros(3), True))
+
+            for index, (centre, world_coord, diameter_mm, offset, negative) in enumerate(samples):
+                key = file[:-4]+"_"+str(index)
+                path = os.path.join(OUTPUT_PATH, spec['name'], key+".mhd")
+                try:
+                    patch, start_index, extract_size, transform = cut_spec_cube(image, centre, spec, diameter_mm, affine)
+                    sitk.WriteImage(patch, path)
+                except RuntimeError as e:
+                    print(f"{file} - {index}: One patch failed")
+                    print(e)
+                    STORE.record("extract/" + spec['name'], file[:-4], index, "failed")
+                    continue
+                STORE.record("extract/" + spec['name'], file[:-4], index, "done", {
+                    "start_index": start_index,
+                    "extract_size": extract_size,
+                    "transform": transform,
+                    "source": file,
+                    "world_coord": [float(c) for c in world_coord],
+                    "jitter_mm": [float(o) for o in offset],
+                    "diameter_mm": None if diameter_mm is None else float(diameter_mm),
+                    "negative": negative,
+                    "spec": spec,
+                })
+            STORE.supersede("extract/" + spec['name'], file[:-4], len(samples))
+
+    if data.get('export_json'):
+        for spec in specs:
+            export_json(STORE, "extract/" + spec['name'], os.path.join(OUTPUT_PATH, spec['name'], "meta.json"))
+
+def patch_series(parent_path, seg_files, meta, ref_dir, output_dir, qc=None):
+    """
+    Pastes every predicted cube of one scan into a blank mask and writes it.
+    Only the header of the scan is read; returns True when the scan had no cube.
+    Cubes without an entry in meta (superseded nodules of an earlier run) are skipped with a warning.
+    With a QCTable the mask volume, empty and border-clipped cubes are recorded from the cubes in memory.
+    """
+    from utils.qc import patch_qc, series_patch_qc
+    parent = os.path.basename(parent_path)
+    children = [child for child in seg_files if parent[:-4] in child]
+    # masks of nodules a re-run of the extraction superseded have no meta anymore
+    stale = [child for child in children if child[:-4] not in meta]
+    if stale:
+        print(f"Warning: {parent}: skipping {len(stale)} mask(s) without extraction meta (superseded?): {', '.join(sorted(stale))}")
+        children = [child for child in children if child[:-4] in meta]
+    if not children:
+        if qc is not None:
+            qc.add(parent[:-4], **series_patch_qc([]))
+        return True
+
+    reference, size, _ = image_handler.read_header(parent_path)
+    blank_array = np.zeros(size[::-1], dtype=sitk.GetArrayViewFromImage(reference).dtype)
+    cubes_qc = []
+    for index, child in enumerate(children):
+        cube = sitk.ReadImage(os.path.join(ref_dir, child))
+        child_meta = meta[child[:-4]]
+        if qc is not None:
+            cubes_qc.append(patch_qc(sitk.GetArrayViewFromImage(cube), cube.GetSpacing(), child_meta, size))
+        start_index = child_meta['start_index']
+        try:
+            image_handler.paste_cube(blank_array, reference, cube, start_index, child_meta.get('transform'), child_meta['extract_size'], child_meta.get('pad_before'))
+        except ValueError as e:
+            print(f"Warning: Node - {index} @ {parent} failed to patch")
+    if qc is not None:
+        qc.add(parent[:-4], **series_patch_qc(cubes_qc))
+
+    blank_image = sitk.GetImageFromArray(blank_array)
+    del blank_array
+    blank_image.SetSpacing(reference.GetSpacing())
+    blank_image.SetDirection(reference.GetDirection())
+    blank_image.SetOrigin(reference.GetOrigin())
+    out_path = os.path.join(output_dir, parent)
+    sitk.WriteImage(blank_image, f"{out_path}.mhd")
+    return False
 
 def patching(data: dict):
+    """
+    Builds the full-size masks of every scan. With data['memory_limit'] (bytes)
+    and data['workers'] scans run in parallel while their estimated footprint fits;
+    data['memory_budget'] (a MemoryBudget) shares one limit between concurrent calls.
+    data['meta'] is the extraction meta.json or meta.db. Every series is recorded as "done" or "empty"
+    in data['store'], else data['meta'] when it is a meta.db, else meta.db in the parent of data['out'];
+    data['export_json'] also writes the empty series to <out>/meta.json.
+    Per-series mask QC is merged into data['qc'] (default qc.csv) and memory_report_patch.json is written,
+    both in data['reports'] (default: next to the meta.db), see utils.qc.
+    """
+    from utils.memory_budget import run_budgeted
+    from utils.qc import QCTable, QC_NAME
     print(data)
     DATA_DIR = data['data']
     META_PATH = data['meta']
     OUTPUT_DIR = data['out']
     REF_DIR = data['ref']
 
-    with open(META_PATH, 'r') as f:
-        meta = json.load(f)
+    meta = read_patch_meta(META_PATH)
+    ROOT = os.path.dirname(os.path.abspath(OUTPUT_DIR))
+    STORE_PATH = default_store(data.get('store') or META_PATH, ROOT)
+    # the extraction store must exist, a new one is only created next to a meta.json input
+    STORE = open_store(STORE_PATH, create=STORE_PATH != META_PATH)
+    REPORT_DIR = data.get('reports') or report_dir(STORE_PATH, ROOT)
+    QC = QCTable(data.get('qc') or os.path.join(REPORT_DIR, QC_NAME))
     
-    parent_files = [file for file in os.listdir(DATA_DIR) if file[-4:] == '.mhd']
+    parent_files = [os.path.join(DATA_DIR, file) for file in os.listdir(DATA_DIR) if file[-4:] == '.mhd']
     seg_files = [file for file in os.listdir(REF_DIR) if file[-4:] == '.mhd']
-    data = {}
-
-    for parent in tqdm(parent_files):
-        parent_image = sitk.ReadImage(os.path.join(DATA_DIR, parent))
-        blank_array = np.zeros_like(sitk.GetArrayFromImage(parent_image))
-        blank_image = sitk.GetImageFromArray(blank_array)
-        blank_image.CopyInformation(parent_image)
-        empty = True
-        for index, child in enumerate(seg_files):
-            if parent[:-4] not in child:
-                continue
-            empty = False
-            cube = sitk.ReadImage(os.path.join(REF_DIR, child))
-            start_index = meta[child[:-4]]['start_index']
-            try:
-                blank_image = image_handler.patch_cube(blank_image, cube, start_index)
-            except ValueError as e:
-                print(f"Warning: Node - {index} @ {parent} failed to patch")
-        if empty:
-            data['.'.join(parent.split('.')[:-1])] = True
-            continue
-        out_path = os.path.join(OUTPUT_DIR, parent)
-        sitk.WriteImage(blank_image, f"{out_path}.mhd")
-    with open(os.path.join(OUTPUT_DIR, "meta.json"), 'w') as f:
-        json.dump(data, f)
 
+    def patch_and_record(parent):
+        empty = patch_series(parent, seg_files, meta, REF_DIR, OUTPUT_DIR, QC)
+        STORE.record("patch", os.path.basename(parent)[:-4], status="empty" if empty else "done")
+        return empty
+
+    run_budgeted(
+        patch_and_record,
+        parent_files, "patch", data.get('memory_limit'), data.get('workers', 1),
+        os.path.join(REPORT_DIR, "memory_report_patch.json"), budget=data.get('memory_budget'),
+    )
+    QC.save()
+    if data.get('export_json'):
+        export_json(STORE, "patch", os.path.join(OUTPUT_DIR, "meta.json"))
@@ -0,0 +1,115 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+QC_NAME = "qc.csv"
+
+
+def sphere_volume(diameter_mm):
+    """Volume in mm³ of a ball of the annotated diameter."""
+    return np.pi / 6 * diameter_mm ** 3
+
+
+def touches_border(start_index, extract_size, image_size):
+    """True when an index box (x, y, z) reaches the edge of the scan, i.e. the cube may have been clipped."""
+    return any(start <= 0 or start + size >= limit for start, size, limit in zip(start_index, extract_size, image_size))
+
+
+def patch_qc(mask, spacing, entry, image_size):
+    """
+    QC of one predicted cube while it is pasted.
+
+    Args:
+        mask (ndarray): Cube mask (z, y, x), already in memory
+        spacing (tuple): Cube spacing in mm
+        entry (dict): Extraction meta of the cube (start_index, extract_size, optional diameter_mm / pad_before)
+        image_size (tuple): Size of the scan (x, y, z)
+    """
+    voxels = int(np.count_nonzero(mask))
+    diameter = entry.get("diameter_mm")
+    return {
+        "voxels": voxels,
+        "volume_mm3": voxels * float(np.prod(spacing)),
+        "expected_mm3": sphere_volume(diameter) if diameter else None,
+        "clipped": bool(any(entry.get("pad_before") or [])) or touches_border(entry["start_index"], entry["extract_size"], image_size),
+    }
+
+
+def series_patch_qc(patches):
+    """Per-series columns from the `patch_qc` rows of its cubes; volume_ratio is predicted over annotated volume."""
+    ratios = [patch["volume_mm3"] / patch["expected_mm3"] for patch in patches if patch["expected_mm3"]]
+    return {
+        "patches": len(patches),
+        "empty_patches": sum(patch["voxels"] == 0 for patch in patches),
+        "clipped_patches": sum(patch["clipped"] for patch in patches),
+        "mask_voxels": sum(patch["voxels"] for patch in patches),
+        "mask_volume_mm3": sum(patch["volume_mm3"] for patch in patches),
+        "nodule_volume_mm3": sum(patch["expected_mm3"] or 0 for patch in patches),
+        "volume_ratio_min": min(ratios) if ratios else float("nan"),
+        "volume_ratio_max": max(ratios) if ratios else float("nan"),
+    }
+
+
+def drr_stats(drr, prefix):
+    """
+    Intensity statistics of a rendered DRR on the 0-255 scale (float DRRs in [0, 1] are scaled).
+    <prefix>_constant flags a flat image, e.g. a projection whose normalisation range was zero.
+    """
+    scale = 255.0 if drr.dtype.kind == "f" else 1.0
+    lo, hi = float(drr.min()) * scale, float(drr.max()) * scale
+    return {
+        f"{prefix}_min": lo,
+        f"{prefix}_max": hi,
+        f"{prefix}_mean": float(drr.mean()) * scale,
+        f"{prefix}_std": float(drr.std()) * scale,
+        f"{prefix}_constant": hi == lo,
+    }
+
+
+# columns that mark a series as suspicious, with the test applied to them
+CHECKS = {
+    "empty_patches": lambda value: value > 0,
+    "clipped_patches": lambda value: value > 0,
+    "xray_constant": lambda value: str(value) == "True",
+    "mask_constant": lambda value: str(value) == "True",
+}
+
+
+class QCTable:
+    """
+    Per-series QC columns collected while a stage runs, merged into one CSV at the end.
+
+    Stages add their own columns; rows already in the file keep the columns of
+    other stages, so patching and DRR rendering can share one table.
+
+    Args:
+        path (str): QC table (.csv)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.rows = {}
+
+    def add(self, uid, **columns):
+        with self.lock:
+            self.rows.setdefault(uid, {}).update(columns)
+
+    def save(self):
+        """Merge the collected rows into the table and print the flagged series."""
+        with self.lock:
+            if not self.rows:
+                return
+            table = pd.DataFrame.from_dict(self.rows, orient="index")
+        table.index.name = "seriesuid"
+        if os.path.exists(self.path):
+            table = table.combine_first(pd.read_csv(self.path, index_col="seriesuid", dtype={"seriesuid": str}))
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temporary = f"{self.path}.tmp"
+        table.sort_index().to_csv(temporary)
+        os.replace(temporary, self.path)
+
+        flagged = {column: int(table[column].map(check).sum()) for column, check in CHECKS.items() if column in table}
+        flagged = {column: count for column, count in flagged.items() if count}
+        print(f"QC: {len(table)} series in {self.path}" + (f", flagged {flagged}" if flagged else ""))
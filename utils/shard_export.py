@@ -0,0 +1,195 @@
+import SimpleITK as sitk
+import numpy as np
+import tarfile
+import json
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from utils.meta_store import read_patch_meta
+from utils.drr_writer import FORMATS
+
+INDEX_NAME = "index.json"
+DRR_KINDS = ("drr", "drr_mask")
+# DRRs keep the extension of the format drrer.py wrote them in, e.g. <key>.drr.webp
+MEMBER_KINDS = ("patch.npy", "mask.npy", *(f"{name}{ext}" for name in DRR_KINDS for ext in FORMATS.values()), "json")
+
+
+def split_member(name):
+    """Split a member name into (sample key, kind); keys contain dots so match known suffixes."""
+    for kind in MEMBER_KINDS:
+        if name.endswith(f".{kind}"):
+            return name[:-len(kind) - 1], kind
+    raise ValueError(f"Unknown shard member: {name}")
+
+
+def array_to_npy_bytes(array):
+    """Serialize a numpy array to .npy bytes."""
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def npy_bytes_to_array(payload):
+    """Deserialize .npy bytes back to a numpy array."""
+    return np.load(io.BytesIO(payload), allow_pickle=False)
+
+
+def find_drr(folder, uid):
+    """DRR of a series in any DRRWriter format (the newest if several were rendered), None when missing."""
+    paths = [path for path in (os.path.join(folder, uid + ext) for ext in FORMATS.values()) if os.path.exists(path)]
+    return max(paths, key=os.path.getmtime) if paths else None
+
+
+def collect_samples(data: dict):
+    """
+    Pair every extracted patch with its predicted mask, DRRs and metadata.
+
+    Args:
+        data (dict): {"patch": patch_dataset dir, "mask": infered_dataset dir,
+                      "xray": xray_dataset dir, "meta": patch meta.json or meta.db}
+
+    Returns:
+        List of sample descriptions, one per nodule, sorted by key
+    """
+    meta = read_patch_meta(data['meta'])
+
+    samples = []
+    drrs = {}
+    for key in sorted(meta):
+        patch_path = os.path.join(data['patch'], f"{key}.mhd")
+        if not os.path.exists(patch_path):
+            continue
+        uid = key.rsplit("_", 1)[0]
+        if uid not in drrs:
+            drrs[uid] = (find_drr(os.path.join(data['xray'], "full_ct_xray"), uid),
+                         find_drr(os.path.join(data['xray'], "full_ct_mask"), uid))
+        samples.append({
+            "key": key,
+            "uid": uid,
+            "patch": patch_path,
+            "mask": os.path.join(data['mask'], f"{key}.mhd"),
+            "drr": drrs[uid][0],
+            "drr_mask": drrs[uid][1],
+            "meta": meta[key],
+        })
+    return samples
+
+
+def sample_members(sample):
+    """Build the (member name, bytes) pairs stored in a shard for one sample."""
+    patch_image = sitk.ReadImage(sample['patch'])
+    info = dict(sample['meta'])
+    info.update({
+        "seriesuid": sample['uid'],
+        "spacing": list(patch_image.GetSpacing()),
+        "origin": list(patch_image.GetOrigin()),
+        "direction": list(patch_image.GetDirection()),
+    })
+    members = [(f"{sample['key']}.patch.npy", array_to_npy_bytes(sitk.GetArrayFromImage(patch_image)))]
+    if os.path.exists(sample['mask']):
+        mask_array = sitk.GetArrayFromImage(sitk.ReadImage(sample['mask'])).astype(np.uint8)
+        members.append((f"{sample['key']}.mask.npy", array_to_npy_bytes(mask_array)))
+    for name in DRR_KINDS:
+        if sample[name] is not None:
+            with open(sample[name], 'rb') as f:
+                members.append((f"{sample['key']}.{name}{os.path.splitext(sample[name])[1]}", f.read()))
+    members.append((f"{sample['key']}.json", json.dumps(info).encode()))
+    return members
+
+
+def write_shard(shard_path, samples):
+    """
+    Write one tar shard in WebDataset layout and return its index entries.
+
+    Every member's data offset and size are recorded so readers can seek
+    straight to a single sample without scanning the archive.
+    """
+    entries = {}
+    with tarfile.open(shard_path, 'w') as tar:
+        for sample in samples:
+            members = {}
+            for name, payload in sample_members(sample):
+                tar_info = tarfile.TarInfo(name)
+                tar_info.size = len(payload)
+                offset_data = tar.offset + len(tar_info.tobuf(tar.format, tar.encoding, tar.errors))
+                tar.addfile(tar_info, io.BytesIO(payload))
+                members[split_member(name)[1]] = [offset_data, tar_info.size]
+            entries[sample['key']] = {"shard": os.path.basename(shard_path), "members": members}
+    return entries
+
+
+def export_shards(data: dict):
+    """
+    Pack paired (patch, mask, DRR, metadata) samples into fixed-size tar shards.
+
+    Args:
+        data (dict): collect_samples keys plus "out" (output dir),
+                     "shard_size" (samples per shard) and "workers"
+    """
+    print(data)
+    OUTPUT_DIR = data['out']
+    shard_size = data.get('shard_size', 256)
+    workers = data.get('workers', 4)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    samples = collect_samples(data)
+    chunks = [samples[i:i + shard_size] for i in range(0, len(samples), shard_size)]
+    shard_paths = [os.path.join(OUTPUT_DIR, f"shard-{i:06d}.tar") for i in range(len(chunks))]
+
+    index = {"shard_size": shard_size, "shards": [os.path.basename(p) for p in shard_paths], "samples": {}}
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for entries in tqdm(executor.map(write_shard, shard_paths, chunks), total=len(chunks)):
+            index["samples"].update(entries)
+
+    with open(os.path.join(OUTPUT_DIR, INDEX_NAME), 'w') as f:
+        json.dump(index, f)
+    print(f"Wrote {len(samples)} samples into {len(chunks)} shards in {OUTPUT_DIR}")
+
+
+def decode_member(kind, payload):
+    """Decode a stored member by its suffix."""
+    if kind.endswith('.npy'):
+        return npy_bytes_to_array(payload)
+    if kind == 'json':
+        return json.loads(payload)
+    return payload
+
+
+class ShardReader:
+    """Random-access and streaming reader for shards written by `export_shards`."""
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, INDEX_NAME), 'r') as f:
+            self.index = json.load(f)
+        self.keys = sorted(self.index["samples"])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            key = self.keys[key]
+        entry = self.index["samples"][key]
+        sample = {"key": key}
+        with open(os.path.join(self.shard_dir, entry["shard"]), 'rb') as f:
+            for kind, (offset, size) in entry["members"].items():
+                f.seek(offset)
+                sample[kind] = decode_member(kind, f.read(size))
+        return sample
+
+    def stream(self, shards=None):
+        """Yield samples shard by shard with sequential reads only."""
+        for shard in shards or self.index["shards"]:
+            sample = None
+            with tarfile.open(os.path.join(self.shard_dir, shard), 'r|') as tar:
+                for member in tar:
+                    key, kind = split_member(member.name)
+                    if sample is None or sample["key"] != key:
+                        if sample is not None:
+                            yield sample
+                        sample = {"key": key}
+                    sample[kind] = decode_member(kind, tar.extractfile(member).read())
+            if sample is not None:
+                yield sample
@@ -1,11 +1,13 @@
 import os
 import glob
+from contextlib import nullcontext
 import torch
 import SimpleITK as sitk
 import numpy as np
 from tqdm import tqdm
 import torch.nn as nn
 import torch.nn.functional as F
+from utils.meta_store import split_key
  
 
 # Define ResidualBlock and VNet classes (unchanged from your provided code)
@@ -112,9 +114,32 @@ class VNet(nn.Module):
 
 
 
+def folder_filters(input_folder, lungs=None, meta=None):
+    """
+    skip and store arguments of infer_folder for a patch folder.
+
+    Args:
+        input_folder (str): Folder of .mhd patches
+        lungs (str): lungs.json of the lungs stage, patches outside the lungs are skipped
+        meta (str): Extraction meta.json or meta.db (default <input_folder>/meta.json), a meta.db also records the status
+
+    Returns:
+        (skip, store): predicate on patch file names or None, MetaStore or None
+    """
+    from utils.meta_store import open_store
+    skip = None
+    if lungs:
+        from utils.lung_mask import LungIndex, outside_lungs
+        skip = outside_lungs(LungIndex(lungs), meta or os.path.join(input_folder, "meta.json"))
+    return skip, open_store(meta, create=False)
+
+
 def convert_to_vnet(data: dict):
     """
     Loads MHD images and runs VNet segmentation directly on them.
+    When data['meta'] is a meta.db every patch is recorded there under the "infer" stage.
+    data['weights'] (several files are ensembled), data['tta'] (flip variants) and
+    data['batch'] (patches per forward pass) switch to the batched TTA path.
     """
     INPUT = data['data']
     OUTPUT = data['out']
@@ -123,61 +148,269 @@ def convert_to_vnet(data: dict):
     ct_patches = sorted(glob.glob(os.path.join(INPUT, "*.mhd")))
     print(f"🔍 Found {len(ct_patches)} MHD files.")
 
-    vnet_inference(INPUT, OUTPUT)
+    skip, store = folder_filters(INPUT, data.get('lungs'), data.get('meta'))
+    if data.get('weights') or data.get('tta', 1) > 1 or data.get('batch', 1) > 1 or data.get('bench_tta'):
+        tta_inference(data, skip, store)
+    else:
+        vnet_inference(INPUT, OUTPUT, skip, store)
     print(f"✅ Segmentation completed for {len(ct_patches)} images.")
 
 
-def vnet_inference(input_folder, output_folder):
-    torch.cuda.init()
-    device = torch.device("cuda:1" if torch.cuda.is_available() else "cpu")
-    print(f"Using device: {device}")
-    
-    try:
-        model = VNet(in_channels=1, out_channels=1).to(device)
-        weight_path = "./weights/best_model1.pth"
-        if not os.path.exists(weight_path):
-            raise FileNotFoundError(f"Weight file not found: {weight_path}")
-        
-        model.load_state_dict(torch.load(weight_path, map_location=device), strict=False)
-        model.eval()
-    except Exception as e:
-        print(f"⚠️ Model loading error: {e}")
-        return
+def get_device():
+    if torch.cuda.is_available():
+        torch.cuda.init()
+        return torch.device("cuda:1" if torch.cuda.device_count() > 1 else "cuda:0")
+    return torch.device("cpu")
+
+
+def load_model(device, weight_path="./weights/best_model1.pth"):
+    """
+    Builds VNet and loads its weights, raises FileNotFoundError when the weights are missing.
+    """
+    model = VNet(in_channels=1, out_channels=1).to(device)
+    if not os.path.exists(weight_path):
+        raise FileNotFoundError(f"Weight file not found: {weight_path}")
+
+    model.load_state_dict(torch.load(weight_path, map_location=device), strict=False)
+    model.eval()
+    return model
+
+
+def normalize_patch(array):
+    """Min-max scales a patch to [0, 1] as float32."""
+    array = array.astype(np.float32)
+    return (array - array.min()) / (array.max() - array.min() + 1e-8)
+
 
+def predict_array(model, device, array):
+    """
+    Runs VNet on one patch array (z, y, x) and returns the binary mask as float32.
+    """
+    array = normalize_patch(array)
+    tensor = torch.tensor(array).unsqueeze(0).unsqueeze(0).to(device)
+    print(f"Input tensor shape: {tensor.shape}")
+
+    with torch.no_grad():
+        output = model(tensor)
+        output = torch.sigmoid(output)
+        output = (output > 0.5).float()
+
+    return output.squeeze().cpu().numpy()
+
+
+# flipped axes of a (N, C, D, H, W) batch, in the order variants are added by --tta
+FLIPS = [(), (4,), (3,), (2,), (3, 4), (2, 4), (2, 3), (2, 3, 4)]
+
+
+def load_models(device, weight_paths):
+    """Loads one VNet per weight file for ensembling."""
+    return [load_model(device, weight_path) for weight_path in weight_paths]
+
+
+def predict_tta(models, device, arrays, flips=FLIPS[:1], threshold=0.5):
+    """
+    Averages the sigmoid probabilities of several models over flipped copies of a batch.
+
+    All flipped copies of the batch go through each model in a single forward
+    pass, the probabilities are flipped back and summed in place into one
+    buffer, which is thresholded once at the end.
+
+    Args:
+        models (list): VNet models, see load_models
+        device (torch.device): Device of the models
+        arrays (list): Patch arrays (z, y, x) of one shape
+        flips (list): Entries of FLIPS, () is the plain pass
+        threshold (float): Threshold on the mean probability
+
+    Returns:
+        float32 array (batch, z, y, x) of binary masks
+    """
+    batch = torch.from_numpy(np.stack([normalize_patch(array) for array in arrays]))[:, None].to(device)
+    size = batch.shape[0]
+    inputs = torch.cat([batch.flip(flip) if flip else batch for flip in flips])
+    probability = torch.zeros_like(batch)
+    with torch.no_grad():
+        for model in models:
+            output = model(inputs).sigmoid_()
+            for variant, flip in enumerate(flips):
+                part = output[variant * size:(variant + 1) * size]
+                probability.add_(part.flip(flip) if flip else part)
+            del output
+    probability.div_(len(flips) * len(models))
+    return (probability[:, 0] > threshold).float().cpu().numpy()
+
+
+def batches_by_shape(paths, images, batch_size):
+    """Groups patches of equal size (border patches can be smaller) into batches of at most batch_size."""
+    groups = {}
+    for path, image in zip(paths, images):
+        groups.setdefault(image.GetSize(), []).append((path, image))
+    for members in groups.values():
+        for start in range(0, len(members), batch_size):
+            yield members[start:start + batch_size]
+
+
+def infer_folder_tta(models, device, input_folder, output_folder, flips=FLIPS[:1], batch_size=4, skip=None, store=None):
+    """
+    Runs the TTA/ensemble prediction on every .mhd patch of input_folder, batch_size patches per forward pass.
+    skip and store work like in infer_folder; returns the number of masks written.
+    """
     os.makedirs(output_folder, exist_ok=True)
-    
+    filenames = sorted(filename for filename in os.listdir(input_folder) if filename.endswith(".mhd"))
+    records = []
+    pending = []
+    for filename in filenames:
+        input_path = os.path.join(input_folder, filename)
+        if skip is not None and skip(filename):
+            write_empty_mask(input_path, os.path.join(output_folder, filename))
+            records.append((*split_key(filename[:-4]), "skipped", None))
+        else:
+            pending.append(filename)
+
+    for start in range(0, len(pending), batch_size * 8):
+        chunk = pending[start:start + batch_size * 8]
+        images = [sitk.ReadImage(os.path.join(input_folder, filename)) for filename in chunk]
+        for batch in batches_by_shape(chunk, images, batch_size):
+            names = [filename for filename, _ in batch]
+            try:
+                masks = predict_tta(models, device, [sitk.GetArrayViewFromImage(image) for _, image in batch], flips)
+            except Exception as e:
+                print(f"⚠️ Error processing {names}: {e}")
+                records += [(*split_key(filename[:-4]), "failed", None) for filename in names]
+                continue
+            for (filename, image), mask in zip(batch, masks):
+                output_image = sitk.GetImageFromArray(mask)
+                output_image.CopyInformation(image)
+                sitk.WriteImage(output_image, os.path.join(output_folder, filename))
+                records.append((*split_key(filename[:-4]), "done", None))
+            print(f"✅ Saved {len(batch)} masks ({len(flips)} flips x {len(models)} models)")
+    if store is not None:
+        store.append("infer", records)
+    return sum(status != "failed" for _, _, status, _ in records)
+
+
+def benchmark_tta(models, device, arrays, variants=(1, 2, 4, 8), batch_size=4):
+    """
+    Measures the prediction time per patch for a growing number of flip variants.
+
+    Returns:
+        List of dicts with variants, models, seconds_per_patch, patches_per_second and
+        cost_per_extra_variant (extra time of each added variant relative to one plain pass)
+    """
+    import time
+    results = []
+    predict_tta(models, device, arrays[:1], FLIPS[:1])  # warm up
+    for count in variants:
+        started = time.perf_counter()
+        for start in range(0, len(arrays), batch_size):
+            predict_tta(models, device, arrays[start:start + batch_size], FLIPS[:count])
+        seconds = (time.perf_counter() - started) / len(arrays)
+        results.append({"variants": count, "models": len(models), "seconds_per_patch": seconds, "patches_per_second": 1 / seconds})
+
+    base = results[0]["seconds_per_patch"]
+    print(f"{'variants':>8} {'models':>6} {'s/patch':>9} {'patches/s':>9} {'cost/extra':>10}")
+    for result in results:
+        extra = result["variants"] - results[0]["variants"]
+        result["cost_per_extra_variant"] = (result["seconds_per_patch"] - base) / (base * extra) if extra else 0.0
+        print(f"{result['variants']:>8} {result['models']:>6} {result['seconds_per_patch']:>9.3f} "
+              f"{result['patches_per_second']:>9.2f} {result['cost_per_extra_variant']:>10.2f}")
+    return results
+
+
+def infer_file(model, device, input_path, output_path, lock=None):
+    """
+    Runs VNet on one .mhd patch and writes the mask with the patch geometry.
+    lock serialises the forward pass when the model is shared between threads.
+    """
+    image = sitk.ReadImage(input_path)
+    array = sitk.GetArrayFromImage(image)
+    print(f"Processing: {os.path.basename(input_path)} | Shape: {array.shape}")
+
+    with lock or nullcontext():
+        output_array = predict_array(model, device, array)
+    output_image = sitk.GetImageFromArray(output_array)
+    output_image.CopyInformation(image)
+    sitk.WriteImage(output_image, output_path)
+    print(f"✅ Saved: {output_path}")
+
+
+def write_empty_mask(input_path, output_path):
+    """Writes an all-zero mask with the patch geometry, without running VNet."""
+    image = sitk.ReadImage(input_path)
+    output_image = sitk.GetImageFromArray(np.zeros(sitk.GetArrayViewFromImage(image).shape, dtype=np.float32))
+    output_image.CopyInformation(image)
+    sitk.WriteImage(output_image, output_path)
+    print(f"Skipped (outside lungs): {os.path.basename(input_path)}")
+
+
+def infer_folder(model, device, input_folder, output_folder, lock=None, skip=None, store=None):
+    """
+    Runs VNet on every .mhd patch of input_folder, returns the number of masks written.
+    Patches for which skip(filename) is true get an empty mask instead.
+    With a MetaStore each patch is recorded as "done", "skipped" or "failed" (stage "infer").
+    """
+    os.makedirs(output_folder, exist_ok=True)
+
+    done = 0
+    records = []
     for filename in os.listdir(input_folder):
         if not filename.endswith(".mhd"):
             continue
-            
+
         input_path = os.path.join(input_folder, filename)
         output_path = os.path.join(output_folder, filename)
-        
+
         try:
-          
-            image = sitk.ReadImage(input_path)
-            array = sitk.GetArrayFromImage(image).astype(np.float32)
-            print(f"Processing: {filename} | Shape: {array.shape}")
-            
-           
-                
-          
-            array = (array - array.min()) / (array.max() - array.min() + 1e-8)
-            tensor = torch.tensor(array).unsqueeze(0).unsqueeze(0).to(device)
-            print(f"Input tensor shape: {tensor.shape}")
-            
-     
-            with torch.no_grad():
-                output = model(tensor)
-                output = torch.sigmoid(output)
-                output = (output > 0.5).float()
-            
-            
-            output_array = output.squeeze().cpu().numpy()
-            output_image = sitk.GetImageFromArray(output_array)
-            output_image.CopyInformation(image)
-            sitk.WriteImage(output_image, output_path)
-            print(f"✅ Saved: {output_path}")
-            
+            if skip is not None and skip(filename):
+                write_empty_mask(input_path, output_path)
+                status = "skipped"
+            else:
+                infer_file(model, device, input_path, output_path, lock)
+                status = "done"
+            done += 1
         except Exception as e:
-            print(f"⚠️ Error processing {filename}: {e}")
\ No newline at end of file
+            print(f"⚠️ Error processing {filename}: {e}")
+            status = "failed"
+        records.append((*split_key(filename[:-4]), status, None))
+    if store is not None:
+        store.append("infer", records)
+    return done
+
+
+def vnet_inference(input_folder, output_folder, skip=None, store=None):
+    device = get_device()
+    print(f"Using device: {device}")
+    
+    try:
+        model = load_model(device)
+    except Exception as e:
+        print(f"⚠️ Model loading error: {e}")
+        return
+
+    infer_folder(model, device, input_folder, output_folder, skip=skip, store=store)
+
+
+def tta_inference(data, skip=None, store=None):
+    """
+    Batched TTA/ensemble inference of data['data'] into data['out'].
+    With data['bench_tta'] the flip variants 1, 2, 4 and 8 are timed on the first
+    patches first and written to <out>/tta_benchmark.json.
+    """
+    import json
+    device = get_device()
+    print(f"Using device: {device}")
+    models = load_models(device, data.get('weights') or ["./weights/best_model1.pth"])
+    flips = FLIPS[:data.get('tta', 1)]
+    batch_size = data.get('batch', 1)
+    os.makedirs(data['out'], exist_ok=True)
+
+    if data.get('bench_tta'):
+        paths = sorted(glob.glob(os.path.join(data['data'], "*.mhd")))
+        arrays = [sitk.GetArrayFromImage(sitk.ReadImage(path)) for path in paths]
+        shape = arrays[0].shape
+        arrays = [array for array in arrays if array.shape == shape][:max(batch_size, 8)]
+        results = benchmark_tta(models, device, arrays, batch_size=batch_size)
+        with open(os.path.join(data['out'], "tta_benchmark.json"), 'w') as f:
+            json.dump(results, f)
+
+    infer_folder_tta(models, device, data['data'], data['out'], flips, batch_size, skip, store)
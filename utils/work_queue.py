@@ -0,0 +1,305 @@
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+from pathlib import Path
+from utils.json_io import write_json_atomic
+
+ITEMS = "items"
+LOCKS = "locks"
+DONE = "done"
+
+
+def queue_dirs(queue_dir):
+    """Create (if needed) and return the items/locks/done folders of a work queue."""
+    paths = [os.path.join(queue_dir, name) for name in (ITEMS, LOCKS, DONE)]
+    for path in paths:
+        os.makedirs(path, exist_ok=True)
+    return paths
+
+
+def default_node_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def init_queue(queue_dir, data_dir):
+    """
+    Register every series (.mhd) of data_dir and of its subset subfolders as a work item.
+    Safe to run again, existing items are kept.
+
+    Returns:
+        Number of items in the queue
+    """
+    items_dir, _, _ = queue_dirs(queue_dir)
+    folders = [Path(data_dir)] + [d for d in Path(data_dir).iterdir() if d.is_dir()]
+    for folder in folders:
+        for file in folder.glob("*.mhd"):
+            item_path = os.path.join(items_dir, f"{file.stem}.json")
+            if not os.path.exists(item_path):
+                write_json_atomic(item_path, {"uid": file.stem, "path": str(file.resolve()), "subset": folder.name})
+    return len(os.listdir(items_dir))
+
+
+def fs_now(directory):
+    """
+    Current time of the filesystem holding directory: the mtime of a file created there just now.
+
+    Lock mtimes are stamped by the same (file server) clock, so lease ages
+    computed against it do not depend on the clocks of the nodes, which
+    may be skewed against each other and against the server.
+    """
+    path = os.path.join(directory, f".clock.{default_node_id()}.{threading.get_ident()}")
+    with open(path, 'w'):
+        pass
+    try:
+        return os.path.getmtime(path)
+    finally:
+        os.remove(path)
+
+
+def lease_age(lock_path):
+    """Seconds since the lock was created or last renewed, on the filesystem's clock (FileNotFoundError when gone)."""
+    mtime = os.path.getmtime(lock_path)
+    return fs_now(os.path.dirname(lock_path)) - mtime
+
+
+def try_lock(lock_path, node_id):
+    """
+    Create the lock file with O_EXCL, which only one node can win.
+
+    Returns:
+        Unique token written into the lock, None when the lock already exists
+    """
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    token = uuid.uuid4().hex
+    with os.fdopen(fd, 'w') as f:
+        json.dump({"node": node_id, "token": token, "claimed": time.time()}, f)
+    return token
+
+
+def lock_token(lock_path):
+    """Token of a lock file, None for a missing or half-written lock."""
+    try:
+        with open(lock_path, 'r') as f:
+            return json.load(f).get("token")
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def owns(lock_path, token):
+    """True while the lock at lock_path is still the one created with token."""
+    return token is not None and lock_token(lock_path) == token
+
+
+def release(lock_path, token):
+    """Delete the lock only if it is still ours; returns False when another node took it over."""
+    if not owns(lock_path, token):
+        return False
+    try:
+        os.remove(lock_path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def reclaim_expired(lock_path, lease_timeout):
+    """
+    Remove a lock whose lease (its mtime) is older than lease_timeout, i.e. of a crashed node.
+    The age is measured on the filesystem's clock, see lease_age.
+
+    The stale token is read first; the lock is then renamed away, which is atomic,
+    and the moved file is read again. If another node replaced the stale lock in
+    between, the moved file holds its fresh token and is put back (without
+    overwriting a lock created meanwhile) instead of being deleted.
+
+    Returns:
+        True when this call removed the stale lock
+    """
+    stale_token = lock_token(lock_path)
+    try:
+        expired = lease_age(lock_path) > lease_timeout
+    except FileNotFoundError:
+        return False
+    if not expired:
+        return False
+    expired_path = f"{lock_path}.expired.{uuid.uuid4().hex}"
+    try:
+        os.rename(lock_path, expired_path)
+    except FileNotFoundError:
+        return False  # another node reclaimed it first
+    if lock_token(expired_path) != stale_token or lease_age(expired_path) <= lease_timeout:
+        try:
+            os.link(expired_path, lock_path)
+        except FileExistsError:
+            pass  # a third node locked the item meanwhile; the owner of the moved lock sees it lost the lease
+        os.remove(expired_path)
+        return False
+    os.remove(expired_path)
+    return True
+
+
+def claim(queue_dir, node_id, lease_timeout):
+    """
+    Claim the next unfinished item. A lock whose lease is older than lease_timeout
+    belongs to a crashed node: it is removed by reclaim_expired and the item is
+    locked again with O_EXCL, so at most one node holds each lock.
+
+    Returns:
+        Item dict (with its "lock" path and "token") or None when every item is done or locked by a live node
+    """
+    items_dir, locks_dir, done_dir = queue_dirs(queue_dir)
+    for name in sorted(os.listdir(items_dir)):
+        if not name.endswith(".json") or os.path.exists(os.path.join(done_dir, name)):
+            continue
+        lock_path = os.path.join(locks_dir, f"{name[:-5]}.lock")
+        token = try_lock(lock_path, node_id)
+        if token is None:
+            if not reclaim_expired(lock_path, lease_timeout):
+                continue
+            print(f"Lease expired, retrying {name[:-5]}")
+            token = try_lock(lock_path, node_id)
+            if token is None:
+                continue
+        if os.path.exists(os.path.join(done_dir, name)):
+            release(lock_path, token)
+            continue
+        with open(os.path.join(items_dir, name), 'r') as f:
+            item = json.load(f)
+        item["lock"] = lock_path
+        item["token"] = token
+        return item
+    return None
+
+
+class Lease:
+    """
+    Keeps an item's lock fresh (touches its mtime, stamped by the filesystem's clock) while it is being processed.
+    Only a lock carrying our token is renewed; once another node has taken the
+    item over, lost is set and renewing stops.
+    """
+
+    def __init__(self, lock_path, token, lease_timeout):
+        self.lock_path = lock_path
+        self.token = token
+        self.interval = max(lease_timeout / 3, 0.1)
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.renew, daemon=True)
+
+    def renew(self):
+        while not self.stopped.wait(self.interval):
+            if not owns(self.lock_path, self.token):
+                self.lost = True
+                return
+            try:
+                os.utime(self.lock_path)
+            except FileNotFoundError:
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def node_meta_path(output_dir, node_id):
+    return os.path.join(output_dir, f"meta.{node_id}.json")
+
+
+def run_extraction_worker(data: dict):
+    """
+    Claim series from a shared queue and extract their patches until the queue is empty.
+
+    Each node keeps its own meta.<node>.json in the shared output folder (rewritten
+    after every series) and marks finished series in done/, so a crash loses at
+    most the series in progress, which is retried once its lease expires.
+
+    data keys: "queue", "out", "csv", "node" (optional), "lease" (seconds),
+    "spacing" (optional), "poll" (seconds to wait for leased items)
+    """
+    import pandas as pd
+    from utils.patching import extract_series
+    print(data)
+    QUEUE_DIR = data['queue']
+    OUTPUT_DIR = data['out']
+    node_id = data.get('node') or default_node_id()
+    lease_timeout = data.get('lease', 600)
+    poll_interval = data.get('poll', 5)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    _, _, done_dir = queue_dirs(QUEUE_DIR)
+
+    annots = pd.read_csv(data['csv'])
+    meta_path = node_meta_path(OUTPUT_DIR, node_id)
+    meta_data = {}
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta_data = json.load(f)
+
+    processed = 0
+    while True:
+        item = claim(QUEUE_DIR, node_id, lease_timeout)
+        if item is None:
+            if pending_items(QUEUE_DIR) == 0:
+                break
+            time.sleep(poll_interval)  # remaining items are leased by other nodes
+            continue
+        print(f"[{node_id}] Processing {item['uid']}")
+        with Lease(item["lock"], item["token"], lease_timeout) as lease:
+            coord_rows = annots[annots['seriesuid']==item['uid']]
+            meta_data.update(extract_series(item['path'], coord_rows, OUTPUT_DIR, spacing=data.get('spacing')))
+            write_json_atomic(meta_path, meta_data)
+            if lease.lost or not owns(item["lock"], item["token"]):
+                # another node reclaimed the item, it marks it done and reduce keeps its entries
+                print(f"[{node_id}] Lost the lease of {item['uid']}, leaving it to its new owner")
+                continue
+            write_json_atomic(os.path.join(done_dir, f"{item['uid']}.json"), {"node": node_id, "finished": time.time()})
+        release(item["lock"], item["token"])
+        processed += 1
+    print(f"[{node_id}] Queue drained, processed {processed} series")
+    return processed
+
+
+def pending_items(queue_dir):
+    """Number of items without a done marker."""
+    items_dir, _, done_dir = queue_dirs(queue_dir)
+    done = set(os.listdir(done_dir))
+    return sum(1 for name in os.listdir(items_dir) if name.endswith(".json") and name not in done)
+
+
+def reduce_meta(queue_dir, output_dir):
+    """
+    Merge the per-node meta.<node>.json files into meta.json. For every finished
+    series only the entries of the node that marked it done are kept, so partial
+    results of crashed nodes are ignored.
+    """
+    _, _, done_dir = queue_dirs(queue_dir)
+    owners = {}
+    for name in os.listdir(done_dir):
+        with open(os.path.join(done_dir, name), 'r') as f:
+            owners[name[:-5]] = json.load(f)["node"]
+
+    node_metas = {}
+    for name in os.listdir(output_dir):
+        if name.startswith("meta.") and name.endswith(".json") and name != "meta.json":
+            with open(os.path.join(output_dir, name), 'r') as f:
+                node_metas[name[len("meta."):-len(".json")]] = json.load(f)
+
+    merged = {}
+    for node_id, meta_data in node_metas.items():
+        for key, value in meta_data.items():
+            if owners.get(key.rsplit("_", 1)[0]) == node_id:
+                merged[key] = value
+
+    with open(os.path.join(output_dir, "meta.json"), 'w') as f:
+        json.dump(merged, f)
+    print(f"Merged {len(merged)} patches from {len(node_metas)} nodes, {pending_items(queue_dir)} series still pending")
+    return merged